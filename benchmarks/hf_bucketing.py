@@ -0,0 +1,67 @@
+"""HF batch times and padding with and without resolution bucketing, using a
+tiny random Qwen3-VL on CPU and pages from receipt to newspaper size.
+
+Usage:
+    PYTHONPATH=. python benchmarks/hf_bucketing.py
+"""
+
+import random
+import time
+
+import click
+from PIL import Image
+
+from benchmarks.tiny_qwen import load_tiny_model
+from chandra.model import hf
+from chandra.model.hf import PaddingStats, generate_hf
+from chandra.model.schema import BatchInputItem
+from chandra.settings import settings
+
+PAGE_SIZES = [(300, 800), (612, 792), (1275, 1650), (2480, 3508)]
+
+
+@click.command()
+@click.option("--batches", type=int, default=4)
+@click.option("--batch-size", type=int, default=8)
+@click.option("--max-output-tokens", type=int, default=16)
+@click.option("--max-pixels", type=int, default=1024 * 32 * 32)
+@click.option("--hidden-size", type=int, default=64)
+def main(
+    batches: int,
+    batch_size: int,
+    max_output_tokens: int,
+    max_pixels: int,
+    hidden_size: int,
+):
+    model = load_tiny_model(max_pixels=max_pixels, hidden_size=hidden_size)
+    rng = random.Random(0)
+    batch_list = [
+        [
+            BatchInputItem(
+                image=Image.new("RGB", rng.choice(PAGE_SIZES), "white"),
+                prompt="OCR",
+            )
+            for _ in range(batch_size)
+        ]
+        for _ in range(batches)
+    ]
+    # Warm up
+    generate_hf(batch_list[0][:1], model, max_output_tokens=2)
+
+    for bucketed in (False, True):
+        settings.HF_BUCKET_PAGES = bucketed
+        hf.padding_stats = PaddingStats()
+        start = time.perf_counter()
+        for batch in batch_list:
+            generate_hf(batch, model, max_output_tokens=max_output_tokens)
+        elapsed = time.perf_counter() - start
+        stats = hf.padding_stats
+        click.echo(
+            f"bucketed={bucketed}: {elapsed:.2f}s, "
+            f"{stats.padding} padding of {stats.tokens + stats.padding} prompt tokens "
+            f"({stats.padding / (stats.tokens + stats.padding):.1%})"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""CPU throughput of the HF backend, in tokens/sec and pages/min, for float32,
+bfloat16 and dynamic int8 linear layers.
+
+Runs a tiny random Qwen3-VL by default. --checkpoint loads a real one through
+load_model with TORCH_DEVICE=cpu. --json prints one JSON object per run, with
+the torch version and host, for tracking across releases.
+
+Usage:
+    PYTHONPATH=. python benchmarks/hf_cpu.py
+    PYTHONPATH=. python benchmarks/hf_cpu.py --checkpoint datalab-to/chandra --json
+"""
+
+import json
+import platform
+import time
+
+import click
+import torch
+from PIL import Image, ImageDraw
+
+from benchmarks.tiny_qwen import load_tiny_model
+from chandra.model.hf import (
+    configure_cpu_threads,
+    generate_hf,
+    load_model,
+    quantize_for_cpu,
+)
+from chandra.model.schema import BatchInputItem
+from chandra.settings import settings
+
+MODES = {
+    "float32": dict(dtype="float32", quantize=False),
+    "bfloat16": dict(dtype="bfloat16", quantize=False),
+    "int8": dict(dtype=None, quantize=True),
+}
+
+
+def make_page(idx: int) -> Image.Image:
+    image = Image.new("RGB", (850, 1100), "white")
+    draw = ImageDraw.Draw(image)
+    for line in range(20):
+        draw.text((60, 60 + line * 50), f"Page {idx} line {line}", fill="black")
+    return image
+
+
+def build_model(checkpoint: str | None, hidden_size: int, dtype, quantize: bool):
+    settings.TORCH_DEVICE = "cpu"
+    settings.TORCH_CPU_DTYPE = dtype
+    settings.TORCH_CPU_QUANTIZE = quantize
+    if checkpoint:
+        settings.MODEL_CHECKPOINT = checkpoint
+        return load_model()
+
+    # Same steps load_model takes after from_pretrained
+    model = load_tiny_model(hidden_size=hidden_size).to(settings.TORCH_DTYPE)
+    if quantize:
+        model = quantize_for_cpu(model)
+    return model
+
+
+@click.command()
+@click.option("--modes", default="float32,bfloat16,int8")
+@click.option("--pages", type=int, default=8)
+@click.option("--batch-size", type=int, default=4)
+@click.option("--max-output-tokens", type=int, default=128)
+@click.option("--threads", type=int, default=None)
+@click.option("--interop-threads", type=int, default=None)
+@click.option("--hidden-size", type=int, default=1024)
+@click.option("--checkpoint", default=None)
+@click.option("--json", "as_json", is_flag=True)
+def main(
+    modes: str,
+    pages: int,
+    batch_size: int,
+    max_output_tokens: int,
+    threads: int | None,
+    interop_threads: int | None,
+    hidden_size: int,
+    checkpoint: str | None,
+    as_json: bool,
+):
+    configure_cpu_threads(threads, interop_threads)
+    items = [BatchInputItem(image=make_page(idx), prompt="OCR") for idx in range(pages)]
+
+    for mode in modes.split(","):
+        model = build_model(checkpoint, hidden_size, **MODES[mode])
+        # Warm up
+        generate_hf(items[:1], model, max_output_tokens=2)
+
+        tokens = 0
+        start = time.perf_counter()
+        for idx in range(0, pages, batch_size):
+            results = generate_hf(
+                items[idx : idx + batch_size],
+                model,
+                max_output_tokens=max_output_tokens,
+            )
+            tokens += sum(result.token_count for result in results)
+        elapsed = time.perf_counter() - start
+
+        run = {
+            "mode": mode,
+            "model": checkpoint or f"tiny-qwen3-vl-{hidden_size}",
+            "dtype": str(settings.TORCH_DTYPE).removeprefix("torch."),
+            "threads": torch.get_num_threads(),
+            "tokens_per_sec": round(tokens / elapsed, 1),
+            "pages_per_min": round(pages / elapsed * 60, 1),
+            "seconds": round(elapsed, 2),
+            "torch": torch.__version__,
+            "cpu": torch.backends.cpu.get_cpu_capability(),
+            "host": platform.machine(),
+        }
+        if as_json:
+            click.echo(json.dumps(run))
+        else:
+            click.echo(
+                f"{mode}: {run['tokens_per_sec']} tokens/s, "
+                f"{run['pages_per_min']} pages/min ({elapsed:.1f}s, "
+                f"{run['threads']} threads)"
+            )
+        del model
+
+
+if __name__ == "__main__":
+    main()
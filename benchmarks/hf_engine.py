@@ -0,0 +1,72 @@
+"""HF throughput with static batches against the continuous batching engine,
+using a tiny random Qwen3-VL on CPU.
+
+The random model never emits EOS, so each page is given its own output length
+to stand in for pages with more or less text. A static batch decodes until its
+longest page is done, while the engine refills a slot as soon as a page ends.
+Pages are small so that, as on a GPU, decoding rather than prefill dominates.
+
+Usage:
+    PYTHONPATH=. python benchmarks/hf_engine.py
+"""
+
+import random
+import time
+
+import click
+from PIL import Image
+
+from benchmarks.tiny_qwen import load_tiny_model
+from chandra.model.engine import HFEngine
+from chandra.model.hf import generate_hf
+from chandra.model.schema import BatchInputItem
+
+
+@click.command()
+@click.option("--pages", type=int, default=48)
+@click.option("--batch-size", type=int, default=8)
+@click.option("--min-tokens", type=int, default=8)
+@click.option("--max-tokens", type=int, default=512)
+@click.option("--hidden-size", type=int, default=256)
+def main(
+    pages: int, batch_size: int, min_tokens: int, max_tokens: int, hidden_size: int
+):
+    model = load_tiny_model(hidden_size=hidden_size)
+    rng = random.Random(0)
+    items = [
+        BatchInputItem(image=Image.new("RGB", (256, 320), "white"), prompt="OCR")
+        for _ in range(pages)
+    ]
+    # Most pages are short, a few run long
+    lengths = [
+        min(max_tokens, int(rng.expovariate(4 / max_tokens)) + min_tokens)
+        for _ in range(pages)
+    ]
+    useful = sum(lengths)
+    # Warm up
+    generate_hf(items[:1], model, max_output_tokens=2)
+
+    start = time.perf_counter()
+    for idx in range(0, pages, batch_size):
+        batch_lengths = lengths[idx : idx + batch_size]
+        generate_hf(
+            items[idx : idx + batch_size], model, max_output_tokens=max(batch_lengths)
+        )
+    elapsed = time.perf_counter() - start
+    click.echo(f"static batches: {elapsed:.2f}s, {useful / elapsed:.1f} tokens/s")
+
+    engine = HFEngine(model, max_batch_size=batch_size)
+    start = time.perf_counter()
+    futures = [engine.submit(item, length) for item, length in zip(items, lengths)]
+    for future in futures:
+        future.result()
+    elapsed = time.perf_counter() - start
+    engine.close()
+    click.echo(
+        f"engine: {elapsed:.2f}s, {useful / elapsed:.1f} tokens/s, "
+        f"{engine.occupancy:.0%} slot occupancy"
+    )
+
+
+if __name__ == "__main__":
+    main()
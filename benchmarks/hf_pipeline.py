@@ -0,0 +1,81 @@
+"""HF batch throughput with the stages run back to back (depth 1) and
+pipelined, using a tiny random Qwen3-VL, with per-stage timings.
+
+On a CPU-only machine generate competes with preparation for the same cores.
+--accelerator-seconds adds a sleep to every generate call to stand in for an
+accelerator, which leaves the CPU free while it works.
+
+Usage:
+    PYTHONPATH=. python benchmarks/hf_pipeline.py --accelerator-seconds 0.5
+"""
+
+import time
+
+import click
+from PIL import Image, ImageDraw
+
+from benchmarks.tiny_qwen import load_tiny_model
+from chandra.model import hf
+from chandra.model.hf import PipelineStats, generate_hf_pipelined
+from chandra.model.schema import BatchInputItem
+
+
+def make_page(idx: int) -> Image.Image:
+    image = Image.new("RGB", (1700, 2200), "white")
+    draw = ImageDraw.Draw(image)
+    for line in range(40):
+        draw.text((100, 100 + line * 50), f"Page {idx} line {line}", fill="black")
+    return image
+
+
+@click.command()
+@click.option("--batches", type=int, default=8)
+@click.option("--batch-size", type=int, default=4)
+@click.option("--max-output-tokens", type=int, default=32)
+@click.option("--accelerator-seconds", type=float, default=0.0)
+@click.option("--depth", type=int, default=3)
+def main(
+    batches: int,
+    batch_size: int,
+    max_output_tokens: int,
+    accelerator_seconds: float,
+    depth: int,
+):
+    model = load_tiny_model()
+    if accelerator_seconds:
+        generate = model.generate
+
+        def slow_generate(**kwargs):
+            time.sleep(accelerator_seconds)
+            return generate(**kwargs)
+
+        model.generate = slow_generate
+
+    batch_list = [
+        [
+            BatchInputItem(image=make_page(idx * batch_size + i), prompt="OCR")
+            for i in range(batch_size)
+        ]
+        for idx in range(batches)
+    ]
+    # Warm up
+    list(generate_hf_pipelined([batch_list[0][:1]], model, max_output_tokens=2))
+
+    for run_depth in (1, depth):
+        hf.pipeline_stats = stats = PipelineStats()
+        start = time.perf_counter()
+        for _ in generate_hf_pipelined(
+            batch_list, model, max_output_tokens=max_output_tokens, depth=run_depth
+        ):
+            pass
+        elapsed = time.perf_counter() - start
+        click.echo(
+            f"depth {run_depth}: {elapsed:.2f}s, "
+            f"{batches * batch_size / elapsed:.2f} pages/s "
+            f"(prepare {stats.prepare:.2f}s, generate {stats.generate:.2f}s, "
+            f"decode {stats.decode:.2f}s, {stats.overlap:.2f}s overlapped)"
+        )
+
+
+if __name__ == "__main__":
+    main()
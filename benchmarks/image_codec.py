@@ -0,0 +1,62 @@
+"""Compare image transport codecs for vLLM requests.
+
+Reports encode time and payload size per codec and, with --api-base, the
+end-to-end latency of a short completion against a running server.
+
+Usage:
+    PYTHONPATH=. python benchmarks/image_codec.py page.png
+    PYTHONPATH=. python benchmarks/image_codec.py page.png --api-base http://localhost:8000/v1
+"""
+
+import statistics
+import time
+
+import click
+from PIL import Image
+
+from chandra.input import load_file
+from chandra.model.schema import BatchInputItem
+from chandra.model.util import scale_to_fit
+from chandra.model.vllm import IMAGE_CODECS, generate_vllm, image_to_data_url
+
+
+@click.command()
+@click.argument("input_path", type=click.Path(exists=True))
+@click.option("--codec", "codecs", multiple=True, default=IMAGE_CODECS)
+@click.option("--repeats", type=int, default=5)
+@click.option("--api-base", type=str, default=None)
+@click.option("--max-output-tokens", type=int, default=256)
+def main(input_path: str, codecs, repeats: int, api_base: str, max_output_tokens: int):
+    image: Image.Image = scale_to_fit(load_file(input_path, {"page_range": "0"})[0])
+    click.echo(f"Page size: {image.width}x{image.height}")
+
+    for codec in codecs:
+        timings = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            data_url = image_to_data_url(image, codec)
+            timings.append(time.perf_counter() - start)
+        line = (
+            f"{codec:<5} encode={statistics.median(timings) * 1000:.0f}ms "
+            f"payload={len(data_url) / 1024:.0f}KB"
+        )
+
+        if api_base:
+            latencies = []
+            for _ in range(repeats):
+                start = time.perf_counter()
+                generate_vllm(
+                    [BatchInputItem(image=image, prompt_type="ocr_layout")],
+                    max_output_tokens=max_output_tokens,
+                    max_retries=0,
+                    vllm_api_base=api_base,
+                    image_codec=codec,
+                )
+                latencies.append(time.perf_counter() - start)
+            line += f" end-to-end={statistics.median(latencies) * 1000:.0f}ms"
+
+        click.echo(line)
+
+
+if __name__ == "__main__":
+    main()
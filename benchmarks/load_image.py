@@ -0,0 +1,78 @@
+"""Time image decoding: full vs draft JPEG decode, and multi-page TIFF streaming.
+
+Usage:
+    PYTHONPATH=. python benchmarks/load_image.py
+    PYTHONPATH=. python benchmarks/load_image.py --jpeg photo.jpg --tiff fax.tiff
+"""
+
+import tempfile
+import time
+from pathlib import Path
+
+import click
+from PIL import Image, ImageDraw
+
+from chandra.input import iter_image_frames, load_image
+from chandra.model.util import scale_to_fit
+
+
+def make_jpeg(path: Path, size=(7728, 5152)):
+    image = Image.new("RGB", size, "white")
+    draw = ImageDraw.Draw(image)
+    for y in range(0, size[1], 120):
+        draw.text((100, y), "Sample receipt line " * 20, fill="black", font_size=64)
+    image.save(path, quality=90)
+
+
+def make_tiff(path: Path, num_frames: int = 20, size=(1728, 2200)):
+    frames = []
+    for idx in range(num_frames):
+        frame = Image.new("1", size, 1)
+        ImageDraw.Draw(frame).text((100, 100), f"Fax page {idx}", fill=0)
+        frames.append(frame)
+    frames[0].save(path, save_all=True, append_images=frames[1:], compression="group4")
+
+
+def time_jpeg(path: str, fit_to_model: bool, repeats: int):
+    start = time.perf_counter()
+    for _ in range(repeats):
+        image = scale_to_fit(load_image(path, fit_to_model=fit_to_model))
+    return (time.perf_counter() - start) / repeats, image.size
+
+
+@click.command()
+@click.option("--jpeg", "jpeg_path", type=click.Path(exists=True), default=None)
+@click.option("--tiff", "tiff_path", type=click.Path(exists=True), default=None)
+@click.option("--repeats", type=int, default=3)
+def main(jpeg_path: str, tiff_path: str, repeats: int):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if jpeg_path is None:
+            jpeg_path = str(Path(tmp_dir) / "large.jpg")
+            make_jpeg(Path(jpeg_path))
+        if tiff_path is None:
+            tiff_path = str(Path(tmp_dir) / "fax.tiff")
+            make_tiff(Path(tiff_path))
+
+        for fit_to_model in (False, True):
+            elapsed, size = time_jpeg(jpeg_path, fit_to_model, repeats)
+            click.echo(
+                f"jpeg draft={fit_to_model!s:<5} load+fit={elapsed * 1000:.0f}ms "
+                f"model input={size[0]}x{size[1]}"
+            )
+
+        start = time.perf_counter()
+        first_page = None
+        count = 0
+        for _ in iter_image_frames(tiff_path):
+            count += 1
+            if first_page is None:
+                first_page = time.perf_counter() - start
+        elapsed = time.perf_counter() - start
+        click.echo(
+            f"tiff frames={count} first page={first_page * 1000:.0f}ms "
+            f"total={elapsed * 1000:.0f}ms ({count / elapsed:.1f} pages/sec)"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""Compare PDF rasterization throughput and cost per page.
+
+Usage:
+    PYTHONPATH=. python benchmarks/pdf_render.py input.pdf --workers 1 --workers 8
+    PYTHONPATH=. python benchmarks/pdf_render.py input.pdf --compare-budget
+"""
+
+import time
+
+import click
+import pypdfium2 as pdfium
+
+from chandra.input import iter_pdf_images, parse_range_str, render_pdf_page
+from chandra.model.util import scale_to_fit
+
+
+def time_render(filepath: str, page_range, workers: int):
+    start = time.perf_counter()
+    count = 0
+    for _ in iter_pdf_images(filepath, page_range, workers=workers):
+        count += 1
+    return count, time.perf_counter() - start
+
+
+def compare_budget(filepath: str, page_range):
+    """CPU time and raster bytes per page: render-then-downscale vs budget render."""
+    doc = pdfium.PdfDocument(filepath)
+    doc.init_forms()
+    pages = page_range or range(len(doc))
+    stats = {"downscale": [0.0, 0], "budget": [0.0, 0]}
+    for page in pages:
+        start = time.process_time()
+        image = render_pdf_page(doc, page, fit_to_model=False)
+        resized = scale_to_fit(image)
+        peak = image.width * image.height * 3
+        if resized is not image:
+            peak += resized.width * resized.height * 3
+        stats["downscale"][0] += time.process_time() - start
+        stats["downscale"][1] = max(stats["downscale"][1], peak)
+
+        start = time.process_time()
+        image = render_pdf_page(doc, page, fit_to_model=True)
+        stats["budget"][0] += time.process_time() - start
+        stats["budget"][1] = max(stats["budget"][1], image.width * image.height * 3)
+    doc.close()
+
+    for name, (cpu, peak) in stats.items():
+        click.echo(
+            f"{name:<10} cpu/page={cpu / len(pages) * 1000:.1f}ms "
+            f"peak raster={peak / 1024**2:.1f}MB"
+        )
+
+
+@click.command()
+@click.argument("pdf_path", type=click.Path(exists=True))
+@click.option("--workers", type=int, multiple=True, default=[1, 2, 4, 8])
+@click.option("--page-range", type=str, default=None)
+@click.option("--compare-budget", "budget", is_flag=True, default=False)
+def main(pdf_path: str, workers, page_range: str, budget: bool):
+    page_range = parse_range_str(page_range) if page_range else None
+    if budget:
+        compare_budget(pdf_path, page_range)
+        return
+
+    for num_workers in workers:
+        count, elapsed = time_render(pdf_path, page_range, num_workers)
+        click.echo(
+            f"workers={num_workers:<3} pages={count:<5} "
+            f"time={elapsed:.2f}s pages/sec={count / elapsed:.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""Compare the markdown-based and raw repeat detectors.
+
+Times one full check (both cut_from_end variants, as the retry policy runs
+them) on outputs of growing size, and the total check cost of streaming a
+looping generation through RepeatMonitor.
+
+Usage:
+    PYTHONPATH=. python benchmarks/repeat_detector.py
+"""
+
+import random
+import time
+
+import click
+
+from chandra.model.util import (
+    RepeatMonitor,
+    detect_repeat_token,
+    has_repeat,
+)
+
+WORDS = "the of and to in a is that for it as was with be by on not this are".split()
+
+
+def make_output(rng: random.Random, chars: int) -> str:
+    blocks = []
+    size = 0
+    while size < chars:
+        if rng.random() < 0.2:
+            rows = "".join(
+                f"<tr><td>{rng.randint(0, 999)}</td><td>{rng.choice(WORDS)}</td></tr>"
+                for _ in range(10)
+            )
+            block = f'<div data-bbox="1 2 3 4" data-label="Table"><table>{rows}</table></div>'
+        else:
+            text = " ".join(rng.choice(WORDS) for _ in range(rng.randint(10, 60)))
+            block = f'<div data-bbox="1 2 3 4" data-label="Text"><p>{text}</p></div>'
+        blocks.append(block)
+        size += len(block)
+    return "".join(blocks)
+
+
+def markdown_has_repeat(text: str) -> bool:
+    return detect_repeat_token(text) or (
+        len(text) > 50 and detect_repeat_token(text, cut_from_end=50)
+    )
+
+
+def stream_markdown(pieces, check_every: int) -> int:
+    """Same schedule as RepeatMonitor, checking the whole text so far."""
+    parts, length, next_check = [], 0, check_every
+    for idx, piece in enumerate(pieces):
+        parts.append(piece)
+        length += len(piece)
+        if length >= next_check:
+            next_check = length + check_every
+            if markdown_has_repeat("".join(parts)):
+                return idx
+    return len(pieces)
+
+
+def stream_raw(pieces, check_every: int) -> int:
+    monitor = RepeatMonitor(check_every=check_every)
+    for idx, piece in enumerate(pieces):
+        if monitor.feed(piece):
+            return idx
+    return len(pieces)
+
+
+def time_call(fn, text: str, repeats: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn(text)
+    return (time.perf_counter() - start) / repeats
+
+
+@click.command()
+@click.option("--repeats", type=int, default=20)
+@click.option("--check-every", type=int, default=512)
+def main(repeats: int, check_every: int):
+    rng = random.Random(0)
+    click.echo(f"{'chars':>8} {'markdown':>12} {'raw':>12}")
+    for chars in (2_000, 10_000, 50_000):
+        text = make_output(rng, chars)
+        markdown_ms = time_call(markdown_has_repeat, text, repeats) * 1000
+        raw_ms = time_call(has_repeat, text, repeats) * 1000
+        click.echo(f"{len(text):>8} {markdown_ms:>10.2f}ms {raw_ms:>10.2f}ms")
+
+    # Page that starts looping halfway through a 12k-token budget
+    looping = (
+        '<div data-bbox="1 2 3 4" data-label="Text"><p>' + "the same line " * 2_000
+    )
+    text = make_output(rng, 24_000) + looping
+    pieces = [text[i : i + 4] for i in range(0, len(text), 4)]
+    for name, stream in (("markdown", stream_markdown), ("raw", stream_raw)):
+        start = time.perf_counter()
+        stopped_at = stream(pieces, check_every)
+        elapsed = time.perf_counter() - start
+        click.echo(
+            f"stream {name:<8} stopped at chunk {stopped_at} of {len(pieces)} "
+            f"in {elapsed * 1000:.1f}ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
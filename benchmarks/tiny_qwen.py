@@ -0,0 +1,134 @@
+"""Tiny randomly initialized Qwen3-VL model and processor, built offline, for
+running the HF backend on CPU in benchmarks and tests."""
+
+import torch
+from transformers import (
+    PreTrainedTokenizer,
+    Qwen3VLConfig,
+    Qwen3VLForConditionalGeneration,
+    Qwen3VLProcessor,
+)
+from transformers.models.qwen2_vl.image_processing_qwen2_vl import (
+    Qwen2VLImageProcessor,
+)
+from transformers.models.qwen3_vl.video_processing_qwen3_vl import (
+    Qwen3VLVideoProcessor,
+)
+
+SPECIAL_TOKENS = [
+    "<|endoftext|>",
+    "<|im_start|>",
+    "<|im_end|>",
+    "<|vision_start|>",
+    "<|vision_end|>",
+    "<|image_pad|>",
+    "<|video_pad|>",
+]
+
+CHAT_TEMPLATE = (
+    "{% for message in messages %}<|im_start|>{{ message['role'] }}\n"
+    "{% for content in message['content'] %}"
+    "{% if content['type'] == 'image' %}<|vision_start|><|image_pad|><|vision_end|>"
+    "{% else %}{{ content['text'] }}{% endif %}"
+    "{% endfor %}<|im_end|>\n{% endfor %}"
+    "{% if add_generation_prompt %}<|im_start|>assistant\n{% endif %}"
+)
+
+
+class CharTokenizer(PreTrainedTokenizer):
+    """One token per printable ASCII character, plus the Qwen special tokens."""
+
+    def __init__(self, **kwargs):
+        chars = [chr(i) for i in range(32, 127)] + ["\n"]
+        self.vocab = {token: i for i, token in enumerate(SPECIAL_TOKENS + chars)}
+        self.tokens = {i: token for token, i in self.vocab.items()}
+        super().__init__(
+            pad_token="<|endoftext|>",
+            eos_token="<|im_end|>",
+            extra_special_tokens=SPECIAL_TOKENS[1:],
+            **kwargs,
+        )
+
+    @property
+    def vocab_size(self) -> int:
+        return len(self.vocab)
+
+    def get_vocab(self):
+        return dict(self.vocab)
+
+    def _tokenize(self, text: str, **kwargs):
+        return list(text)
+
+    def _convert_token_to_id(self, token: str) -> int:
+        return self.vocab.get(token, 0)
+
+    def _convert_id_to_token(self, index: int) -> str:
+        return self.tokens.get(index, "")
+
+    def convert_tokens_to_string(self, tokens) -> str:
+        return "".join(tokens)
+
+
+def load_tiny_model(
+    max_pixels: int = 1024 * 32 * 32, hidden_size: int = 64, seed: int = 0
+):
+    """A model shaped like load_model's, with `model.processor` attached.
+
+    The image processor uses Qwen3-VL's 16px patches merged 2x2, capped at
+    `max_pixels` so pages stay cheap on CPU.
+    """
+    tokenizer = CharTokenizer()
+    image_processor = Qwen2VLImageProcessor(
+        patch_size=16,
+        merge_size=2,
+        temporal_patch_size=2,
+        min_pixels=4 * 32 * 32,
+        max_pixels=max_pixels,
+    )
+    processor = Qwen3VLProcessor(
+        image_processor=image_processor,
+        tokenizer=tokenizer,
+        video_processor=Qwen3VLVideoProcessor(),
+        chat_template=CHAT_TEMPLATE,
+    )
+    config = Qwen3VLConfig(
+        text_config=dict(
+            vocab_size=tokenizer.vocab_size,
+            hidden_size=hidden_size,
+            intermediate_size=hidden_size * 2,
+            num_hidden_layers=2,
+            num_attention_heads=4,
+            num_key_value_heads=2,
+            head_dim=hidden_size // 4,
+            max_position_embeddings=8192,
+            rope_scaling={
+                "rope_type": "default",
+                "mrope_section": [2, 3, 3],
+                "mrope_interleaved": True,
+            },
+        ),
+        vision_config=dict(
+            depth=1,
+            hidden_size=hidden_size,
+            intermediate_size=hidden_size * 2,
+            num_heads=4,
+            out_hidden_size=hidden_size,
+            patch_size=16,
+            spatial_merge_size=2,
+            temporal_patch_size=2,
+            deepstack_visual_indexes=[0],
+            num_position_embeddings=64,
+        ),
+        image_token_id=processor.image_token_id,
+        video_token_id=processor.video_token_id,
+        vision_start_token_id=processor.vision_start_token_id,
+        vision_end_token_id=processor.vision_end_token_id,
+        eos_token_id=tokenizer.eos_token_id,
+        pad_token_id=tokenizer.pad_token_id,
+    )
+    torch.manual_seed(seed)
+    model = Qwen3VLForConditionalGeneration(config).eval()
+    model.generation_config.pad_token_id = tokenizer.pad_token_id
+    model.generation_config.eos_token_id = tokenizer.eos_token_id
+    model.processor = processor
+    return model
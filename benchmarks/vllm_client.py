@@ -0,0 +1,57 @@
+"""p50/p99 latency of single-page generate_vllm calls against a local stub server,
+with a fresh client per call versus the shared pooled client.
+
+Usage:
+    PYTHONPATH=. python benchmarks/vllm_client.py --calls 200
+"""
+
+import statistics
+import time
+
+import click
+from PIL import Image
+
+from benchmarks.vllm_stub import StubVLLMServer
+from chandra.model.schema import BatchInputItem
+from chandra.model.vllm import clear_clients, generate_vllm
+from chandra.settings import settings
+
+
+def percentile(values, pct: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct))]
+
+
+def run(server: StubVLLMServer, calls: int, fresh_client: bool):
+    batch = [BatchInputItem(image=Image.new("RGB", (64, 64), "white"), prompt="OCR")]
+    latencies = []
+    for _ in range(calls):
+        if fresh_client:
+            clear_clients()
+        start = time.perf_counter()
+        generate_vllm(batch, max_retries=0, vllm_api_base=server.url)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+@click.command()
+@click.option("--calls", type=int, default=200)
+@click.option("--server-latency", type=float, default=0.005)
+def main(calls: int, server_latency: float):
+    # Force model discovery, as when VLLM_MODEL_NAME is unset
+    settings.VLLM_MODEL_NAME = None
+    for fresh_client in (True, False):
+        clear_clients()
+        with StubVLLMServer(latency=server_latency) as server:
+            latencies = run(server, calls, fresh_client)
+            label = "per-call client" if fresh_client else "pooled client"
+            click.echo(
+                f"{label:<16} p50={statistics.median(latencies) * 1000:.1f}ms "
+                f"p99={percentile(latencies, 0.99) * 1000:.1f}ms "
+                f"connections={server.connections} "
+                f"model list calls={server.model_list_calls}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""Compare a fixed worker count against the adaptive concurrency limit, on a
+stub server that, like vLLM with --max-num-seqs, only runs so many requests
+at once and queues the rest.
+
+Usage:
+    PYTHONPATH=. python benchmarks/vllm_concurrency.py
+"""
+
+import time
+
+import click
+from PIL import Image
+
+from benchmarks.vllm_stub import StubVLLMServer
+from chandra.model.router import clear_routers, get_router
+from chandra.model.schema import BatchInputItem
+from chandra.model.vllm import clear_clients, generate_vllm
+from chandra.settings import settings
+
+
+@click.command()
+@click.option("--pages", type=int, default=300)
+@click.option("--workers", type=int, default=64)
+@click.option("--max-num-seqs", type=int, default=16)
+@click.option("--latency", type=float, default=0.3)
+@click.option("--token-latency", type=float, default=0.01)
+def main(
+    pages: int,
+    workers: int,
+    max_num_seqs: int,
+    latency: float,
+    token_latency: float,
+):
+    batch = [
+        BatchInputItem(image=Image.new("RGB", (256, 256), "white"), prompt="OCR")
+    ] * pages
+
+    for adaptive in (False, True):
+        settings.VLLM_ADAPTIVE_CONCURRENCY = adaptive
+        clear_clients()
+        clear_routers()
+        with StubVLLMServer(
+            latency=latency, token_latency=token_latency, max_num_seqs=max_num_seqs
+        ) as server:
+            start = time.perf_counter()
+            generate_vllm(
+                batch, max_retries=0, max_workers=workers, vllm_api_base=server.url
+            )
+            elapsed = time.perf_counter() - start
+            stats = get_router(server.url).stats()[0]
+
+        name = "adaptive" if adaptive else f"fixed {workers}"
+        line = (
+            f"{name:<10} {pages / elapsed:>6.1f} pages/s, "
+            f"{stats['mean_latency'] * 1000:>6.0f}ms mean request latency"
+        )
+        if adaptive:
+            line += f", limit settled at {stats['concurrency_limit']}"
+        click.echo(line)
+    clear_routers()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""Batch times with and without hedging, on a stub server where a few
+requests are several times slower than the rest.
+
+Usage:
+    PYTHONPATH=. python benchmarks/vllm_hedging.py
+"""
+
+import random
+import statistics
+import time
+
+import click
+from PIL import Image
+
+from benchmarks.vllm_stub import StubVLLMServer
+from chandra.model import hedging, vllm
+from chandra.model.hedging import HedgePolicy
+from chandra.model.router import clear_routers
+from chandra.model.schema import BatchInputItem
+from chandra.model.vllm import clear_clients, generate_vllm
+from chandra.settings import settings
+
+
+@click.command()
+@click.option("--batches", type=int, default=12)
+@click.option("--batch-size", type=int, default=28)
+@click.option("--latency", type=float, default=0.2)
+@click.option("--slow-prob", type=float, default=0.03)
+@click.option("--slowdown", type=float, default=8.0)
+@click.option("--budget", type=float, default=0.05)
+def main(
+    batches: int,
+    batch_size: int,
+    latency: float,
+    slow_prob: float,
+    slowdown: float,
+    budget: float,
+):
+    batch = [
+        BatchInputItem(image=Image.new("RGB", (256, 256), "white"), prompt="OCR")
+    ] * batch_size
+
+    for hedge in (False, True):
+        settings.VLLM_HEDGE = hedge
+        policy = HedgePolicy(budget=budget)
+        hedging.hedge_policy = vllm.hedge_policy = policy
+        clear_clients()
+        clear_routers()
+        rng = random.Random(0)
+
+        def page_latency():
+            return latency * (slowdown if rng.random() < slow_prob else 1)
+
+        times = []
+        with StubVLLMServer(latency=page_latency) as server:
+            for _ in range(batches):
+                start = time.perf_counter()
+                generate_vllm(batch, max_retries=0, vllm_api_base=server.url)
+                times.append(time.perf_counter() - start)
+            requests = server.requests
+
+        line = (
+            f"{'hedged' if hedge else 'unhedged':<9} "
+            f"median batch {statistics.median(times):.2f}s, "
+            f"total {sum(times):.1f}s, {requests} requests"
+        )
+        if hedge:
+            line += f", {policy.hedges} hedges, {policy.wins} won"
+        click.echo(line)
+    clear_routers()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""Time retried looping pages: regenerating from scratch, continuing from the
+last good block, and racing speculative continuations.
+
+The stub streams a page of --tokens chunks. The greedy attempt starts looping
+--loop-at of the way through, and each sampled retry loops again with
+probability --retry-loop-prob.
+
+Usage:
+    PYTHONPATH=. python benchmarks/vllm_retry.py
+"""
+
+import random
+import time
+from collections import defaultdict
+
+import click
+from PIL import Image
+
+from benchmarks.vllm_stub import StubVLLMServer
+from chandra.model.schema import BatchInputItem
+from chandra.model import vllm
+from chandra.model.vllm import SpeculationStats, clear_clients, generate_vllm
+from chandra.settings import settings
+
+CHUNK_CHARS = 4
+
+
+def make_blocks(count: int):
+    return [
+        f'<div data-bbox="0 {i} 10 {i + 1}" data-label="Text"><p>Block {i} text.</p></div>'
+        for i in range(count)
+    ]
+
+
+MODES = {
+    # name: (continue from the last good block, race speculative retries)
+    "regenerate": (False, False),
+    "race": (False, True),
+    "continue": (True, False),
+    "race+continue": (True, True),
+}
+
+
+@click.command()
+@click.option("--tokens", type=int, default=4000)
+@click.option("--loop-at", type=float, default=0.8)
+@click.option("--retry-loop-prob", type=float, default=0.5)
+@click.option("--token-latency", type=float, default=0.001)
+@click.option("--pages", type=int, default=5)
+@click.option("--race-size", type=int, default=3)
+def main(
+    tokens: int,
+    loop_at: float,
+    retry_loop_prob: float,
+    token_latency: float,
+    pages: int,
+    race_size: int,
+):
+    block_tokens = len(make_blocks(1)[0]) // CHUNK_CHARS
+    blocks = make_blocks(tokens // block_tokens)
+    page = "".join(blocks)
+    good_blocks = int(len(blocks) * loop_at)
+    looping = "".join(blocks[:good_blocks]) + "<div><p>" + "the same line " * 500
+    attempts = defaultdict(int)
+
+    def respond(body):
+        messages = body["messages"]
+        page_id = messages[0]["content"][1]["text"]
+        if body["temperature"] == 0:
+            loops = True
+        else:
+            # Serial attempt k and speculative seed k share an outcome
+            key = body.get("seed")
+            if key is None:
+                key = attempts[page_id]
+                attempts[page_id] += 1
+            loops = random.Random(f"{page_id}-{key}").random() < retry_loop_prob
+        text = looping if loops else page
+        if messages[-1]["role"] == "assistant":
+            return text[len(messages[-1]["content"]) :]
+        return text
+
+    for mode, (continue_on_repeat, race) in MODES.items():
+        settings.VLLM_CONTINUE_ON_REPEAT = continue_on_repeat
+        settings.VLLM_SPECULATIVE_RETRIES = race_size if race else 0
+        attempts.clear()
+        clear_clients()
+        stats = SpeculationStats()
+        vllm.speculation_stats = stats
+        with StubVLLMServer(
+            response=respond, token_latency=token_latency, chunk_chars=CHUNK_CHARS
+        ) as server:
+            start = time.perf_counter()
+            for idx in range(pages):
+                batch = [
+                    BatchInputItem(
+                        image=Image.new("RGB", (64, 64), "white"), prompt=f"page {idx}"
+                    )
+                ]
+                generate_vllm(batch, max_retries=6, vllm_api_base=server.url)
+            elapsed = (time.perf_counter() - start) / pages
+            decoded = server.streamed_chunks / pages
+        line = (
+            f"{mode:<12} {decoded:>6.0f} tokens decoded, "
+            f"{elapsed * 1000:>6.0f}ms per retried page"
+        )
+        if stats.races:
+            line += (
+                f" ({stats.extra_tokens / pages:.0f} extra tokens, "
+                f"{stats.seconds_saved / pages * 1000:.0f}ms saved per page estimated)"
+            )
+        click.echo(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""Compare routing policies across stub vLLM replicas of uneven speed.
+
+One replica is --slowdown times slower than the others and, optionally, one
+replica fails every request so it has to be ejected.
+
+Usage:
+    PYTHONPATH=. python benchmarks/vllm_router.py
+"""
+
+import time
+
+import click
+from PIL import Image
+
+from benchmarks.vllm_stub import StubVLLMServer
+from chandra.model.router import ROUTING_POLICIES, clear_routers
+from chandra.model.schema import BatchInputItem
+from chandra.model.vllm import clear_clients, generate_vllm
+from chandra.settings import settings
+
+
+@click.command()
+@click.option("--replicas", type=int, default=3)
+@click.option("--pages", type=int, default=200)
+@click.option("--workers", type=int, default=24)
+@click.option("--latency", type=float, default=0.05)
+@click.option("--slowdown", type=float, default=4.0)
+@click.option("--failing/--no-failing", default=False)
+def main(
+    replicas: int,
+    pages: int,
+    workers: int,
+    latency: float,
+    slowdown: float,
+    failing: bool,
+):
+    batch = [
+        BatchInputItem(image=Image.new("RGB", (256, 256), "white"), prompt="OCR")
+    ] * pages
+
+    for policy in ROUTING_POLICIES:
+        settings.VLLM_ROUTING_POLICY = policy
+        clear_clients()
+        clear_routers()
+        servers = [StubVLLMServer(latency=latency).start() for _ in range(replicas)]
+        servers[0].latency = latency * slowdown
+        if failing:
+            servers[-1].status = 503
+        try:
+            start = time.perf_counter()
+            results = generate_vllm(
+                batch,
+                max_retries=0,
+                max_failure_retries=3,
+                max_workers=workers,
+                vllm_api_base=",".join(server.url for server in servers),
+            )
+            elapsed = time.perf_counter() - start
+        finally:
+            for server in servers:
+                server.stop()
+
+        errors = sum(result.error for result in results)
+        split = "/".join(str(server.requests) for server in servers)
+        click.echo(
+            f"{policy:<15} {pages / elapsed:>6.1f} pages/s, {errors} errors, "
+            f"requests per replica {split}"
+        )
+    clear_routers()
+
+
+if __name__ == "__main__":
+    main()
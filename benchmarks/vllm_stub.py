@@ -0,0 +1,250 @@
+"""Minimal OpenAI-compatible stand-in for a vLLM server, for benchmarks and tests."""
+
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable
+
+DEFAULT_RESPONSE = (
+    '<div data-bbox="10 10 500 60" data-label="Text"><p>Stub page</p></div>'
+)
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    # The default backlog of 5 drops connections under high concurrency
+    request_queue_size = 4096
+
+
+class StubVLLMServer:
+    """Serves /v1/models and /v1/chat/completions from a background thread.
+
+    `latency` is a fixed delay or a callable returning one per request, and
+    `response` is a string or a callable taking the request body. Streamed
+    requests get the response in `chunk_chars` pieces, `token_latency` apart.
+    `status` is an HTTP status or a callable returning one per request; error
+    statuses fail the request, with `retry_after` as its Retry-After header.
+    Like vLLM's --max-num-seqs, `max_num_seqs` requests run at once and the
+    rest queue.
+    """
+
+    def __init__(
+        self,
+        latency: float | Callable[[], float] = 0.0,
+        response: str | Callable[[dict], str] = DEFAULT_RESPONSE,
+        model_name: str = "chandra",
+        token_latency: float = 0.0,
+        chunk_chars: int = 4,
+        status: int | Callable[[], int] = 200,
+        retry_after: str | None = None,
+        max_num_seqs: int | None = None,
+    ):
+        self.latency = latency
+        self.response = response
+        self.model_name = model_name
+        self.token_latency = token_latency
+        self.chunk_chars = chunk_chars
+        self.status = status
+        self.retry_after = retry_after
+        self.max_num_seqs = max_num_seqs
+        self.running = 0
+        self._slots = threading.Condition()
+        self.connections = 0
+        self.requests = 0
+        self.model_list_calls = 0
+        self.completed_streams = 0
+        self.aborted_streams = 0
+        self.streamed_chunks = 0
+        self.bodies = []
+        self._lock = threading.Lock()
+        self._server = _Server(("127.0.0.1", 0), self._make_handler())
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _count(self, field: str):
+        with self._lock:
+            setattr(self, field, getattr(self, field) + 1)
+
+    def _enter(self):
+        with self._slots:
+            while self.max_num_seqs and self.running >= self.max_num_seqs:
+                self._slots.wait()
+            self.running += 1
+
+    def _exit(self):
+        with self._slots:
+            self.running -= 1
+            self._slots.notify()
+
+    def _get_status(self) -> int:
+        return self.status() if callable(self.status) else self.status
+
+    def _get_latency(self) -> float:
+        return self.latency() if callable(self.latency) else self.latency
+
+    def _get_response(self, body: dict) -> str:
+        return self.response(body) if callable(self.response) else self.response
+
+    def _make_handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                super().setup()
+                stub._count("connections")
+
+            def log_message(self, format, *args):
+                pass
+
+            def handle(self):
+                # Clients hang up on streams they cancel
+                try:
+                    super().handle()
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+            def _send_json(self, payload: dict, status: int = 200):
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                if status != 200 and stub.retry_after is not None:
+                    self.send_header("Retry-After", stub.retry_after)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _send_event(self, payload: dict | str):
+                data = payload if isinstance(payload, str) else json.dumps(payload)
+                event = f"data: {data}\n\n".encode()
+                self.wfile.write(f"{len(event):x}\r\n".encode() + event + b"\r\n")
+                self.wfile.flush()
+
+            def _stream(self, body: dict, content: str):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+
+                chunk = {
+                    "id": "stub",
+                    "object": "chat.completion.chunk",
+                    "created": int(time.time()),
+                    "model": body.get("model", stub.model_name),
+                }
+                pieces = [
+                    content[i : i + stub.chunk_chars]
+                    for i in range(0, len(content), stub.chunk_chars)
+                ]
+                try:
+                    for piece in pieces:
+                        time.sleep(stub.token_latency)
+                        delta = {"content": piece}
+                        choice = {"index": 0, "delta": delta, "finish_reason": None}
+                        self._send_event({**chunk, "choices": [choice]})
+                        stub._count("streamed_chunks")
+                    if body.get("stream_options", {}).get("include_usage"):
+                        usage = {
+                            "prompt_tokens": 1,
+                            "completion_tokens": len(pieces),
+                            "total_tokens": 1 + len(pieces),
+                        }
+                        self._send_event({**chunk, "choices": [], "usage": usage})
+                    self._send_event("[DONE]")
+                    self.wfile.write(b"0\r\n\r\n")
+                    self.wfile.flush()
+                except (BrokenPipeError, ConnectionResetError):
+                    stub._count("aborted_streams")
+                    self.close_connection = True
+                    return
+                stub._count("completed_streams")
+
+            def do_GET(self):
+                if not self.path.endswith("/models"):
+                    self._send_json({"error": "not found"}, 404)
+                    return
+                stub._count("model_list_calls")
+                status = stub._get_status()
+                if status != 200:
+                    self._send_json({"error": "stub error"}, status)
+                    return
+                self._send_json(
+                    {
+                        "object": "list",
+                        "data": [
+                            {
+                                "id": stub.model_name,
+                                "object": "model",
+                                "created": 0,
+                                "owned_by": "stub",
+                            }
+                        ],
+                    }
+                )
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                body = json.loads(self.rfile.read(length) or b"{}")
+                stub._count("requests")
+                stub.bodies.append(body)
+                stub._enter()
+                try:
+                    self._respond(body)
+                finally:
+                    stub._exit()
+
+            def _respond(self, body: dict):
+                time.sleep(stub._get_latency())
+                status = stub._get_status()
+                if status != 200:
+                    self._send_json({"error": "stub error"}, status)
+                    return
+                content = stub._get_response(body)
+                if body.get("stream"):
+                    self._stream(body, content)
+                    return
+                # Same decode time as streaming the response
+                time.sleep(stub.token_latency * -(-len(content) // stub.chunk_chars))
+                self._send_json(
+                    {
+                        "id": "stub",
+                        "object": "chat.completion",
+                        "created": int(time.time()),
+                        "model": body.get("model", stub.model_name),
+                        "choices": [
+                            {
+                                "index": 0,
+                                "finish_reason": "stop",
+                                "message": {"role": "assistant", "content": content},
+                            }
+                        ],
+                        "usage": {
+                            "prompt_tokens": 1,
+                            "completion_tokens": len(content.split()),
+                            "total_tokens": 1 + len(content.split()),
+                        },
+                    }
+                )
+
+        return Handler
@@ -1,11 +1,25 @@
-from typing import List
+import html
+import io
+import math
+import multiprocessing
+import os
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from typing import BinaryIO, Iterable, Iterator, List, Tuple, Union
 import filetype
 from PIL import Image
 import pypdfium2 as pdfium
 import pypdfium2.raw as pdfium_c
 
+from chandra.raster_cache import get_raster_cache, hash_file
 from chandra.settings import settings
 
+# Anything pypdfium2 and Pillow can open: a path, raw bytes or a binary file object
+FileSource = Union[str, os.PathLike, bytes, bytearray, memoryview, BinaryIO]
+
 
 def flatten(page, flag=pdfium_c.FLAT_NORMALDISPLAY):
     rc = pdfium_c.FPDFPage_Flatten(page, flag)
@@ -13,10 +27,26 @@ def flatten(page, flag=pdfium_c.FLAT_NORMALDISPLAY):
         print(f"Failed to flatten annotations / form fields on page {page}.")
 
 
-def load_image(
-    filepath: str, min_image_dim: int = settings.MIN_IMAGE_DIM
-) -> Image.Image:
-    image = Image.open(filepath).convert("RGB")
+def get_draft_size(
+    size: Tuple[int, int],
+    min_image_dim: int = settings.MIN_IMAGE_DIM,
+    max_size: Tuple[int, int] = settings.MODEL_MAX_IMAGE_SIZE,
+) -> Tuple[int, int] | None:
+    """Smallest decode size that still covers the model pixel budget."""
+    width, height = size
+    max_pixels = max_size[0] * max_size[1]
+    if width * height <= max_pixels:
+        return None
+
+    scale = (max_pixels / (width * height)) ** 0.5
+    scale = max(scale, min_image_dim / min(width, height))
+    if scale >= 1:
+        return None
+    return math.ceil(width * scale), math.ceil(height * scale)
+
+
+def _prepare_image(image: Image.Image, min_image_dim: int) -> Image.Image:
+    image = image.convert("RGB")
     if image.width < min_image_dim or image.height < min_image_dim:
         scale = min_image_dim / min(image.width, image.height)
         new_size = (int(image.width * scale), int(image.height * scale))
@@ -24,30 +54,464 @@ def load_image(
     return image
 
 
-def load_pdf_images(
+def load_image(
+    filepath: FileSource,
+    min_image_dim: int = settings.MIN_IMAGE_DIM,
+    fit_to_model: bool | None = None,
+) -> Image.Image:
+    if fit_to_model is None:
+        fit_to_model = settings.IMAGE_DECODE_AT_MODEL_BUDGET
+
+    image = Image.open(filepath)
+    if fit_to_model and image.format == "JPEG":
+        # JPEG can decode straight at 1/2, 1/4 or 1/8 scale
+        draft_size = get_draft_size(image.size, min_image_dim)
+        if draft_size:
+            image.draft("RGB", draft_size)
+    return _prepare_image(image, min_image_dim)
+
+
+def iter_image_frames(
+    filepath: FileSource,
+    page_range: List[int] | None = None,
+    min_image_dim: int = settings.MIN_IMAGE_DIM,
+) -> Iterator[Image.Image]:
+    """Decode the frames of a multi-page image (e.g. TIFF faxes) one at a time."""
+    image = Image.open(filepath)
+    try:
+        for frame in get_page_indices(getattr(image, "n_frames", 1), page_range):
+            image.seek(frame)
+            yield _prepare_image(image, min_image_dim)
+    finally:
+        image.close()
+
+
+def get_page_indices(num_pages: int, page_range: List[int] | None) -> List[int]:
+    if not page_range:
+        return list(range(num_pages))
+    return sorted({page for page in page_range if 0 <= page < num_pages})
+
+
+def get_render_scale(
+    page_width: float,
+    page_height: float,
+    image_dpi: int = settings.IMAGE_DPI,
+    min_pdf_image_dim: int = settings.MIN_PDF_IMAGE_DIM,
+    max_size: Tuple[int, int] | None = None,
+) -> float:
+    min_page_dim = min(page_width, page_height)
+    scale_dpi = (min_pdf_image_dim / min_page_dim) * 72
+    scale_dpi = max(scale_dpi, image_dpi)
+    scale = scale_dpi / 72
+    if not max_size:
+        return scale
+
+    # Same pixel budget as scale_to_fit, so the model input needs no resample
+    max_pixels = max_size[0] * max_size[1]
+    pixels = page_width * page_height * scale**2
+    if pixels > max_pixels:
+        scale *= (max_pixels / pixels) ** 0.5
+        # pdfium rounds rendered dimensions up
+        while (
+            math.ceil(page_width * scale) * math.ceil(page_height * scale) > max_pixels
+        ):
+            scale *= 0.999
+    return scale
+
+
+def render_pdf_page(
+    doc: pdfium.PdfDocument,
+    page: int,
+    image_dpi: int = settings.IMAGE_DPI,
+    min_pdf_image_dim: int = settings.MIN_PDF_IMAGE_DIM,
+    fit_to_model: bool | None = None,
+    file_hash: str | None = None,
+    text_layer: bool = False,
+) -> Image.Image:
+    """Render a single page. Passing `file_hash` enables the raster cache.
+
+    With `text_layer`, eligible text blocks are attached as
+    `image.info["text_layer"]` (see extract_text_layer).
+    """
+    if fit_to_model is None:
+        fit_to_model = settings.PDF_RENDER_AT_MODEL_BUDGET
+    max_size = settings.MODEL_MAX_IMAGE_SIZE if fit_to_model else None
+
+    page_obj = doc[page]
+    scale = get_render_scale(
+        page_obj.get_width(),
+        page_obj.get_height(),
+        image_dpi,
+        min_pdf_image_dim,
+        max_size,
+    )
+
+    image = None
+    cache_key = None
+    if file_hash:
+        cache_key = get_raster_cache().make_key(file_hash, page, scale, flatten=True)
+        image = get_raster_cache().get(cache_key)
+
+    if image is None or text_layer:
+        # Form fields and annotations are drawn into the page, so the text
+        # layer of a cached page matches that of a fresh render
+        flatten(page_obj)
+        page_obj = doc[page]
+    if image is None:
+        image = page_obj.render(scale=scale).to_pil().convert("RGB")
+        if cache_key:
+            get_raster_cache().put(cache_key, image)
+
+    if text_layer:
+        image.info["text_layer"] = extract_text_layer(page_obj)
+    return image
+
+
+def extract_text_layer(
+    page_obj: pdfium.PdfPage,
+    min_chars: int = settings.TEXT_LAYER_MIN_CHARS,
+    max_paths: int = settings.TEXT_LAYER_MAX_PATHS,
+    margin: float = settings.TEXT_LAYER_MARGIN,
+) -> List[dict] | None:
+    """Text blocks from a born-digital page, or None if it needs the model.
+
+    Pages qualify when they have a usable text layer and no images, rotation or
+    heavy vector drawing (tables, charts). Block bboxes are fractions of the page
+    size so they can be scaled to any bbox_scale later. Short blocks within
+    `margin` of the top or bottom edge are labelled Page-Header / Page-Footer, so
+    they are filtered like the model's.
+    """
+    if page_obj.get_rotation() != 0:
+        return None
+
+    num_paths = 0
+    for obj in page_obj.get_objects(max_depth=5):
+        if obj.type in (pdfium_c.FPDF_PAGEOBJ_IMAGE, pdfium_c.FPDF_PAGEOBJ_SHADING):
+            return None
+        if obj.type == pdfium_c.FPDF_PAGEOBJ_PATH:
+            num_paths += 1
+            if num_paths > max_paths:
+                return None
+
+    textpage = page_obj.get_textpage()
+    try:
+        text = textpage.get_text_range()
+        visible = [char for char in text if not char.isspace()]
+        if len(visible) < min_chars:
+            return None
+        # Fonts without a unicode map extract as garbage
+        bad = sum(1 for char in visible if char == "\ufffd" or not char.isprintable())
+        if bad > 0.02 * len(visible):
+            return None
+
+        left, bottom, right, top = page_obj.get_bbox()
+        width, height = right - left, top - bottom
+        blocks = []
+        for idx in range(textpage.count_rects()):
+            rect = textpage.get_rect(idx)
+            line = " ".join(textpage.get_text_bounded(*rect).split())
+            if not line:
+                continue
+            line_left, line_bottom, line_right, line_top = rect
+            line_height = line_top - line_bottom
+
+            block = blocks[-1] if blocks else None
+            if block:
+                gap = block["bottom"] - line_top
+                overlaps = line_left < block["right"] and line_right > block["left"]
+                if overlaps and -0.5 * line_height <= gap <= 0.8 * line_height:
+                    block["lines"].append(line)
+                    block["left"] = min(block["left"], line_left)
+                    block["right"] = max(block["right"], line_right)
+                    block["bottom"] = min(block["bottom"], line_bottom)
+                    continue
+
+            blocks.append(
+                {
+                    "left": line_left,
+                    "bottom": line_bottom,
+                    "right": line_right,
+                    "top": line_top,
+                    "lines": [line],
+                }
+            )
+    finally:
+        textpage.close()
+
+    if not blocks:
+        return None
+
+    text_layer = []
+    for block in blocks:
+        bbox = [
+            max(0.0, (block["left"] - left) / width),
+            max(0.0, (top - block["top"]) / height),
+            min(1.0, (block["right"] - left) / width),
+            min(1.0, (top - block["bottom"]) / height),
+        ]
+        label = "Text"
+        if len(blocks) > 1 and len(block["lines"]) <= 2:
+            if bbox[3] <= margin:
+                label = "Page-Header"
+            elif bbox[1] >= 1 - margin:
+                label = "Page-Footer"
+        text_layer.append(
+            {"label": label, "bbox": bbox, "text": " ".join(block["lines"])}
+        )
+    return text_layer
+
+
+def text_layer_to_html(text_layer: List[dict], bbox_scale: int) -> str:
+    """Render text layer blocks in the same layout HTML format the model emits."""
+    divs = []
+    for block in text_layer:
+        bbox = " ".join(str(round(coord * bbox_scale)) for coord in block["bbox"])
+        divs.append(
+            f'<div data-bbox="{bbox}" data-label="{block["label"]}">'
+            f"<p>{html.escape(block['text'])}</p></div>"
+        )
+    return "\n".join(divs)
+
+
+def iter_pdf_images(
+    filepath: FileSource,
+    page_range: List[int] | None,
+    image_dpi: int = settings.IMAGE_DPI,
+    min_pdf_image_dim: int = settings.MIN_PDF_IMAGE_DIM,
+    workers: int | None = None,
+    fit_to_model: bool | None = None,
+    use_cache: bool | None = None,
+    text_layer: bool | None = None,
+) -> Iterator[Image.Image]:
+    if text_layer is None:
+        text_layer = settings.TEXT_LAYER_ENABLED
+    if fit_to_model is None:
+        fit_to_model = settings.PDF_RENDER_AT_MODEL_BUDGET
+    if workers is None:
+        workers = settings.PDF_RENDER_WORKERS
+    if use_cache is None:
+        use_cache = settings.RASTER_CACHE_ENABLED
+    file_hash = hash_file(filepath) if use_cache else None
+
+    doc = pdfium.PdfDocument(filepath)
+    page_indices = get_page_indices(len(doc), page_range)
+    is_path = isinstance(filepath, (str, os.PathLike))
+    if workers > 1 and len(page_indices) > 1 and is_path:
+        doc.close()
+        yield from _iter_pdf_images_parallel(
+            filepath,
+            page_indices,
+            image_dpi,
+            min_pdf_image_dim,
+            workers,
+            fit_to_model,
+            file_hash,
+            text_layer,
+        )
+        return
+
+    try:
+        doc.init_forms()
+        for page in page_indices:
+            yield render_pdf_page(
+                doc,
+                page,
+                image_dpi,
+                min_pdf_image_dim,
+                fit_to_model,
+                file_hash,
+                text_layer,
+            )
+    finally:
+        doc.close()
+
+
+# Document opened once per render worker process, see _init_render_worker
+_worker_doc = None
+
+
+def _init_render_worker(filepath: str):
+    global _worker_doc
+    _worker_doc = pdfium.PdfDocument(filepath)
+    _worker_doc.init_forms()
+
+
+def _render_page_to_shm(
+    page: int,
+    image_dpi: int,
+    min_pdf_image_dim: int,
+    fit_to_model: bool,
+    file_hash: str | None,
+    text_layer: bool,
+):
+    image = render_pdf_page(
+        _worker_doc,
+        page,
+        image_dpi,
+        min_pdf_image_dim,
+        fit_to_model,
+        file_hash,
+        text_layer,
+    )
+    data = image.tobytes()
+    shm = shared_memory.SharedMemory(create=True, size=max(len(data), 1))
+    shm.buf[: len(data)] = data
+    shm.close()
+    return shm.name, image.size, image.info
+
+
+def _image_from_shm(name: str, size, info: dict) -> Image.Image:
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        buf = shm.buf[: size[0] * size[1] * 3]
+        image = Image.frombytes("RGB", size, buf)
+        buf.release()
+    finally:
+        shm.close()
+        shm.unlink()
+    image.info.update(info)
+    return image
+
+
+def _iter_pdf_images_parallel(
     filepath: str,
+    page_indices: List[int],
+    image_dpi: int,
+    min_pdf_image_dim: int,
+    workers: int,
+    fit_to_model: bool,
+    file_hash: str | None,
+    text_layer: bool,
+) -> Iterator[Image.Image]:
+    """Render pages in worker processes, yielding them in page order.
+
+    Each worker opens its own document and hands pixels back through shared
+    memory. At most `2 * workers` pages are submitted ahead of the consumer.
+    """
+    workers = min(workers, len(page_indices))
+    pending = deque()
+    pages = iter(page_indices)
+    # Spawn, since callers may already be running prefetch threads
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_render_worker,
+        initargs=(filepath,),
+    ) as executor:
+        try:
+            while True:
+                while len(pending) < 2 * workers:
+                    page = next(pages, None)
+                    if page is None:
+                        break
+                    pending.append(
+                        executor.submit(
+                            _render_page_to_shm,
+                            page,
+                            image_dpi,
+                            min_pdf_image_dim,
+                            fit_to_model,
+                            file_hash,
+                            text_layer,
+                        )
+                    )
+                if not pending:
+                    return
+                yield _image_from_shm(*pending.popleft().result())
+        finally:
+            # Release shared memory for pages that were rendered but never consumed
+            for future in pending:
+                if future.cancel():
+                    continue
+                try:
+                    name = future.result()[0]
+                    shared_memory.SharedMemory(name=name).unlink()
+                except Exception:
+                    pass
+
+
+def load_pdf_images(
+    filepath: FileSource,
     page_range: List[int],
     image_dpi: int = settings.IMAGE_DPI,
     min_pdf_image_dim: int = settings.MIN_PDF_IMAGE_DIM,
+    workers: int | None = None,
+    fit_to_model: bool | None = None,
+    use_cache: bool | None = None,
+    text_layer: bool | None = None,
 ) -> List[Image.Image]:
-    doc = pdfium.PdfDocument(filepath)
-    doc.init_forms()
+    return list(
+        iter_pdf_images(
+            filepath,
+            page_range,
+            image_dpi,
+            min_pdf_image_dim,
+            workers,
+            fit_to_model,
+            use_cache,
+            text_layer,
+        )
+    )
+
+
+def prefetch(iterable: Iterable, max_pending: int) -> Iterator:
+    """Run `iterable` on a background thread, holding at most `max_pending` items."""
+    if max_pending <= 0:
+        yield from iterable
+        return
+
+    done = object()
+    items = queue.Queue(maxsize=max_pending)
+    stop = threading.Event()
+
+    def _put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
 
-    images = []
-    for page in range(len(doc)):
-        if not page_range or page in page_range:
-            page_obj = doc[page]
-            min_page_dim = min(page_obj.get_width(), page_obj.get_height())
-            scale_dpi = (min_pdf_image_dim / min_page_dim) * 72
-            scale_dpi = max(scale_dpi, image_dpi)
-            page_obj = doc[page]
-            flatten(page_obj)
-            page_obj = doc[page]
-            pil_image = page_obj.render(scale=scale_dpi / 72).to_pil().convert("RGB")
-            images.append(pil_image)
+    def _produce():
+        iterator = iter(iterable)
+        try:
+            for item in iterator:
+                if not _put((item, None)):
+                    return
+        except BaseException as e:
+            _put((done, e))
+            return
+        finally:
+            # Generators must be closed on the thread that drives them
+            if hasattr(iterator, "close"):
+                iterator.close()
+        _put((done, None))
 
-    doc.close()
-    return images
+    worker = threading.Thread(target=_produce, daemon=True)
+    worker.start()
+    try:
+        while True:
+            item, error = items.get()
+            if item is done:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
+        worker.join()
+
+
+def batched(iterable: Iterable, batch_size: int) -> Iterator[List]:
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
 
 
 def parse_range_str(range_str: str) -> List[int]:
@@ -63,14 +527,53 @@ def parse_range_str(range_str: str) -> List[int]:
     return page_lst
 
 
-def load_file(filepath: str, config: dict):
+def open_source(source: FileSource) -> str | os.PathLike | BinaryIO:
+    """Wrap in-memory buffers so they can be read like files."""
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return io.BytesIO(source)
+    return source
+
+
+def iter_file(filepath: FileSource, config: dict) -> Iterator[Image.Image]:
+    filepath = open_source(filepath)
     page_range = config.get("page_range")
     if page_range:
         page_range = parse_range_str(page_range)
 
     input_type = filetype.guess(filepath)
     if input_type and input_type.extension == "pdf":
-        images = load_pdf_images(filepath, page_range)
+        yield from iter_pdf_images(
+            filepath,
+            page_range,
+            use_cache=config.get("use_raster_cache"),
+            text_layer=config.get("use_text_layer"),
+        )
+    elif input_type and input_type.extension == "tif":
+        yield from iter_image_frames(filepath, page_range)
     else:
-        images = [load_image(filepath)]
-    return images
+        yield load_image(filepath)
+
+
+def iter_file_batches(
+    filepath: FileSource,
+    config: dict,
+    batch_size: int,
+    max_pending: int | None = None,
+) -> Iterator[List[Image.Image]]:
+    """Yield batches of pages, rendering ahead on a background thread.
+
+    At most `max_pending` rendered pages wait to be consumed, so memory stays
+    bounded while the next batch renders during inference on the current one.
+    """
+    if max_pending is None:
+        max_pending = settings.PDF_PREFETCH_PAGES
+    pages = prefetch(iter_file(filepath, config), max_pending)
+    try:
+        yield from batched(pages, batch_size)
+    finally:
+        # Joins the render thread, so `filepath` can be closed once this is
+        pages.close()
+
+
+def load_file(filepath: FileSource, config: dict):
+    return list(iter_file(filepath, config))
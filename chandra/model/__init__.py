@@ -1,8 +1,15 @@
-from typing import List
+import asyncio
+from collections import deque
+from concurrent.futures import Future
+from typing import Iterable, Iterator, List
 
-from chandra.model.hf import load_model, generate_hf
-from chandra.model.schema import BatchInputItem, BatchOutputItem
-from chandra.model.vllm import generate_vllm
+from chandra.input import text_layer_to_html
+from chandra.model.dedup import PageDedupIndex
+from chandra.model.engine import HFEngine
+from chandra.model.hf import load_model, generate_hf, generate_hf_pipelined
+from chandra.model.schema import BatchInputItem, BatchOutputItem, GenerationResult
+from chandra.model.util import is_blank_page
+from chandra.model.vllm import generate_vllm, generate_vllm_async
 from chandra.output import parse_markdown, parse_html, parse_chunks, extract_images
 from chandra.settings import settings
 
@@ -11,15 +18,20 @@ class InferenceManager:
     def __init__(self, method: str = "vllm"):
         assert method in ("vllm", "hf"), "method must be 'vllm' or 'hf'"
         self.method = method
+        # Shared across generate calls so later batches reuse earlier results
+        self.dedup_index = PageDedupIndex()
 
+        self.engine = None
         if method == "hf":
             self.model = load_model()
+            if settings.HF_CONTINUOUS_BATCHING:
+                self.engine = HFEngine(self.model)
         else:
             self.model = None
 
-    def generate(
-        self, batch: List[BatchInputItem], max_output_tokens=None, **kwargs
-    ) -> List[BatchOutputItem]:
+    def _prepare(self, batch: List[BatchInputItem], kwargs: dict) -> dict:
+        """Pop the options generate handles itself and work out which pages
+        actually need the model."""
         output_kwargs = {}
         if "include_images" in kwargs:
             output_kwargs["include_images"] = kwargs.pop("include_images")
@@ -28,27 +40,69 @@ class InferenceManager:
                 "include_headers_footers"
             )
         bbox_scale = kwargs.pop("bbox_scale", settings.BBOX_SCALE)
-        vllm_api_base = kwargs.pop("vllm_api_base", settings.VLLM_API_BASE)
+        use_text_layer = kwargs.pop("use_text_layer", True)
+        skip_blank = kwargs.pop("skip_blank", settings.SKIP_BLANK_PAGES)
+        dedup = kwargs.pop("dedup", settings.DEDUP_PAGES)
+        max_output_tokens = kwargs.get("max_output_tokens")
 
-        if self.method == "vllm":
-            results = generate_vllm(
-                batch,
-                max_output_tokens=max_output_tokens,
-                bbox_scale=bbox_scale,
-                vllm_api_base=vllm_api_base,
-                **kwargs,
-            )
-        else:
-            results = generate_hf(
-                batch,
-                self.model,
-                max_output_tokens=max_output_tokens,
-                bbox_scale=bbox_scale,
-                **kwargs,
-            )
+        # Pages with a usable text layer or no content are answered without the model
+        results = [None] * len(batch)
+        for idx, item in enumerate(batch):
+            if use_text_layer and item.text_layer:
+                raw = text_layer_to_html(item.text_layer, bbox_scale)
+                results[idx] = GenerationResult(raw=raw, token_count=0, error=False)
+            elif skip_blank and is_blank_page(item.image):
+                results[idx] = GenerationResult(raw="", token_count=0, skipped=True)
+        model_idxs = [idx for idx, result in enumerate(results) if result is None]
+
+        # Identical pages are only sent to the model once
+        deduplicated = set()
+        leaders, followers = {}, {}
+        if dedup:
+            generation_args = (self.method, max_output_tokens, bbox_scale)
+            keyed_items = [
+                (idx, self.dedup_index.make_key(batch[idx], *generation_args))
+                for idx in model_idxs
+            ]
+            cached, leaders, followers = self.dedup_index.plan(keyed_items)
+            for idx, result in cached.items():
+                results[idx] = result
+                deduplicated.add(idx)
+            model_idxs = sorted(leaders.values())
+
+        return dict(
+            results=results,
+            model_idxs=model_idxs,
+            leaders=leaders,
+            followers=followers,
+            deduplicated=deduplicated,
+            bbox_scale=bbox_scale,
+            use_text_layer=use_text_layer,
+            output_kwargs=output_kwargs,
+        )
+
+    def _finish(
+        self,
+        batch: List[BatchInputItem],
+        plan: dict,
+        model_results: List[GenerationResult],
+    ) -> List[BatchOutputItem]:
+        results = plan["results"]
+        deduplicated = plan["deduplicated"]
+        bbox_scale = plan["bbox_scale"]
+        output_kwargs = plan["output_kwargs"]
+
+        for idx, result in zip(plan["model_idxs"], model_results):
+            results[idx] = result
+
+        for key, idx in plan["leaders"].items():
+            self.dedup_index.put(key, results[idx])
+        for idx, leader_idx in plan["followers"].items():
+            results[idx] = results[leader_idx]
+            deduplicated.add(idx)
 
         output = []
-        for result, input_item in zip(results, batch):
+        for idx, (result, input_item) in enumerate(zip(results, batch)):
             chunks = parse_chunks(result.raw, input_item.image, bbox_scale=bbox_scale)
             output.append(
                 BatchOutputItem(
@@ -60,6 +114,151 @@ class InferenceManager:
                     token_count=result.token_count,
                     images=extract_images(result.raw, chunks, input_item.image),
                     error=result.error,
+                    from_text_layer=plan["use_text_layer"]
+                    and bool(input_item.text_layer),
+                    skipped=result.skipped,
+                    deduplicated=idx in deduplicated,
                 )
             )
         return output
+
+    def generate(
+        self, batch: List[BatchInputItem], max_output_tokens=None, **kwargs
+    ) -> List[BatchOutputItem]:
+        kwargs["max_output_tokens"] = max_output_tokens
+        plan = self._prepare(batch, kwargs)
+        vllm_api_base = kwargs.pop("vllm_api_base", settings.VLLM_API_BASE)
+        model_batch = [batch[idx] for idx in plan["model_idxs"]]
+
+        if not model_batch:
+            model_results = []
+        elif self.method == "vllm":
+            model_results = generate_vllm(
+                model_batch,
+                bbox_scale=plan["bbox_scale"],
+                vllm_api_base=vllm_api_base,
+                **kwargs,
+            )
+        elif self.engine is not None:
+            return self._collect(batch, plan, self._submit(batch, plan, kwargs))
+        else:
+            model_results = generate_hf(
+                model_batch,
+                self.model,
+                bbox_scale=plan["bbox_scale"],
+                **kwargs,
+            )
+        return self._finish(batch, plan, model_results)
+
+    async def agenerate(
+        self, batch: List[BatchInputItem], max_output_tokens=None, **kwargs
+    ) -> List[BatchOutputItem]:
+        """Asyncio version of generate, returning the same outputs.
+
+        With vllm, requests go through generate_vllm_async (accepting
+        `max_concurrency` and `semaphore` in place of `max_workers`). The hf
+        method and the CPU-bound pre and post processing run in worker threads
+        so the event loop stays responsive.
+        """
+        if self.method == "hf":
+            return await asyncio.to_thread(
+                self.generate, batch, max_output_tokens, **kwargs
+            )
+
+        kwargs["max_output_tokens"] = max_output_tokens
+        plan = await asyncio.to_thread(self._prepare, batch, kwargs)
+        vllm_api_base = kwargs.pop("vllm_api_base", settings.VLLM_API_BASE)
+        model_batch = [batch[idx] for idx in plan["model_idxs"]]
+
+        model_results = []
+        if model_batch:
+            model_results = await generate_vllm_async(
+                model_batch,
+                bbox_scale=plan["bbox_scale"],
+                vllm_api_base=vllm_api_base,
+                **kwargs,
+            )
+        return await asyncio.to_thread(self._finish, batch, plan, model_results)
+
+    def _submit(
+        self, batch: List[BatchInputItem], plan: dict, kwargs: dict
+    ) -> List[Future]:
+        return [
+            self.engine.submit(
+                batch[idx], kwargs.get("max_output_tokens"), plan["bbox_scale"]
+            )
+            for idx in plan["model_idxs"]
+        ]
+
+    def _collect(
+        self, batch: List[BatchInputItem], plan: dict, futures: List[Future]
+    ) -> List[BatchOutputItem]:
+        # A page the engine failed on comes back as an error, like generate_hf's
+        model_results = []
+        for future in futures:
+            try:
+                model_results.append(future.result())
+            except Exception as e:
+                print(f"Error generating page: {e}")
+                model_results.append(
+                    GenerationResult(raw="", token_count=0, error=True)
+                )
+        return self._finish(batch, plan, model_results)
+
+    def generate_iter(
+        self,
+        batches: Iterable[List[BatchInputItem]],
+        max_output_tokens=None,
+        **kwargs,
+    ) -> Iterator[List[BatchOutputItem]]:
+        # Batches are pulled lazily, so a prefetching loader keeps rendering
+        # the next pages while the current batch is being inferred.
+        if self.method == "hf" and self.engine is None:
+            yield from self._generate_iter_pipelined(batches, max_output_tokens, kwargs)
+            return
+        if self.engine is None:
+            for batch in batches:
+                yield self.generate(
+                    batch, max_output_tokens=max_output_tokens, **kwargs
+                )
+            return
+
+        # The next batch is queued before waiting on the current one, so the
+        # engine fills the slots its short pages free up. Pages repeated in
+        # the very next batch miss the dedup index and are generated again.
+        pending = None
+        for batch in batches:
+            batch_kwargs = dict(kwargs, max_output_tokens=max_output_tokens)
+            plan = self._prepare(batch, batch_kwargs)
+            submitted = (batch, plan, self._submit(batch, plan, batch_kwargs))
+            if pending is not None:
+                yield self._collect(*pending)
+            pending = submitted
+        if pending is not None:
+            yield self._collect(*pending)
+
+    def _generate_iter_pipelined(
+        self,
+        batches: Iterable[List[BatchInputItem]],
+        max_output_tokens,
+        kwargs: dict,
+    ) -> Iterator[List[BatchOutputItem]]:
+        """generate_iter for hf without the engine. The next batch is prepared
+        and the last one decoded while the current one generates."""
+        plans = deque()
+
+        def model_batches():
+            for batch in batches:
+                batch_kwargs = dict(kwargs, max_output_tokens=max_output_tokens)
+                plan = self._prepare(batch, batch_kwargs)
+                plans.append((batch, plan))
+                yield [batch[idx] for idx in plan["model_idxs"]]
+
+        for model_results in generate_hf_pipelined(
+            model_batches(),
+            self.model,
+            max_output_tokens,
+            bbox_scale=kwargs.get("bbox_scale", settings.BBOX_SCALE),
+        ):
+            batch, plan = plans.popleft()
+            yield self._finish(batch, plan, model_results)
@@ -0,0 +1,72 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Tuple
+
+from PIL import Image
+
+from chandra.model.schema import BatchInputItem, GenerationResult
+from chandra.settings import settings
+
+
+def pixel_hash(img: Image.Image) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f"{img.mode}{img.size}".encode())
+    digest.update(img.tobytes())
+    return digest.hexdigest()
+
+
+class PageDedupIndex:
+    """Bounded LRU of generation results keyed by page content and prompt.
+
+    Only pages with the same exact pixel hash share a result, so repeated
+    renders of a page match but re-scans of it don't. Near-duplicate matching
+    is left out on purpose: a threshold loose enough to absorb scanner noise and
+    misalignment also absorbs a changed digit in a form field, and that page
+    would silently get another page's text.
+    """
+
+    def __init__(self, max_entries: int = settings.DEDUP_INDEX_SIZE):
+        self.max_entries = max_entries
+        self._results: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self.lookups = 0
+        self.hits = 0
+
+    @staticmethod
+    def make_key(item: BatchInputItem, *generation_args) -> Tuple:
+        # pixel_hash covers the mode and size as well as the pixels
+        return pixel_hash(item.image), item.prompt, item.prompt_type, generation_args
+
+    def plan(
+        self, keyed_items: List[Tuple[int, Tuple]]
+    ) -> Tuple[Dict[int, GenerationResult], Dict[Tuple, int], Dict[int, int]]:
+        """Split (batch index, key) pairs into cached results, unique pages to
+        run and duplicates of those pages within the batch."""
+        cached, leaders, followers = {}, {}, {}
+        with self._lock:
+            for idx, key in keyed_items:
+                self.lookups += 1
+                if key in self._results:
+                    self._results.move_to_end(key)
+                    cached[idx] = self._results[key]
+                    self.hits += 1
+                elif key in leaders:
+                    followers[idx] = leaders[key]
+                    self.hits += 1
+                else:
+                    leaders[key] = idx
+        return cached, leaders, followers
+
+    def put(self, key: Tuple, result: GenerationResult):
+        if result.error or self.max_entries <= 0:
+            return
+        with self._lock:
+            self._results[key] = result
+            self._results.move_to_end(key)
+            while len(self._results) > self.max_entries:
+                self._results.popitem(last=False)
+
+    @property
+    def hit_rate(self) -> float:
+        return self.hits / self.lookups if self.lookups else 0.0
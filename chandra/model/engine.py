@@ -0,0 +1,329 @@
+import queue
+import threading
+from concurrent.futures import Future
+from typing import List
+
+import torch
+from transformers import DynamicCache
+
+from chandra.model.hf import bucket_batch, prepare_inputs, vision_token_count
+from chandra.model.schema import BatchInputItem, GenerationResult
+from chandra.model.util import has_repeat, repeat_check_chars
+from chandra.settings import settings
+
+
+class _Sequence:
+    def __init__(
+        self,
+        item: BatchInputItem,
+        max_output_tokens: int,
+        bbox_scale: int,
+        future: Future,
+    ):
+        self.item = item
+        self.max_output_tokens = max_output_tokens
+        self.bbox_scale = bbox_scale
+        self.future = future
+        self.tokens = []
+        self.position = 0  # Text position of the last token, the next one fed
+        self.rope_delta = 0  # Offset of its multimodal rope position
+        self.looping = False
+
+
+class HFEngine:
+    """Continuous batching for the HF backend.
+
+    Pages submitted from any thread queue up for one decode loop running in a
+    background thread. The loop steps the model one token at a time over a
+    shared KV cache, retires pages as soon as they finish and prefills queued
+    pages into the freed slots, so short pages never wait on long ones.
+    Decoding follows the model's generation config, greedy unless it samples.
+    """
+
+    def __init__(self, model, max_batch_size: int = settings.HF_ENGINE_SLOTS):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.queue = queue.Queue()
+        self.running: List[_Sequence] = []
+        self.cache = None
+        self.attention_mask = None
+        self.steps = 0
+        self.tokens = 0
+        self.busy_slots = 0  # Summed over steps, for occupancy
+        eos = model.generation_config.eos_token_id
+        self.eos_token_ids = set(eos if isinstance(eos, list) else [eos])
+        self._closed = False
+        self._thread = threading.Thread(
+            target=self._loop, name="chandra-hf-engine", daemon=True
+        )
+        self._thread.start()
+
+    def submit(
+        self,
+        item: BatchInputItem,
+        max_output_tokens: int | None = None,
+        bbox_scale: int = settings.BBOX_SCALE,
+    ) -> Future:
+        """Queues a page, returning a future for its GenerationResult."""
+        if self._closed:
+            raise RuntimeError("HFEngine is closed")
+        if max_output_tokens is None:
+            max_output_tokens = settings.MAX_OUTPUT_TOKENS
+        future = Future()
+        self.queue.put(_Sequence(item, max_output_tokens, bbox_scale, future))
+        return future
+
+    def generate(
+        self,
+        batch: List[BatchInputItem],
+        max_output_tokens: int | None = None,
+        bbox_scale: int = settings.BBOX_SCALE,
+        **kwargs,
+    ) -> List[GenerationResult]:
+        """Drop-in for generate_hf, sharing the engine with other callers."""
+        futures = [self.submit(item, max_output_tokens, bbox_scale) for item in batch]
+        return [future.result() for future in futures]
+
+    def close(self):
+        self._closed = True
+        self.queue.put(None)
+        self._thread.join()
+
+    @property
+    def occupancy(self) -> float:
+        """Mean share of the slots that held a page, over all decode steps."""
+        if not self.steps:
+            return 0.0
+        return self.busy_slots / (self.steps * self.max_batch_size)
+
+    def _loop(self):
+        while True:
+            try:
+                if not self._admit():
+                    break
+                if self.running:
+                    self._step()
+            except Exception as e:
+                # A failed decode step leaves the shared cache unusable, so
+                # every running page gets the error
+                _fail(self.running, e)
+                self._reset()
+        for seq in self.running:
+            seq.future.cancel()
+
+    def _reset(self):
+        self.running = []
+        self.cache = None
+        self.attention_mask = None
+
+    @torch.inference_mode()
+    def _admit(self) -> bool:
+        """Prefills queued pages into free slots, waiting for work when idle.
+        Returns False once the engine is closed."""
+        admitted = []
+        while len(self.running) + len(admitted) < self.max_batch_size:
+            try:
+                block = not self.running and not admitted
+                seq = self.queue.get(block=block)
+            except queue.Empty:
+                break
+            if seq is None:
+                return False
+            if seq.future.set_running_or_notify_cancel():
+                admitted.append(seq)
+        if not admitted:
+            return True
+
+        # Pages of similar size are prefilled together, as in generate_hf
+        groups = {}
+        for seq in admitted:
+            groups.setdefault(seq.bbox_scale, []).append(seq)
+        for group in groups.values():
+            try:
+                counts = [
+                    vision_token_count(seq.item, self.model.processor) for seq in group
+                ]
+                buckets = [
+                    [group[idx] for idx in idxs] for idxs in bucket_batch(counts)
+                ]
+            except Exception:
+                buckets = [[seq] for seq in group]
+            for bucket in buckets:
+                self._prefill_or_fail(bucket)
+        return True
+
+    def _prefill_or_fail(self, seqs: List[_Sequence]):
+        """Prefills `seqs`, failing only the pages that can't be prefilled
+        while the running pages keep decoding."""
+        try:
+            self._prefill(seqs)
+        except Exception as e:
+            if len(seqs) == 1:
+                _fail(seqs, e)
+                return
+            # Retry one by one, so a bad page doesn't fail its bucket
+            for seq in seqs:
+                self._prefill_or_fail([seq])
+
+    def _prefill(self, seqs: List[_Sequence]):
+        model = self.model
+        inputs = prepare_inputs([seq.item for seq in seqs], model, seqs[0].bbox_scale)
+        mask = inputs.attention_mask
+        # Explicit positions keep the model from holding rope deltas of its own
+        rope_positions, rope_deltas = model.model.get_rope_index(
+            inputs.input_ids,
+            mm_token_type_ids=inputs.mm_token_type_ids,
+            image_grid_thw=inputs.image_grid_thw,
+            attention_mask=mask,
+        )
+        text_positions = (mask.cumsum(-1) - 1).masked_fill(mask == 0, 0)
+        cache = DynamicCache(config=model.config)
+        outputs = model(
+            **inputs,
+            position_ids=torch.cat([text_positions[None], rope_positions]),
+            past_key_values=cache,
+            use_cache=True,
+            logits_to_keep=1,
+        )
+        next_tokens = self._next_tokens(outputs.logits[:, -1])
+
+        for seq, length, delta in zip(seqs, mask.sum(-1).tolist(), rope_deltas):
+            seq.position = length
+            seq.rope_delta = delta.item()
+        self._merge(seqs, cache, mask)
+        self._append(seqs, next_tokens)
+
+    def _merge(self, seqs: List[_Sequence], cache: DynamicCache, mask: torch.Tensor):
+        """Adds prefilled sequences to the running batch, left-padding
+        whichever side is shorter."""
+        if self.cache is None:
+            self.running, self.cache, self.attention_mask = list(seqs), cache, mask
+            return
+        length = max(self.attention_mask.shape[1], mask.shape[1])
+        for layer, new_layer in zip(self.cache.layers, cache.layers):
+            layer.keys = torch.cat(
+                [_left_pad(layer.keys, length), _left_pad(new_layer.keys, length)]
+            )
+            layer.values = torch.cat(
+                [_left_pad(layer.values, length), _left_pad(new_layer.values, length)]
+            )
+        self.attention_mask = torch.cat(
+            [
+                _left_pad(self.attention_mask, length, dim=1),
+                _left_pad(mask, length, dim=1),
+            ]
+        )
+        self.running.extend(seqs)
+
+    @torch.inference_mode()
+    def _step(self):
+        device = self.model.device
+        last_tokens = torch.tensor(
+            [[seq.tokens[-1]] for seq in self.running], device=device
+        )
+        text_positions = torch.tensor(
+            [[seq.position] for seq in self.running], device=device
+        )
+        rope_positions = text_positions + torch.tensor(
+            [[seq.rope_delta] for seq in self.running], device=device
+        )
+        self.attention_mask = torch.cat(
+            [self.attention_mask, self.attention_mask.new_ones(len(self.running), 1)],
+            dim=1,
+        )
+        outputs = self.model(
+            input_ids=last_tokens,
+            attention_mask=self.attention_mask,
+            position_ids=torch.stack(
+                [text_positions, rope_positions, rope_positions, rope_positions]
+            ),
+            past_key_values=self.cache,
+            use_cache=True,
+            logits_to_keep=1,
+        )
+        self.steps += 1
+        self.busy_slots += len(self.running)
+        for seq in self.running:
+            seq.position += 1
+        self._append(self.running, self._next_tokens(outputs.logits[:, -1]))
+
+    def _append(self, seqs: List[_Sequence], next_tokens: torch.Tensor):
+        """Records each sequence's next token, then retires finished ones."""
+        tokenizer = self.model.processor.tokenizer
+        check_every = settings.REPEAT_CHECK_TOKENS
+        for seq, token in zip(seqs, next_tokens.tolist()):
+            seq.tokens.append(token)
+            self.tokens += 1
+            if len(seq.tokens) % check_every == 0:
+                # Tokens are at least a character, so this covers the checked tail
+                tail = tokenizer.decode(
+                    seq.tokens[-repeat_check_chars() :], skip_special_tokens=True
+                )
+                seq.looping = has_repeat(tail)
+
+        keep = []
+        for idx, seq in enumerate(self.running):
+            if (
+                seq.tokens[-1] in self.eos_token_ids
+                or len(seq.tokens) >= seq.max_output_tokens
+                or seq.looping
+            ):
+                raw = tokenizer.decode(
+                    seq.tokens,
+                    skip_special_tokens=True,
+                    clean_up_tokenization_spaces=False,
+                )
+                seq.future.set_result(
+                    GenerationResult(raw=raw, token_count=len(seq.tokens), error=False)
+                )
+            else:
+                keep.append(idx)
+        if len(keep) == len(self.running):
+            return
+        if not keep:
+            self._reset()
+            return
+
+        self.running = [self.running[idx] for idx in keep]
+        indices = torch.tensor(keep, device=self.attention_mask.device)
+        self.cache.batch_select_indices(indices)
+        self.attention_mask = self.attention_mask[indices]
+        # Drop columns that are padding for every remaining sequence
+        start = self.attention_mask.any(dim=0).nonzero()[0].item()
+        if start:
+            self.attention_mask = self.attention_mask[:, start:]
+            for layer in self.cache.layers:
+                layer.keys = layer.keys[:, :, start:]
+                layer.values = layer.values[:, :, start:]
+
+    def _next_tokens(self, logits: torch.Tensor) -> torch.Tensor:
+        config = self.model.generation_config
+        if not config.do_sample:
+            return logits.argmax(dim=-1)
+        logits = logits.float() / (config.temperature or 1.0)
+        if config.top_k:
+            kth = logits.topk(min(config.top_k, logits.shape[-1])).values[:, -1:]
+            logits = logits.masked_fill(logits < kth, float("-inf"))
+        probs = logits.softmax(dim=-1)
+        if config.top_p is not None and config.top_p < 1.0:
+            sorted_probs, order = probs.sort(dim=-1, descending=True)
+            # Keep the smallest set of tokens whose mass reaches top_p
+            outside = sorted_probs.cumsum(dim=-1) - sorted_probs > config.top_p
+            sorted_probs = sorted_probs.masked_fill(outside, 0)
+            probs = torch.zeros_like(probs).scatter(-1, order, sorted_probs)
+        return torch.multinomial(probs, 1).squeeze(-1)
+
+
+def _fail(seqs: List[_Sequence], error: Exception):
+    for seq in seqs:
+        if not seq.future.done():
+            seq.future.set_exception(error)
+
+
+def _left_pad(tensor: torch.Tensor, length: int, dim: int = 2) -> torch.Tensor:
+    missing = length - tensor.shape[dim]
+    if not missing:
+        return tensor
+    shape = list(tensor.shape)
+    shape[dim] = missing
+    return torch.cat([tensor.new_zeros(shape), tensor], dim=dim)
@@ -0,0 +1,58 @@
+import math
+import threading
+from collections import deque
+
+from chandra.settings import settings
+
+
+class HedgePolicy:
+    """Decides when a slow request gets a duplicate, and keeps count.
+
+    A request is hedged once it has run longer than `percentile` of recently
+    completed requests, as long as hedges stay under `budget` of all requests.
+    No request is hedged until `min_samples` latencies have been seen.
+    """
+
+    def __init__(
+        self,
+        percentile: float = settings.VLLM_HEDGE_PERCENTILE,
+        budget: float = settings.VLLM_HEDGE_BUDGET,
+        min_samples: int = settings.VLLM_HEDGE_MIN_SAMPLES,
+        window: int = 500,
+    ):
+        self.percentile = percentile
+        self.budget = budget
+        self.min_samples = min_samples
+        self.latencies = deque(maxlen=window)
+        self.requests = 0
+        self.hedges = 0
+        self.wins = 0
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float):
+        with self._lock:
+            self.latencies.append(seconds)
+
+    def delay(self) -> float | None:
+        """Seconds to wait before hedging a new request, None to not hedge."""
+        with self._lock:
+            self.requests += 1
+            if not self.latencies or len(self.latencies) < self.min_samples:
+                return None
+            ordered = sorted(self.latencies)
+        rank = math.ceil(self.percentile / 100 * len(ordered)) - 1
+        return ordered[min(max(rank, 0), len(ordered) - 1)]
+
+    def try_hedge(self) -> bool:
+        with self._lock:
+            if self.hedges + 1 > self.budget * self.requests:
+                return False
+            self.hedges += 1
+            return True
+
+    def won(self):
+        with self._lock:
+            self.wins += 1
+
+
+hedge_policy = HedgePolicy()
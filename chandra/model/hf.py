@@ -1,14 +1,156 @@
-from typing import List
+import threading
+import time
+import warnings
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Iterator, List
 
-from qwen_vl_utils import process_vision_info
-from transformers import Qwen3VLForConditionalGeneration, Qwen3VLProcessor
+import torch
+from qwen_vl_utils import process_vision_info, smart_resize
+from transformers import (
+    BatchFeature,
+    Qwen3VLForConditionalGeneration,
+    Qwen3VLProcessor,
+    StoppingCriteria,
+    StoppingCriteriaList,
+)
 
 from chandra.model.schema import BatchInputItem, GenerationResult
-from chandra.model.util import scale_to_fit
+from chandra.model.util import fit_size, has_repeat, repeat_check_chars, scale_to_fit
 from chandra.prompts import PROMPT_MAPPING
 from chandra.settings import settings
 
 
+class PaddingStats:
+    """Running totals of prompt tokens in HF batches, and how many of them
+    were padding with and without resolution bucketing."""
+
+    def __init__(self):
+        self.tokens = 0
+        self.padding = 0
+        self.unbucketed_padding = 0  # Had the whole batch been padded together
+
+    def record(self, lengths: List[List[int]]):
+        """Prompt lengths of one batch, grouped by the sub-batch they ran in."""
+        flat = [length for group in lengths for length in group]
+        if not flat:
+            return
+        self.tokens += sum(flat)
+        self.padding += sum(len(group) * max(group) - sum(group) for group in lengths)
+        self.unbucketed_padding += len(flat) * max(flat) - sum(flat)
+
+    @property
+    def saved(self) -> int:
+        return self.unbucketed_padding - self.padding
+
+
+padding_stats = PaddingStats()
+
+
+def vision_token_count(item: BatchInputItem, processor) -> int:
+    """Vision tokens the processor will produce for the page, without
+    touching its pixels."""
+    width, height = fit_size(item.image.size)
+    # process_vision_info rounds to its default 14px patches merged 2x2
+    # before the image processor resizes again to its own
+    height, width = smart_resize(height, width, factor=28)
+    image_processor = processor.image_processor
+    patches = image_processor.get_number_of_image_patches(height, width, {})
+    return patches // image_processor.merge_size**2
+
+
+def bucket_batch(
+    token_counts: List[int], ratio: float = settings.HF_BUCKET_RATIO
+) -> List[List[int]]:
+    """Groups batch indices so that vision token counts within a group differ
+    by at most `ratio`. Groups run smallest first."""
+    buckets = []
+    for idx in sorted(range(len(token_counts)), key=lambda i: token_counts[i]):
+        if buckets and token_counts[idx] <= token_counts[buckets[-1][0]] * ratio:
+            buckets[-1].append(idx)
+        else:
+            buckets.append([idx])
+    return buckets
+
+
+class PipelineStats:
+    """Seconds spent in each stage of HF generation, to compare with the
+    wall time of pipelined runs."""
+
+    def __init__(self):
+        self.batches = 0
+        self.prepare = 0.0  # Resizing, chat template and the processor
+        self.generate = 0.0
+        self.decode = 0.0
+        self.wall = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, stage: str, seconds: float):
+        with self._lock:
+            setattr(self, stage, getattr(self, stage) + seconds)
+
+    @property
+    def overlap(self) -> float:
+        """Stage seconds hidden behind other stages."""
+        return max(self.prepare + self.generate + self.decode - self.wall, 0.0)
+
+
+pipeline_stats = PipelineStats()
+
+
+class BatchLimits:
+    """Sub-batch sizes that fit in memory, learned per resolution band and
+    output length from out-of-memory errors over the life of the process.
+
+    Until a band runs out of memory its batches are only capped at
+    `max_size`. After that, the cap probes halfway between the largest batch
+    that fit and the smallest that did not, converging on the largest that fits.
+    """
+
+    def __init__(self, max_size: int = settings.HF_AUTO_BATCH_MAX):
+        self.max_size = max_size
+        self.fits = {}  # Largest batch that generated
+        self.fails = {}  # Smallest batch that ran out of memory
+        self.ooms = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(vision_tokens: int, max_output_tokens: int):
+        # Bands double in vision tokens, as does the memory a page can need
+        return vision_tokens.bit_length(), max_output_tokens
+
+    def limit(self, key) -> int:
+        with self._lock:
+            failed = self.fails.get(key)
+            if failed is None:
+                return self.max_size
+            return max((self.fits.get(key, 0) + failed) // 2, 1)
+
+    def record(self, key, size: int, fitted: bool):
+        with self._lock:
+            if fitted:
+                self.fits[key] = max(self.fits.get(key, 0), size)
+            else:
+                self.ooms += 1
+                self.fails[key] = min(self.fails.get(key, size), size)
+
+    def learned(self) -> dict:
+        """Largest batch known to fit in each band that has run out of memory."""
+        with self._lock:
+            return {key: self.fits.get(key, 0) for key in self.fails}
+
+
+batch_limits = BatchLimits()
+
+
+def _timed(stage: str, fn, *args):
+    start = time.perf_counter()
+    try:
+        return fn(*args)
+    finally:
+        pipeline_stats.add(stage, time.perf_counter() - start)
+
+
 def generate_hf(
     batch: List[BatchInputItem],
     model,
@@ -16,11 +158,212 @@ def generate_hf(
     bbox_scale: int = settings.BBOX_SCALE,
     **kwargs,
 ) -> List[GenerationResult]:
+    """Generates in sub-batches of pages with similar resolution, so small
+    pages aren't padded to the size of the largest one. Results are in the
+    order of `batch`."""
+    if max_output_tokens is None:
+        max_output_tokens = settings.MAX_OUTPUT_TOKENS
+
+    start = time.perf_counter()
+    prepared = _timed("prepare", _prepare_batch, batch, model, bbox_scale)
+    generated = _timed("generate", _generate_batch, prepared, model, max_output_tokens)
+    results = _timed("decode", _decode_batch, generated, model, len(batch))
+    pipeline_stats.add("batches", 1)
+    pipeline_stats.add("wall", time.perf_counter() - start)
+    return results
+
+
+def generate_hf_pipelined(
+    batches: Iterable[List[BatchInputItem]],
+    model,
+    max_output_tokens=None,
+    bbox_scale: int = settings.BBOX_SCALE,
+    depth: int = settings.HF_PIPELINE_DEPTH,
+    **kwargs,
+) -> Iterator[List[GenerationResult]]:
+    """generate_hf over a stream of batches, yielding results batch by batch.
+
+    Each stage runs on its own thread, so batch N+1 is prepared and batch N-1
+    decoded while batch N generates. Up to `depth` batches are in flight;
+    a depth of 1 runs the stages back to back.
+    """
     if max_output_tokens is None:
         max_output_tokens = settings.MAX_OUTPUT_TOKENS
 
+    batches = iter(batches)
+    pools = [
+        ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"chandra-hf-{stage}")
+        for stage in ("prepare", "generate", "decode")
+    ]
+    prepare_pool, generate_pool, decode_pool = pools
+    in_flight = deque()
+
+    # Each stage waits on the one before it outside of its own timing
+    def _generate(prepared):
+        return _timed(
+            "generate", _generate_batch, prepared.result(), model, max_output_tokens
+        )
+
+    def _decode(generated, size):
+        return _timed("decode", _decode_batch, generated.result(), model, size)
+
+    start = time.perf_counter()
+    try:
+        while True:
+            while len(in_flight) < max(depth, 1):
+                batch = next(batches, None)
+                if batch is None:
+                    break
+                # Single worker pools keep every stage in batch order
+                prepared = prepare_pool.submit(
+                    _timed, "prepare", _prepare_batch, batch, model, bbox_scale
+                )
+                generated = generate_pool.submit(_generate, prepared)
+                in_flight.append(decode_pool.submit(_decode, generated, len(batch)))
+            if not in_flight:
+                break
+            results = in_flight.popleft().result()
+            pipeline_stats.add("batches", 1)
+            yield results
+    finally:
+        for pool in pools:
+            pool.shutdown(wait=True, cancel_futures=True)
+        pipeline_stats.add("wall", time.perf_counter() - start)
+
+
+def _prepare_batch(batch: List[BatchInputItem], model, bbox_scale: int):
+    """Model inputs for each resolution bucket of `batch`, with the batch
+    indices they cover."""
+    if settings.HF_BUCKET_PAGES:
+        buckets = bucket_batch(
+            [vision_token_count(item, model.processor) for item in batch]
+        )
+    else:
+        buckets = [list(range(len(batch)))] if batch else []
+
+    prepared = [
+        (idxs, prepare_inputs([batch[idx] for idx in idxs], model, bbox_scale))
+        for idxs in buckets
+    ]
+    padding_stats.record(
+        [inputs.attention_mask.sum(dim=1).tolist() for _, inputs in prepared]
+    )
+    return prepared
+
+
+def _generate_batch(prepared, model, max_output_tokens: int):
+    """Runs each bucket through generate, keeping only the new tokens."""
+    return [
+        (idxs, _generate_bucket(inputs, model, max_output_tokens))
+        for idxs, inputs in prepared
+    ]
+
+
+def _generate_bucket(inputs, model, max_output_tokens: int) -> List:
+    """Generates in sub-batches no larger than the bucket's learned limit,
+    halving any that run out of memory. A page that runs out of memory on
+    its own gets None instead of failing the batch."""
+    image_processor = model.processor.image_processor
+    vision_tokens = inputs.image_grid_thw.prod(dim=-1).max().item()
+    key = batch_limits.key(
+        vision_tokens // image_processor.merge_size**2, max_output_tokens
+    )
+
+    generated = []
+    pending = deque([inputs])
+    while pending:
+        chunk = pending.popleft()
+        size = chunk.input_ids.shape[0]
+        limit = batch_limits.limit(key)
+        if size > limit:
+            pending.extendleft(reversed(_split_inputs(chunk, limit)))
+            continue
+
+        try:
+            generated.extend(_generate_once(chunk, model, max_output_tokens))
+            batch_limits.record(key, size, fitted=True)
+            continue
+        except torch.OutOfMemoryError:
+            batch_limits.record(key, size, fitted=False)
+        # Outside the except block, so the error no longer holds the tensors
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        if size == 1:
+            print("Out of memory generating a single page, skipping it")
+            generated.append(None)
+        else:
+            half = min(limit, (size + 1) // 2)
+            pending.extendleft(reversed(_split_inputs(chunk, half)))
+    return generated
+
+
+def _generate_once(inputs, model, max_output_tokens: int) -> List:
+    stopping_criteria = StoppingCriteriaList(
+        [RepeatStoppingCriteria(model.processor.tokenizer, inputs.input_ids.shape[1])]
+    )
+    generated_ids = model.generate(
+        **inputs,
+        max_new_tokens=max_output_tokens,
+        stopping_criteria=stopping_criteria,
+    )
+    return [
+        out_ids[len(in_ids) :]
+        for in_ids, out_ids in zip(inputs.input_ids, generated_ids)
+    ]
+
+
+def _split_inputs(inputs, size: int) -> List[BatchFeature]:
+    """Processor outputs in chunks of at most `size` pages, without the
+    padding columns no page in a chunk needs. Assumes one image per page,
+    as process_batch_element builds."""
+    batch_size, length = inputs.input_ids.shape
+    # pixel_values holds every image's patches back to back
+    patch_ends = inputs.image_grid_thw.prod(dim=-1).cumsum(dim=0).tolist()
+    patch_starts = [0] + patch_ends[:-1]
+
+    chunks = []
+    for start in range(0, batch_size, size):
+        end = min(start + size, batch_size)
+        first = inputs.attention_mask[start:end].any(dim=0).nonzero()[0].item()
+        data = {}
+        for name, value in inputs.items():
+            if value.shape[:2] == (batch_size, length):
+                data[name] = value[start:end, first:]
+            elif name == "pixel_values":
+                data[name] = value[patch_starts[start] : patch_ends[end - 1]]
+            else:
+                data[name] = value[start:end]
+        chunks.append(BatchFeature(data))
+    return chunks
+
+
+def _decode_batch(generated, model, size: int) -> List[GenerationResult]:
+    """Decoded results, back in batch order."""
+    results = [None] * size
+    for idxs, generated_ids_trimmed in generated:
+        decoded = [
+            (idx, ids)
+            for idx, ids in zip(idxs, generated_ids_trimmed)
+            if ids is not None
+        ]
+        output_text = model.processor.batch_decode(
+            [ids for _, ids in decoded],
+            skip_special_tokens=True,
+            clean_up_tokenization_spaces=False,
+        )
+        for (idx, ids), out in zip(decoded, output_text):
+            results[idx] = GenerationResult(raw=out, token_count=len(ids), error=False)
+        for idx, ids in zip(idxs, generated_ids_trimmed):
+            if ids is None:
+                results[idx] = GenerationResult(raw="", token_count=0, error=True)
+    return results
+
+
+def prepare_inputs(batch: List[BatchInputItem], model, bbox_scale: int):
+    """Left-padded model inputs for `batch`, on the model's device."""
+    # One conversation per page, not one conversation of every page
     messages = [
-        process_batch_element(item, model.processor, bbox_scale) for item in batch
+        [process_batch_element(item, model.processor, bbox_scale)] for item in batch
     ]
     text = model.processor.apply_chat_template(
         messages, tokenize=False, add_generation_prompt=True
@@ -34,24 +377,42 @@ def generate_hf(
         return_tensors="pt",
         padding_side="left",
     )
-    inputs = inputs.to("cuda")
+    return inputs.to(model.device)
 
-    # Inference: Generation of the output
-    generated_ids = model.generate(**inputs, max_new_tokens=max_output_tokens)
-    generated_ids_trimmed = [
-        out_ids[len(in_ids) :]
-        for in_ids, out_ids in zip(inputs.input_ids, generated_ids)
-    ]
-    output_text = model.processor.batch_decode(
-        generated_ids_trimmed,
-        skip_special_tokens=True,
-        clean_up_tokenization_spaces=False,
-    )
-    results = [
-        GenerationResult(raw=out, token_count=len(ids), error=False)
-        for out, ids in zip(output_text, generated_ids_trimmed)
-    ]
-    return results
+
+class RepeatStoppingCriteria(StoppingCriteria):
+    """Stops sequences whose output has started looping, instead of letting
+    them decode up to max_new_tokens."""
+
+    def __init__(
+        self,
+        tokenizer,
+        prompt_length: int,
+        check_every: int = settings.REPEAT_CHECK_TOKENS,
+    ):
+        self.tokenizer = tokenizer
+        self.prompt_length = prompt_length
+        self.check_every = check_every
+        self.steps = 0
+        self.stopped = None
+
+    def __call__(self, input_ids: torch.LongTensor, scores, **kwargs):
+        if self.stopped is None:
+            self.stopped = torch.zeros(
+                input_ids.shape[0], dtype=torch.bool, device=input_ids.device
+            )
+        self.steps += 1
+        if self.steps % self.check_every == 0:
+            pending = (~self.stopped).nonzero().flatten().tolist()
+            # Tokens are at least a character, so this covers the checked tail
+            start = max(self.prompt_length, input_ids.shape[1] - repeat_check_chars())
+            texts = self.tokenizer.batch_decode(
+                input_ids[pending, start:], skip_special_tokens=True
+            )
+            for idx, text in zip(pending, texts):
+                if has_repeat(text):
+                    self.stopped[idx] = True
+        return self.stopped.clone()
 
 
 def process_batch_element(item: BatchInputItem, processor, bbox_scale: int):
@@ -70,7 +431,47 @@ def process_batch_element(item: BatchInputItem, processor, bbox_scale: int):
     return message
 
 
+def configure_cpu_threads(
+    num_threads: int | None = settings.TORCH_NUM_THREADS,
+    num_interop_threads: int | None = settings.TORCH_NUM_INTEROP_THREADS,
+):
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    if num_interop_threads:
+        try:
+            torch.set_num_interop_threads(num_interop_threads)
+        except RuntimeError as e:
+            # Only possible before torch runs its first parallel work
+            print(f"Could not set inter-op threads: {e}")
+
+
+def quantize_for_cpu(model):
+    """Dynamic int8 quantization of the model's linear layers, in place.
+
+    Weights are stored as int8 and activations quantized on the fly, which
+    cuts memory and speeds up the matmuls that dominate CPU decoding.
+    """
+    model = model.float()
+    with warnings.catch_warnings():
+        # torch points at torchao for new code, but dynamic eager quantization
+        # still works and needs no extra dependency
+        warnings.filterwarnings(
+            "ignore",
+            message=r"torch\.ao\.quantization is deprecated",
+            category=DeprecationWarning,
+        )
+        warnings.filterwarnings(
+            "ignore",
+            message=r"torch\.quantize_per_tensor, torch\.quantize_per_channel",
+            category=UserWarning,
+        )
+        return torch.ao.quantization.quantize_dynamic(
+            model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True
+        )
+
+
 def load_model():
+    configure_cpu_threads()
     device_map = "auto"
     if settings.TORCH_DEVICE:
         device_map = {"": settings.TORCH_DEVICE}
@@ -86,6 +487,8 @@ def load_model():
         settings.MODEL_CHECKPOINT, **kwargs
     )
     model = model.eval()
+    if settings.TORCH_DEVICE == "cpu" and settings.TORCH_CPU_QUANTIZE:
+        model = quantize_for_cpu(model)
     processor = Qwen3VLProcessor.from_pretrained(settings.MODEL_CHECKPOINT)
     model.processor = processor
     return model
@@ -0,0 +1,109 @@
+import math
+import time
+from collections import deque
+
+from chandra.settings import settings
+
+
+class AIMDLimit:
+    """Additive-increase, multiplicative-decrease concurrency limit for one
+    vLLM endpoint.
+
+    The limit grows by one per success until the first cut (slow start), then
+    by one per limit's worth of successes. It is cut by `backoff` on overload
+    errors or when time to first token rises past `tolerance` times its
+    baseline, which means requests are queueing inside vLLM. Requests already
+    in flight when the limit is cut can't trigger another cut. Large pages
+    take longer to prefill, so baselines are kept per band of prefill tokens,
+    each spanning a factor of sqrt(2). A band's baseline is its lowest
+    latency over the last one to two `baseline_window` samples.
+    """
+
+    def __init__(
+        self,
+        initial: int = settings.VLLM_INITIAL_CONCURRENCY,
+        max_limit: int = settings.VLLM_MAX_CONCURRENCY,
+        backoff: float = settings.VLLM_CONCURRENCY_BACKOFF,
+        tolerance: float = settings.VLLM_CONCURRENCY_LATENCY_TOLERANCE,
+        window: float = 10.0,
+        baseline_window: int = 256,
+    ):
+        self.limit = float(min(initial, max_limit))
+        self.max_limit = max_limit
+        self.backoff = backoff
+        self.tolerance = tolerance
+        self.window = window
+        self.baseline_window = baseline_window
+        self._minimums = {}  # Per band, for the current and previous window
+        self._samples = {}
+        self.slow_start = True
+        self.decreases = 0
+        self._grace = 0
+        self._completions = deque()
+
+    def __int__(self) -> int:
+        return max(1, int(self.limit))
+
+    def decrease(self, inflight: int):
+        if self._grace > 0:
+            return
+        self.limit = max(1.0, self.limit * self.backoff)
+        self.slow_start = False
+        self.decreases += 1
+        self._grace = inflight
+
+    def on_result(
+        self,
+        inflight: int,
+        overloaded: bool,
+        latency: float | None,
+        prefill_tokens: int = 0,
+    ):
+        """Update the limit after a request finishes. `inflight` counts the
+        requests still running on the endpoint, including this one, and
+        `prefill_tokens` estimates the prompt the latency was measured on."""
+        now = time.monotonic()
+        self._completions.append(now)
+        while self._completions[0] < now - self.window:
+            self._completions.popleft()
+
+        self._grace = max(0, self._grace - 1)
+        if overloaded:
+            self.decrease(inflight)
+            return
+
+        if latency is not None:
+            band = self.band(prefill_tokens)
+            self._add_sample(band, latency)
+            if latency > self.tolerance * self.baseline(band):
+                self.decrease(inflight)
+                return
+
+        # Only grow a limit that is actually being used
+        if 2 * inflight >= self.limit:
+            step = 1.0 if self.slow_start else 1.0 / self.limit
+            self.limit = min(self.max_limit, self.limit + step)
+
+    @staticmethod
+    def band(prefill_tokens: int) -> int:
+        return int(2 * math.log2(max(prefill_tokens, 1)))
+
+    def _add_sample(self, band: int, latency: float):
+        # Older minimums age out, so the baseline follows a server that slows down
+        minimums = self._minimums.setdefault(band, [math.inf, math.inf])
+        self._samples[band] = self._samples.get(band, 0) + 1
+        if self._samples[band] > self.baseline_window:
+            minimums[:] = [minimums[1], math.inf]
+            self._samples[band] = 1
+        minimums[1] = min(minimums[1], latency)
+
+    def baseline(self, band: int = 0) -> float:
+        return min(self._minimums.get(band, [math.inf]))
+
+    @property
+    def throughput(self) -> float:
+        """Completed requests per second over the last `window` seconds."""
+        if not self._completions:
+            return 0.0
+        elapsed = time.monotonic() - self._completions[0]
+        return len(self._completions) / max(elapsed, 1.0)
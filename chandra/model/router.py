@@ -0,0 +1,347 @@
+import asyncio
+import itertools
+import threading
+import time
+from typing import Dict, List, Sequence, Tuple
+
+import httpx
+
+from chandra.model.limiter import AIMDLimit
+from chandra.settings import settings
+
+ROUTING_POLICIES = ("least_tokens", "least_requests")
+
+
+class CircuitOpenError(RuntimeError):
+    """Raised instead of sending requests while every endpoint is failing."""
+
+    def __init__(self, retry_after: float = 0.0):
+        super().__init__("vLLM endpoints are failing, not sending")
+        self.retry_after = retry_after  # Seconds until a trial request may go
+
+
+def parse_endpoints(api_base: str | Sequence[str]) -> Tuple[str, ...]:
+    """Endpoints from a list, or from a comma-separated string."""
+    if isinstance(api_base, str):
+        api_base = api_base.split(",")
+    endpoints = tuple(url.strip().rstrip("/") for url in api_base if url.strip())
+    if not endpoints:
+        raise ValueError("No vLLM endpoints given")
+    return endpoints
+
+
+def prefill_tokens(image_size: Tuple[int, int]) -> int:
+    # Qwen3-VL spends one prefill token per 32x32 patch after scaling
+    max_width, max_height = settings.MODEL_MAX_IMAGE_SIZE
+    pixels = min(image_size[0] * image_size[1], max_width * max_height)
+    return pixels // (32 * 32)
+
+
+class Endpoint:
+    def __init__(self, url: str):
+        self.url = url
+        self.healthy = True
+        self.outstanding = 0
+        self.pending_tokens = 0
+        self.consecutive_failures = 0
+        self.last_used = 0
+        self.limit = AIMDLimit()
+        # Totals
+        self.requests = 0
+        self.errors = 0
+        self.tokens = 0
+        self.seconds = 0.0
+        self.ejections = 0
+
+    def stats(self) -> dict:
+        completed = self.requests - self.outstanding
+        return {
+            "url": self.url,
+            "healthy": self.healthy,
+            "requests": self.requests,
+            "errors": self.errors,
+            "outstanding": self.outstanding,
+            "pending_tokens": self.pending_tokens,
+            "tokens": self.tokens,
+            "mean_latency": self.seconds / completed if completed else 0.0,
+            "ejections": self.ejections,
+            "concurrency_limit": int(self.limit),
+            "throughput": self.limit.throughput,
+        }
+
+
+class Lease:
+    """One request's hold on an endpoint, from acquire until release."""
+
+    def __init__(self, endpoint: Endpoint, trial: bool = False):
+        self.endpoint = endpoint
+        self.trial = trial  # The single request let through an open circuit
+
+    @property
+    def url(self) -> str:
+        return self.endpoint.url
+
+
+class EndpointRouter:
+    """Spreads requests over vLLM replicas.
+
+    Requests go to the healthy replica with the fewest estimated pending
+    tokens (prefill plus expected decode) or the fewest outstanding requests.
+    Replicas are ejected after repeated request failures or a failed /models
+    probe, and re-admitted once a probe succeeds again. With `adaptive`, each
+    replica only gets as many requests at once as its AIMDLimit allows, and
+    acquire waits for a free slot.
+
+    When the last healthy replica keeps failing, the circuit opens: acquire
+    raises CircuitOpenError for `VLLM_CIRCUIT_COOLDOWN` seconds, then lets a
+    single trial request through, which closes the circuit if it succeeds.
+    Only the trial's own result opens or closes it again.
+    """
+
+    def __init__(
+        self,
+        urls: Sequence[str],
+        policy: str = settings.VLLM_ROUTING_POLICY,
+        api_key: str | None = None,
+        headers: dict | None = None,
+        adaptive: bool | None = None,
+    ):
+        if policy not in ROUTING_POLICIES:
+            raise ValueError(f"Unknown routing policy '{policy}'")
+        self.endpoints = [Endpoint(url) for url in urls]
+        self.policy = policy
+        if adaptive is None:
+            adaptive = settings.VLLM_ADAPTIVE_CONCURRENCY
+        self.adaptive = adaptive
+        self.api_key = settings.VLLM_API_KEY if api_key is None else api_key
+        self.headers = headers or {}
+        # Running estimate of completion length, used to price new requests
+        self.decode_estimate = settings.VLLM_ROUTING_DECODE_ESTIMATE
+        self._sequence = itertools.count(1)
+        self._lock = threading.Lock()
+        self._available = threading.Condition(self._lock)
+        self._async_waiters = []
+        # Monotonic time the open circuit allows a trial request again
+        self.circuit_open_until = None
+        self._trial_running = False
+        self._stop = threading.Event()
+        self._health_thread = None
+
+    def request_cost(self, image_size: Tuple[int, int], max_tokens: int) -> int:
+        return prefill_tokens(image_size) + min(max_tokens, int(self.decode_estimate))
+
+    def _load(self, endpoint: Endpoint) -> Tuple:
+        # Ties go to the endpoint used least recently
+        if self.policy == "least_tokens":
+            return endpoint.pending_tokens, endpoint.outstanding, endpoint.last_used
+        return endpoint.outstanding, endpoint.last_used
+
+    def _pick(self, cost: int, avoid: Sequence[str]) -> Lease | None:
+        if self.circuit_open_until is not None:
+            if self._trial_running or time.monotonic() < self.circuit_open_until:
+                raise CircuitOpenError(
+                    max(self.circuit_open_until - time.monotonic(), 0.0)
+                )
+
+        candidates = [
+            endpoint
+            for endpoint in self.endpoints
+            if endpoint.healthy and endpoint.url not in avoid
+        ]
+        if not candidates:
+            candidates = [e for e in self.endpoints if e.healthy]
+        if not candidates:
+            # Everything is down; keep trying rather than fail outright
+            candidates = self.endpoints
+        if self.adaptive:
+            candidates = [e for e in candidates if e.outstanding < int(e.limit)]
+            if not candidates:
+                return None
+
+        endpoint = min(candidates, key=self._load)
+        trial = self.circuit_open_until is not None
+        if trial:
+            self._trial_running = True
+        endpoint.outstanding += 1
+        endpoint.pending_tokens += cost
+        endpoint.requests += 1
+        endpoint.last_used = next(self._sequence)
+        return Lease(endpoint, trial)
+
+    def acquire(self, cost: int = 0, avoid: Sequence[str] = ()) -> Lease:
+        """Reserve the best endpoint for a request, preferring healthy ones
+        not listed in `avoid`. Every acquire must be paired with a release.
+        Raises CircuitOpenError while the circuit is open."""
+        with self._available:
+            while (endpoint := self._pick(cost, avoid)) is None:
+                self._available.wait()
+            return endpoint
+
+    async def acquire_async(self, cost: int = 0, avoid: Sequence[str] = ()) -> Lease:
+        """acquire for the event loop, waiting without blocking it."""
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._lock:
+                endpoint = self._pick(cost, avoid)
+                if endpoint is not None:
+                    return endpoint
+                waiter = loop.create_future()
+                self._async_waiters.append((loop, waiter))
+            await waiter
+
+    def _wake(self):
+        self._available.notify_all()
+        for loop, waiter in self._async_waiters:
+            loop.call_soon_threadsafe(_resolve, waiter)
+        self._async_waiters.clear()
+
+    def release(
+        self,
+        lease: Lease,
+        cost: int,
+        error: bool,
+        tokens: int = 0,
+        seconds: float = 0.0,
+        latency: float | None = None,
+        overloaded: bool = False,
+        prefill: int = 0,
+        cancelled: bool = False,
+    ):
+        """Return a request's slot. `error` marks a failure of the endpoint,
+        not a request it rightly rejected. `latency` is the time to first token,
+        if known, for a prompt of about `prefill` tokens, and `overloaded`
+        marks errors meaning the server is saturated. A `cancelled` request
+        counts as neither a success nor a failure."""
+        endpoint = lease.endpoint
+        with self._lock:
+            if lease.trial:
+                self._trial_running = False
+            if cancelled:
+                endpoint.outstanding -= 1
+                endpoint.pending_tokens -= cost
+                self._wake()
+                return
+            if self.adaptive:
+                endpoint.limit.on_result(
+                    endpoint.outstanding, overloaded, latency, prefill
+                )
+            endpoint.outstanding -= 1
+            endpoint.pending_tokens -= cost
+            endpoint.seconds += seconds
+            if error:
+                endpoint.errors += 1
+                endpoint.consecutive_failures += 1
+                # A failed trial opens the circuit again straight away
+                if lease.trial or (
+                    endpoint.healthy
+                    and endpoint.consecutive_failures
+                    >= settings.VLLM_EJECT_AFTER_FAILURES
+                ):
+                    self._eject(endpoint)
+            else:
+                endpoint.consecutive_failures = 0
+                if lease.trial:
+                    self._close_circuit()
+                if tokens:
+                    endpoint.tokens += tokens
+                    self.decode_estimate = 0.9 * self.decode_estimate + 0.1 * tokens
+            self._wake()
+
+    def _eject(self, endpoint: Endpoint):
+        # Only eject if another replica can take the traffic, otherwise stop
+        # sending for a while
+        if sum(e.healthy for e in self.endpoints) > 1:
+            endpoint.healthy = False
+            endpoint.ejections += 1
+            print(f"Ejecting vLLM endpoint {endpoint.url}")
+        else:
+            if self.circuit_open_until is None:
+                print("All vLLM endpoints are failing, opening the circuit")
+            self.circuit_open_until = time.monotonic() + settings.VLLM_CIRCUIT_COOLDOWN
+
+    def _close_circuit(self):
+        if self.circuit_open_until is not None:
+            print("vLLM endpoint recovered, closing the circuit")
+            self.circuit_open_until = None
+
+    def healthy_count(self, avoid: Sequence[str] = ()) -> int:
+        return sum(e.healthy and e.url not in avoid for e in self.endpoints)
+
+    def can_reroute(self, avoid: Sequence[str] = ()) -> bool:
+        """Whether a failed request can go straight to another endpoint."""
+        return self.circuit_open_until is None and self.healthy_count(avoid) > 0
+
+    def probe(self):
+        """Check every endpoint's /models once, updating its health."""
+        headers = {"Authorization": f"Bearer {self.api_key}", **self.headers}
+        for endpoint in self.endpoints:
+            try:
+                response = httpx.get(
+                    f"{endpoint.url}/models",
+                    headers=headers,
+                    timeout=settings.VLLM_HEALTH_CHECK_TIMEOUT,
+                )
+                ok = response.status_code == 200
+            except httpx.HTTPError:
+                ok = False
+
+            with self._lock:
+                if ok and not endpoint.healthy:
+                    print(f"Re-admitting vLLM endpoint {endpoint.url}")
+                    endpoint.healthy = True
+                    endpoint.consecutive_failures = 0
+                    self._close_circuit()
+                    self._wake()
+                elif not ok and endpoint.healthy:
+                    self._eject(endpoint)
+
+    def start_health_checks(
+        self, interval: float = settings.VLLM_HEALTH_CHECK_INTERVAL
+    ):
+        if self._health_thread is not None or len(self.endpoints) < 2:
+            return
+
+        def run():
+            while not self._stop.wait(interval):
+                self.probe()
+
+        self._health_thread = threading.Thread(target=run, daemon=True)
+        self._health_thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def stats(self) -> List[dict]:
+        with self._lock:
+            return [endpoint.stats() for endpoint in self.endpoints]
+
+
+def _resolve(waiter: asyncio.Future):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+_routers: Dict[Tuple, EndpointRouter] = {}
+_routers_lock = threading.Lock()
+
+
+def get_router(
+    api_base: str | Sequence[str], headers: dict | None = None
+) -> EndpointRouter:
+    """Shared router for a set of endpoints, with health checks running."""
+    endpoints = parse_endpoints(api_base)
+    key = (endpoints, tuple(sorted((headers or {}).items())))
+    with _routers_lock:
+        router = _routers.get(key)
+        if router is None:
+            router = EndpointRouter(endpoints, headers=headers)
+            router.start_health_checks()
+            _routers[key] = router
+    return router
+
+
+def clear_routers():
+    with _routers_lock:
+        for router in _routers.values():
+            router.stop()
+        _routers.clear()
@@ -9,6 +9,9 @@ class GenerationResult:
     raw: str
     token_count: int
     error: bool = False
+    skipped: bool = False
+    retryable: bool = True  # False for errors a retry can't fix
+    retry_after: float | None = None  # Seconds the server asked to wait
 
 
 @dataclass
@@ -16,6 +19,7 @@ class BatchInputItem:
     image: Image.Image
     prompt: str | None = None
     prompt_type: str | None = None
+    text_layer: List[dict] | None = None
 
 
 @dataclass
@@ -28,3 +32,6 @@ class BatchOutputItem:
     token_count: int
     images: dict
     error: bool
+    from_text_layer: bool = False
+    skipped: bool = False
+    deduplicated: bool = False
@@ -1,23 +1,38 @@
 import math
+import re
+from functools import lru_cache
+from html import unescape
 from typing import Tuple
 
+import numpy as np
 from PIL import Image
 
 from chandra.output import parse_markdown
+from chandra.settings import settings
 
 
 def scale_to_fit(
     img: Image.Image,
-    max_size: Tuple[int, int] = (3072, 2048),
+    max_size: Tuple[int, int] = settings.MODEL_MAX_IMAGE_SIZE,
     min_size: Tuple[int, int] = (28, 28),
 ):
-    resample_method = Image.Resampling.LANCZOS
+    new_size = fit_size(img.size, max_size, min_size)
+    if new_size == img.size:
+        return img
+    return img.resize(new_size, resample=Image.Resampling.LANCZOS)
 
-    width, height = img.size
+
+def fit_size(
+    size: Tuple[int, int],
+    max_size: Tuple[int, int] = settings.MODEL_MAX_IMAGE_SIZE,
+    min_size: Tuple[int, int] = (28, 28),
+) -> Tuple[int, int]:
+    """The (width, height) scale_to_fit resizes an image of `size` to."""
+    width, height = size
 
     # Check for empty or invalid image
     if width == 0 or height == 0:
-        return img
+        return size
 
     max_width, max_height = max_size
     min_width, min_height = min_size
@@ -37,9 +52,53 @@ def scale_to_fit(
         new_width = math.ceil(width * scale_factor)
         new_height = math.ceil(height * scale_factor)
     else:
-        return img
+        return size
+
+    return new_width, new_height
+
+
+def is_blank_page(
+    img: Image.Image,
+    sample_dim: int = settings.BLANK_PAGE_SAMPLE_DIM,
+    ink_delta: int = settings.BLANK_PAGE_INK_DELTA,
+    max_ink_ratio: float = settings.BLANK_PAGE_MAX_INK_RATIO,
+    max_std: float = settings.BLANK_PAGE_MAX_STD,
+) -> bool:
+    """Cheap check for blank or near-blank pages.
+
+    Ink is any pixel further than `ink_delta` from the paper colour, darker or
+    lighter, so light text on dark slides counts too. A nearest-neighbour
+    sample of at most `sample_dim` per side rules out most pages with content,
+    at a cost that does not depend on the page resolution. Pages it finds blank
+    are confirmed on a box-filtered grid of the same size, which sees every
+    pixel: they need both little ink and little variance across the grid, so
+    thin strokes the sample stepped over and low-contrast text still count.
+    """
+    width, height = img.size
+    if width == 0 or height == 0:
+        return True
+
+    scale = min(1.0, sample_dim / max(width, height))
+    sample_size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    sample = img.resize(sample_size, resample=Image.Resampling.NEAREST)
+    pixels = np.asarray(sample.convert("L"), dtype=np.int16)
+
+    # Ink is measured against the paper colour, so grey or yellowed scans still work
+    paper = np.median(pixels)
+    if (
+        np.count_nonzero(np.abs(pixels - paper) > ink_delta) / pixels.size
+        > max_ink_ratio
+    ):
+        return False
 
-    return img.resize((new_width, new_height), resample=resample_method)
+    # Box filtering averages scanner noise away but keeps anything on the page:
+    # a one pixel stroke still moves its cell by about ink_delta / factor
+    factor = max(1, math.ceil(max(width, height) / sample_dim))
+    cells = np.asarray(img.reduce(factor).convert("L"), dtype=np.int16)
+    if cells.std() > max_std:
+        return False
+    ink = np.abs(cells - paper) > ink_delta / factor
+    return np.count_nonzero(ink) / cells.size <= max_ink_ratio
 
 
 def detect_repeat_token(
@@ -82,3 +141,226 @@ def detect_repeat_token(
             return True
 
     return False
+
+
+# How parse_markdown renders markup, closely enough to count repeats the same
+# way. Tables are kept as HTML in markdown, so their tags are kept here too.
+_TAG = re.compile(r"<(/?)([a-zA-Z][a-zA-Z0-9]*)\b[^>]*>?")
+_BLOCK_TAGS = {"p", "div", "br", "hr", "ul", "ol", "pre", "caption"}
+_KEPT_TAGS = {"table", "thead", "tbody", "tr", "th", "td", "sub", "sup"}
+_INLINE_MARKERS = {
+    "b": "**",
+    "strong": "**",
+    "i": "*",
+    "em": "*",
+    "code": "`",
+    "s": "~~",
+    "del": "~~",
+    "strike": "~~",
+    "math": "$",
+}
+_HREF = re.compile(r"""href=["']?([^"'\s>]*)""", re.I)
+_ESCAPED = re.compile(r"([*_$])")
+_LINE_BREAK = "\x00"
+_WHITESPACE = re.compile(r"[\s\x00]+")
+
+
+def strip_markup(text: str) -> str:
+    """Cheap stand-in for parse_markdown when looking for repetition.
+
+    Emits the markers parse_markdown would for emphasis, code, math, links,
+    list items, headings and quotes, and escapes text the same way, so repeats
+    are counted over the same characters.
+    """
+    pieces = []
+    lists = []  # Item counter per open list, None for bullets
+    links = []
+    in_math = False
+    position = 0
+    for match in _TAG.finditer(text):
+        segment = unescape(text[position : match.start()])
+        pieces.append(segment if in_math else _ESCAPED.sub(r"\\\1", segment))
+        position = match.end()
+
+        closing, name = match.group(1), match.group(2).lower()
+        if name in _KEPT_TAGS:
+            pieces.append(match.group())
+        elif name in _INLINE_MARKERS:
+            pieces.append(_INLINE_MARKERS[name])
+            if name == "math":
+                in_math = not closing
+        elif name == "a":
+            # Links become [text](href)
+            if closing:
+                pieces.append(f"]({links.pop()})" if links else "")
+            else:
+                href = _HREF.search(match.group())
+                links.append(href.group(1) if href else "")
+                pieces.append("[")
+        elif name in ("ul", "ol"):
+            pieces.append("\n")
+            if closing and lists:
+                lists.pop()
+            elif not closing:
+                lists.append(0 if name == "ol" else None)
+        elif name == "li" and not closing:
+            # Items are a line apart, not a paragraph
+            pieces.append(_LINE_BREAK)
+            if lists and lists[-1] is not None:
+                lists[-1] += 1
+                pieces.append(f"{lists[-1]}. ")
+            else:
+                pieces.append("- ")
+        elif name in ("h1", "h2", "h3", "h4", "h5", "h6"):
+            pieces.append("\n" if closing else "\n" + "#" * int(name[1]) + " ")
+        elif name == "blockquote":
+            pieces.append("\n" if closing else "\n> ")
+        elif name in _BLOCK_TAGS:
+            pieces.append("\n")
+    segment = unescape(text[position:])
+    pieces.append(segment if in_math else _ESCAPED.sub(r"\\\1", segment))
+
+    return _WHITESPACE.sub(_collapse, "".join(pieces))
+
+
+def _collapse(match: re.Match) -> str:
+    if "\n" in match.group():
+        return "\n\n"
+    return "\n" if _LINE_BREAK in match.group() else " "
+
+
+@lru_cache
+def _repeat_tail_chars(
+    base_max_repeats: int, window_size: int, scaling_factor: float
+) -> int:
+    # Longest tail that can hold more than max_repeats copies of any sequence
+    return max(
+        (int(base_max_repeats * (1 + scaling_factor / seq_len)) + 1) * seq_len
+        for seq_len in range(1, window_size // 2 + 1)
+    )
+
+
+def _z_function(s: str) -> list:
+    z = [0] * len(s)
+    left = right = 0
+    for i in range(1, len(s)):
+        if i < right:
+            z[i] = min(right - i, z[i - left])
+        while i + z[i] < len(s) and s[z[i]] == s[i + z[i]]:
+            z[i] += 1
+        if i + z[i] > right:
+            left, right = i, i + z[i]
+    return z
+
+
+def detect_repeat_raw(
+    text: str,
+    base_max_repeats: int = 4,
+    window_size: int = 500,
+    cut_from_end: int = 0,
+    scaling_factor: float = 3.0,
+) -> bool:
+    """Same check as detect_repeat_token, in linear time on raw model output.
+
+    Markup is stripped with a regex instead of parsing the markdown. A suffix
+    holding k copies of a sequence of length L is a suffix of length k * L
+    with period L, so one Z-function pass over the reversed tail gives the
+    repeat count for every L. Only a bounded tail is ever looked at.
+    """
+    tail_chars = _repeat_tail_chars(base_max_repeats, window_size, scaling_factor)
+    # Markup shrinks when stripped, so take a generous slice of the raw text
+    raw_tail = text[-(tail_chars + cut_from_end) * 8 :]
+    if len(raw_tail) < len(text):
+        # Drop a tag cut in half at the start of the slice
+        close, open_ = raw_tail.find(">"), raw_tail.find("<")
+        if close != -1 and (open_ == -1 or close < open_):
+            raw_tail = raw_tail[close + 1 :]
+
+    stripped = strip_markup(raw_tail).strip()
+    if cut_from_end > 0:
+        stripped = stripped[:-cut_from_end]
+    tail = stripped[-tail_chars:][::-1]
+    if not tail:
+        return False
+
+    # z[L] is how far the text keeps repeating with period L, back from the end
+    z = _z_function(tail)
+    for seq_len in range(1, min(window_size // 2, len(tail)) + 1):
+        run = z[seq_len] if seq_len < len(tail) else 0
+        repeat_count = (seq_len + run) // seq_len
+        max_repeats = int(base_max_repeats * (1 + scaling_factor / seq_len))
+        if repeat_count > max_repeats:
+            return True
+    return False
+
+
+def has_repeat(text: str) -> bool:
+    """Repeat check applied to every generation, also looking past a truncated tail."""
+    return detect_repeat_raw(text) or (
+        len(text) > 50 and detect_repeat_raw(text, cut_from_end=50)
+    )
+
+
+_DIV_TAG = re.compile(r"<(/?)div\b[^>]*>", re.I)
+
+
+def block_ends(raw: str) -> list:
+    """Offsets just past each complete top-level <div> block."""
+    ends, depth = [], 0
+    for match in _DIV_TAG.finditer(raw):
+        if match.group(1):
+            depth -= 1
+            if depth == 0:
+                ends.append(match.end())
+            depth = max(depth, 0)
+        else:
+            depth += 1
+    return ends
+
+
+def repeat_free_prefix(raw: str) -> str:
+    """Longest run of complete layout blocks from the start of `raw` that has
+    no repetition at its end, or "" if there is none."""
+    for end in reversed(block_ends(raw)):
+        if not has_repeat(raw[:end]):
+            return raw[:end]
+    return ""
+
+
+def repeat_check_chars() -> int:
+    """Raw characters has_repeat can look at, at most."""
+    return (_repeat_tail_chars(4, 500, 3.0) + 50) * 8
+
+
+class RepeatMonitor:
+    """Runs the repeat check on a streamed generation every `check_every` characters.
+
+    Each check only joins the last few chunks, so the cost per check stays
+    constant however long the generation gets.
+    """
+
+    def __init__(self, check_every: int = settings.REPEAT_CHECK_CHARS):
+        self.check_every = check_every
+        self.parts = []
+        self.length = 0
+        self.repeating = False
+        self._next_check = check_every
+
+    @property
+    def text(self) -> str:
+        return "".join(self.parts)
+
+    def tail(self, chars: int) -> str:
+        size, start = 0, len(self.parts)
+        while start > 0 and size < chars:
+            start -= 1
+            size += len(self.parts[start])
+        return "".join(self.parts[start:])
+
+    def feed(self, delta: str) -> bool:
+        self.parts.append(delta)
+        self.length += len(delta)
+        if self.length >= self._next_check:
+            self._next_check = self.length + self.check_every
+            self.repeating = has_repeat(self.tail(repeat_check_chars()))
+        return self.repeating
@@ -1,26 +1,539 @@
+import asyncio
 import base64
+import email.utils
 import io
+import math
+import random
+import threading
 import time
-from concurrent.futures import ThreadPoolExecutor
-from itertools import repeat
-from typing import List
+import weakref
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from itertools import chain, repeat
+from typing import Awaitable, Callable, Dict, List, Sequence, Tuple
 
+import httpx
 from PIL import Image
-from openai import OpenAI
+from openai import (
+    DEFAULT_MAX_RETRIES,
+    APIConnectionError,
+    APIStatusError,
+    APITimeoutError,
+    AsyncOpenAI,
+    DefaultAsyncHttpxClient,
+    DefaultHttpxClient,
+    OpenAI,
+)
 
+from chandra.model.hedging import hedge_policy
+from chandra.model.router import CircuitOpenError, get_router, prefill_tokens
 from chandra.model.schema import BatchInputItem, GenerationResult
-from chandra.model.util import scale_to_fit, detect_repeat_token
+from chandra.model.util import (
+    RepeatMonitor,
+    has_repeat,
+    repeat_free_prefix,
+    scale_to_fit,
+)
 from chandra.prompts import PROMPT_MAPPING
 from chandra.settings import settings
 
 
-def image_to_base64(image: Image.Image) -> str:
+IMAGE_CODECS = ("png", "webp", "jpeg")
+
+
+def _codec_options(codec: str) -> Tuple[str, dict]:
+    if codec == "png":
+        return "PNG", {"compress_level": settings.VLLM_PNG_COMPRESS_LEVEL}
+    if codec == "webp":
+        return "WEBP", {"lossless": True, "method": settings.VLLM_WEBP_METHOD}
+    if codec == "jpeg":
+        return "JPEG", {"quality": settings.VLLM_JPEG_QUALITY, "subsampling": 0}
+    raise ValueError(f"Unknown image codec '{codec}', use one of {IMAGE_CODECS}")
+
+
+def image_to_base64(image: Image.Image, codec: str = "png") -> str:
     """Convert PIL Image to base64 string."""
+    image_format, options = _codec_options(codec)
     buffered = io.BytesIO()
-    image.save(buffered, format="PNG")
+    image.save(buffered, format=image_format, **options)
     return base64.b64encode(buffered.getvalue()).decode()
 
 
+def image_to_data_url(image: Image.Image, codec: str | None = None) -> str:
+    if codec is None:
+        codec = settings.VLLM_IMAGE_CODEC
+    return f"data:image/{codec};base64,{image_to_base64(image, codec)}"
+
+
+def encode_page(item: BatchInputItem, codec: str | None = None) -> str:
+    return image_to_data_url(scale_to_fit(item.image), codec)
+
+
+def encode_batch_images(
+    batch: List[BatchInputItem], executor: ThreadPoolExecutor, codec: str | None
+) -> List[Future]:
+    """Start encoding every page up front; Pillow releases the GIL while encoding."""
+    return [executor.submit(encode_page, item, codec) for item in batch]
+
+
+# Long-lived clients keyed by (api_base, api_key, headers), so connections are
+# kept alive across generate_vllm calls. OpenAI clients are thread-safe.
+_clients: Dict[Tuple, Tuple[OpenAI, int]] = {}
+_model_names: Dict[Tuple, str] = {}
+_async_clients: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+_clients_lock = threading.Lock()
+
+
+def _client_key(api_base: str, api_key: str, headers: dict | None, *extra) -> Tuple:
+    return api_base, api_key, tuple(sorted((headers or {}).items())), *extra
+
+
+def _close_async_pool(loop_ref: weakref.ref, close: Callable[[], Awaitable]):
+    # Async connections can only be closed on the loop that opened them. A
+    # loop that is gone or stopped leaves its sockets to be closed on collection
+    loop = loop_ref()
+    if loop is not None and loop.is_running():
+        asyncio.run_coroutine_threadsafe(close(), loop)
+
+
+def request_timeout(stream: bool = True) -> httpx.Timeout:
+    """Streams time out on a stalled chunk; a non-streamed completion sends
+    nothing until it's done, so it gets the whole-request timeout."""
+    read = settings.VLLM_READ_TIMEOUT if stream else settings.VLLM_REQUEST_TIMEOUT
+    return httpx.Timeout(read, connect=settings.VLLM_CONNECT_TIMEOUT)
+
+
+def get_client(
+    api_base: str,
+    api_key: str | None = None,
+    headers: dict | None = None,
+    pool_size: int | None = None,
+    max_retries: int = DEFAULT_MAX_RETRIES,
+) -> OpenAI:
+    """Shared client whose keep-alive pool holds at least `pool_size` connections.
+
+    `max_retries` is the SDK's own retrying on the same endpoint.
+    """
+    if api_key is None:
+        api_key = settings.VLLM_API_KEY
+    if pool_size is None:
+        pool_size = settings.VLLM_POOL_SIZE
+    key = _client_key(api_base, api_key, headers, max_retries)
+
+    with _clients_lock:
+        client, client_pool_size = _clients.get(key, (None, 0))
+        if client is None or client_pool_size < pool_size:
+            # Growing the pool replaces the client. Requests already in flight
+            # keep the old one alive until they finish, then its pool is closed
+            http_client = DefaultHttpxClient(
+                limits=httpx.Limits(
+                    max_connections=pool_size,
+                    max_keepalive_connections=pool_size,
+                )
+            )
+            client = OpenAI(
+                api_key=api_key,
+                base_url=api_base,
+                default_headers=headers,
+                max_retries=max_retries,
+                timeout=request_timeout(),
+                http_client=http_client,
+            )
+            weakref.finalize(client, http_client.close)
+            _clients[key] = (client, pool_size)
+    return client
+
+
+def get_model_name(
+    client: OpenAI, api_base: str, api_key: str | None = None, headers=None
+) -> str:
+    """First model served at `api_base`, looked up once per process."""
+    if api_key is None:
+        api_key = settings.VLLM_API_KEY
+    key = _client_key(api_base, api_key, headers)
+    model_name = _model_names.get(key)
+    if model_name is None:
+        model_name = client.models.list().data[0].id
+        with _clients_lock:
+            _model_names[key] = model_name
+    return model_name
+
+
+def get_async_clients(
+    api_base: str,
+    api_key: str | None = None,
+    headers: dict | None = None,
+    pool_size: int | None = None,
+    max_retries: int = DEFAULT_MAX_RETRIES,
+) -> List[AsyncOpenAI]:
+    """Async counterpart of get_client.
+
+    httpcore's async pool scans every connection each time a request is
+    scheduled, which gets slow with hundreds of connections, so large pools
+    are split across several clients of VLLM_ASYNC_POOL_SHARD_SIZE. Async
+    connections belong to the event loop that opened them, so clients are
+    shared per running loop.
+    """
+    if api_key is None:
+        api_key = settings.VLLM_API_KEY
+    if pool_size is None:
+        pool_size = settings.VLLM_POOL_SIZE
+    key = _client_key(api_base, api_key, headers, max_retries)
+    loop = asyncio.get_running_loop()
+    shard_size = min(pool_size, settings.VLLM_ASYNC_POOL_SHARD_SIZE)
+    num_shards = math.ceil(pool_size / shard_size)
+
+    with _clients_lock:
+        loop_clients = _async_clients.setdefault(loop, {})
+        clients = loop_clients.get(key, [])
+        if len(clients) < num_shards:
+            clients = []
+            for _ in range(num_shards):
+                http_client = DefaultAsyncHttpxClient(
+                    limits=httpx.Limits(
+                        max_connections=shard_size,
+                        max_keepalive_connections=shard_size,
+                    )
+                )
+                client = AsyncOpenAI(
+                    api_key=api_key,
+                    base_url=api_base,
+                    default_headers=headers,
+                    max_retries=max_retries,
+                    timeout=request_timeout(),
+                    http_client=http_client,
+                )
+                # Replaced or left behind by their loop, clients close their
+                # pool on that loop once requests in flight let go of them
+                weakref.finalize(
+                    client, _close_async_pool, weakref.ref(loop), http_client.aclose
+                )
+                clients.append(client)
+            loop_clients[key] = clients
+    return clients
+
+
+def clear_clients():
+    with _clients_lock:
+        for client, _ in _clients.values():
+            client.close()
+        _clients.clear()
+        for loop, loop_clients in list(_async_clients.items()):
+            for client in chain.from_iterable(loop_clients.values()):
+                _close_async_pool(weakref.ref(loop), client.close)
+        _async_clients.clear()
+        _model_names.clear()
+
+
+def build_messages(item: BatchInputItem, image_url: str, bbox_scale: int) -> list:
+    prompt = item.prompt
+    if not prompt:
+        prompt = PROMPT_MAPPING[item.prompt_type].replace(
+            "{bbox_scale}", str(bbox_scale)
+        )
+
+    content = []
+    content.append(
+        {
+            "type": "image_url",
+            "image_url": {"url": image_url},
+        }
+    )
+
+    content.append({"type": "text", "text": prompt})
+    return [{"role": "user", "content": content}]
+
+
+STREAM_ARGS = {"stream": True, "stream_options": {"include_usage": True}}
+# vLLM extension: extend the trailing assistant message instead of starting a new one
+CONTINUE_ARGS = {"continue_final_message": True, "add_generation_prompt": False}
+
+
+@dataclass
+class Continuation:
+    """Repeat-free start of a looping output, to resume generation from."""
+
+    prefix: str
+    token_count: int
+
+
+def get_continuation(
+    result: GenerationResult, max_output_tokens: int
+) -> Continuation | None:
+    if not settings.VLLM_CONTINUE_ON_REPEAT or result.error or not result.raw:
+        return None
+    prefix = repeat_free_prefix(result.raw)
+    if not prefix:
+        return None
+    # Token counts are only known for the whole output, so split by length
+    token_count = round(result.token_count * len(prefix) / len(result.raw))
+    if token_count >= max_output_tokens:
+        return None
+    return Continuation(prefix=prefix, token_count=token_count)
+
+
+def remaining_tokens(
+    max_output_tokens: int, continuation: Continuation | None = None
+) -> int:
+    if continuation is None:
+        return max_output_tokens
+    return max_output_tokens - continuation.token_count
+
+
+def build_request(
+    item: BatchInputItem,
+    image_url: str,
+    bbox_scale: int,
+    max_output_tokens: int,
+    temperature: float,
+    top_p: float,
+    continuation: Continuation | None = None,
+    seed: int | None = None,
+) -> dict:
+    """Chat completion arguments, less the model, which depends on the endpoint."""
+    messages = build_messages(item, image_url, bbox_scale)
+    request = dict(
+        messages=messages,
+        max_tokens=max_output_tokens,
+        temperature=temperature,
+        top_p=top_p,
+    )
+    if seed is not None:
+        request["seed"] = seed
+    if continuation is not None:
+        messages.append({"role": "assistant", "content": continuation.prefix})
+        request["max_tokens"] = remaining_tokens(max_output_tokens, continuation)
+        request["extra_body"] = CONTINUE_ARGS
+    if settings.VLLM_STREAM:
+        request.update(STREAM_ARGS)
+    request["timeout"] = request_timeout(settings.VLLM_STREAM)
+    return request
+
+
+def completion_result(
+    completion, continuation: Continuation | None = None
+) -> GenerationResult:
+    raw = completion.choices[0].message.content
+    token_count = completion.usage.completion_tokens
+    if continuation is not None:
+        raw = continuation.prefix + raw
+        token_count += continuation.token_count
+    return GenerationResult(raw=raw, token_count=token_count, error=False)
+
+
+class StreamedCompletion:
+    """Collects a streamed completion, watching it for repetition."""
+
+    def __init__(self, continuation: Continuation | None = None):
+        self.monitor = RepeatMonitor()
+        self.chunks = 0
+        self.token_count = None
+        self.prefix_tokens = 0
+        self.first_token_at = None
+        if continuation is not None:
+            # Loops can straddle the point generation resumed from
+            self.monitor.feed(continuation.prefix)
+            self.prefix_tokens = continuation.token_count
+
+    def add(self, chunk) -> bool:
+        """Returns True once the output loops and the stream should be dropped."""
+        if chunk.usage is not None:
+            self.token_count = chunk.usage.completion_tokens
+        if not chunk.choices or not chunk.choices[0].delta.content:
+            return False
+        if self.first_token_at is None:
+            self.first_token_at = time.perf_counter()
+        self.chunks += 1
+        return self.monitor.feed(chunk.choices[0].delta.content)
+
+    def result(self) -> GenerationResult:
+        # Usage only arrives with the last chunk; vLLM streams about one token per chunk
+        token_count = self.token_count
+        if token_count is None:
+            token_count = self.chunks
+        return GenerationResult(
+            raw=self.monitor.text,
+            token_count=self.prefix_tokens + token_count,
+            error=False,
+        )
+
+
+@dataclass
+class RequestError:
+    retryable: bool = True
+    overloaded: bool = False  # The server is saturated, so send less
+    endpoint_failed: bool = True  # Counts toward ejecting the endpoint
+    retry_after: float | None = None
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    """Seconds from a Retry-After header, given as seconds or an HTTP date."""
+    if not value:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            date = email.utils.parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        if date.tzinfo is None:
+            date = date.replace(tzinfo=timezone.utc)
+        seconds = (date - datetime.now(timezone.utc)).total_seconds()
+    return min(max(seconds, 0.0), settings.VLLM_RETRY_AFTER_MAX)
+
+
+def classify_error(error: Exception) -> RequestError:
+    """Tell transient failures from requests a retry can't fix, such as a
+    page over the context length or a bad page on our side."""
+    if isinstance(error, (APITimeoutError, TimeoutError)):
+        return RequestError(overloaded=True)
+    if isinstance(error, APIConnectionError):
+        return RequestError()
+    if isinstance(error, APIStatusError):
+        status = error.status_code
+        if status in (429, 503):
+            return RequestError(
+                overloaded=True,
+                endpoint_failed=status == 503,
+                retry_after=parse_retry_after(
+                    error.response.headers.get("retry-after")
+                ),
+            )
+        if status >= 500:
+            return RequestError(overloaded=True)
+        if status in (408, 409):
+            return RequestError(endpoint_failed=False)
+        return RequestError(retryable=False, endpoint_failed=False)
+    if isinstance(error, httpx.TransportError):
+        return RequestError()
+    # Anything else went wrong on our side, so it says nothing about the endpoint
+    return RequestError(retryable=False, endpoint_failed=False)
+
+
+def error_result(failure: RequestError | None = None) -> GenerationResult:
+    """Result for a failed request; without `failure`, one that never ran
+    because the batch was cancelled or the circuit is open."""
+    if failure is None:
+        return GenerationResult(raw="", token_count=0, error=True, retryable=False)
+    return GenerationResult(
+        raw="",
+        token_count=0,
+        error=True,
+        retryable=failure.retryable,
+        retry_after=failure.retry_after,
+    )
+
+
+def first_token_latency(
+    streamed: StreamedCompletion, start: float, continuation: Continuation | None
+) -> float | None:
+    # Continuations prefill their prefix too, so their latency isn't comparable
+    if continuation is not None or streamed.first_token_at is None:
+        return None
+    return streamed.first_token_at - start
+
+
+class SpeculationStats:
+    """Running totals for speculative retries, to weigh the extra tokens they
+    spend against the time they save."""
+
+    def __init__(self):
+        self.races = 0
+        self.candidates = 0
+        self.extra_tokens = 0
+        self.race_seconds = 0.0
+        # Estimate of running the same candidates one at a time, in order,
+        # until the first clean one, from their durations in the race
+        self.serial_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def record(
+        self,
+        candidates: list,
+        winner_idx: int | None,
+        race_seconds: float,
+        continuation: Continuation | None = None,
+    ):
+        """`candidates` holds (result, seconds) in schedule order."""
+        last_idx = len(candidates) - 1 if winner_idx is None else winner_idx
+        prefix_tokens = continuation.token_count if continuation else 0
+        with self._lock:
+            self.races += 1
+            self.candidates += len(candidates)
+            self.extra_tokens += sum(
+                max(result.token_count - prefix_tokens, 0)
+                for idx, (result, _) in enumerate(candidates)
+                if idx != winner_idx
+            )
+            self.race_seconds += race_seconds
+            self.serial_seconds += sum(
+                seconds for result, seconds in candidates[: last_idx + 1]
+            )
+
+    @property
+    def seconds_saved(self) -> float:
+        return self.serial_seconds - self.race_seconds
+
+
+speculation_stats = SpeculationStats()
+
+
+def speculative_race_size(
+    result: GenerationResult, retries: int, max_retries: int
+) -> int:
+    """How many sampled retries to race for `result`, 0 to retry serially."""
+    if result.error or settings.VLLM_SPECULATIVE_RETRIES < 2:
+        return 0
+    return min(settings.VLLM_SPECULATIVE_RETRIES, max_retries - retries)
+
+
+def speculative_schedule(count: int, retries: int) -> List[Tuple[float, int]]:
+    """(temperature, seed) per candidate; seeds move on with every race."""
+    temperatures = settings.VLLM_SPECULATIVE_TEMPERATURES
+    return [
+        (temperatures[idx % len(temperatures)], retries + idx) for idx in range(count)
+    ]
+
+
+def is_clean(result: GenerationResult) -> bool:
+    return not result.error and not has_repeat(result.raw)
+
+
+def backoff_delay(retries: int, retry_after: float | None = None) -> float:
+    """Exponential backoff with full jitter, so clients that failed together
+    don't come back together. A server's Retry-After is honoured first."""
+    if retry_after is not None:
+        return retry_after + random.uniform(0, settings.VLLM_RETRY_BACKOFF)
+    cap = settings.VLLM_RETRY_BACKOFF * 2**retries
+    return random.uniform(0, min(cap, settings.VLLM_RETRY_BACKOFF_MAX))
+
+
+def retry_delay(
+    result: GenerationResult,
+    retries: int,
+    max_retries: int,
+    max_failure_retries: int | None = None,
+) -> float | None:
+    """Seconds to wait before retrying `result`, or None if it should be kept."""
+    if retries < max_retries and has_repeat(result.raw):
+        print(f"Detected repeat token, retrying generation (attempt {retries + 1})...")
+        return 0
+
+    if not (result.error and result.retryable):
+        return None
+
+    if retries < max_retries or (
+        max_failure_retries is not None and retries < max_failure_retries
+    ):
+        print(f"Detected vllm error, retrying generation (attempt {retries + 1})...")
+        return backoff_delay(retries, result.retry_after)
+
+    return None
+
+
 def generate_vllm(
     batch: List[BatchInputItem],
     max_output_tokens: int = None,
@@ -29,115 +542,592 @@ def generate_vllm(
     custom_headers: dict | None = None,
     max_failure_retries: int | None = None,
     bbox_scale: int = settings.BBOX_SCALE,
-    vllm_api_base: str = settings.VLLM_API_BASE,
+    vllm_api_base: str | Sequence[str] = settings.VLLM_API_BASE,
+    image_codec: str | None = None,
+    cancel: threading.Event | None = None,
 ) -> List[GenerationResult]:
-    client = OpenAI(
-        api_key=settings.VLLM_API_KEY,
-        base_url=vllm_api_base,
-        default_headers=custom_headers,
-    )
-    model_name = settings.VLLM_MODEL_NAME
+    """Run a batch through vLLM, retrying looping outputs and failures.
+
+    Setting `cancel` aborts the batch: streams in flight are closed, which
+    makes vLLM drop them, and unfinished pages come back as errors.
+
+    A blocking non-streamed request can't be stopped once sent, so `cancel`,
+    speculative races and hedging all need VLLM_STREAM here. Without it,
+    `cancel` raises and pages retry and run one request at a time.
+    """
+    if cancel is not None and not settings.VLLM_STREAM:
+        raise ValueError("cancel needs VLLM_STREAM, non-streamed requests can't abort")
 
     if max_retries is None:
         max_retries = settings.MAX_VLLM_RETRIES
 
-    if max_workers is None:
+    router = get_router(vllm_api_base, custom_headers)
+    if max_workers is None and router.adaptive:
+        # The router's adaptive limits decide how many of these run at once
+        max_workers = min(
+            settings.VLLM_MAX_CONCURRENCY * len(router.endpoints), len(batch)
+        )
+    elif max_workers is None:
         max_workers = min(64, len(batch))
 
     if max_output_tokens is None:
         max_output_tokens = settings.MAX_OUTPUT_TOKENS
 
-    if model_name is None:
-        models = client.models.list()
-        model_name = models.data[0].id
+    pool_size = max(settings.VLLM_POOL_SIZE, max_workers)
+    # Requests abort at their next chunk once this is set
+    stop = cancel or threading.Event()
 
     def _generate(
-        item: BatchInputItem, temperature: float = 0, top_p: float = 0.1
+        item: BatchInputItem,
+        image_url: Future,
+        temperature: float = 0,
+        top_p: float = 0.1,
+        continuation: Continuation | None = None,
+        seed: int | None = None,
+        race_won: threading.Event | None = None,
+        failed: set | None = None,
+        sent_to: set | None = None,
     ) -> GenerationResult:
-        prompt = item.prompt
-        if not prompt:
-            prompt = PROMPT_MAPPING[item.prompt_type].replace(
-                "{bbox_scale}", str(bbox_scale)
-            )
-
-        content = []
-        image = scale_to_fit(item.image)
-        image_b64 = image_to_base64(image)
-        content.append(
-            {
-                "type": "image_url",
-                "image_url": {"url": f"data:image/png;base64,{image_b64}"},
-            }
+        """One request, routed to an endpoint not in `failed` or `sent_to`
+        where possible. The endpoint is added to `sent_to`, and to `failed` if
+        the request errors."""
+        if stop.is_set() or (race_won is not None and race_won.is_set()):
+            return error_result()
+        # Client-side work comes before taking a slot, so a bad page isn't
+        # charged to the endpoint
+        try:
+            request = build_request(
+                item,
+                image_url.result(),
+                bbox_scale,
+                max_output_tokens,
+                temperature,
+                top_p,
+                continuation,
+                seed,
+            )
+        except Exception as e:
+            print(f"Error preparing VLLM request: {e}")
+            return error_result(classify_error(e))
+        cost = router.request_cost(
+            item.image.size, remaining_tokens(max_output_tokens, continuation)
         )
-
-        content.append({"type": "text", "text": prompt})
-
         try:
-            completion = client.chat.completions.create(
-                model=model_name,
-                messages=[{"role": "user", "content": content}],
-                max_tokens=max_output_tokens,
-                temperature=temperature,
-                top_p=top_p,
-            )
-            raw = completion.choices[0].message.content
-            result = GenerationResult(
-                raw=raw,
-                token_count=completion.usage.completion_tokens,
-                error=False,
+            lease = router.acquire(cost, (failed or set()) | (sent_to or set()))
+        except CircuitOpenError as e:
+            return error_result(
+                RequestError(endpoint_failed=False, retry_after=e.retry_after)
             )
+        if sent_to is not None:
+            sent_to.add(lease.url)
+        start = time.perf_counter()
+        result = error_result(RequestError())
+        latency, failure, cancelled = None, None, False
+        try:
+            client = get_client(
+                lease.url,
+                headers=custom_headers,
+                pool_size=pool_size,
+                max_retries=0,
+            )
+            model_name = settings.VLLM_MODEL_NAME or get_model_name(
+                client, lease.url, headers=custom_headers
+            )
+            if settings.VLLM_STREAM:
+                deadline = start + settings.VLLM_REQUEST_TIMEOUT
+                stream = client.chat.completions.create(model=model_name, **request)
+                streamed = StreamedCompletion(continuation)
+                try:
+                    for chunk in stream:
+                        if streamed.add(chunk):
+                            break
+                        if stop.is_set() or (
+                            race_won is not None and race_won.is_set()
+                        ):
+                            cancelled = True
+                            break
+                        if time.perf_counter() > deadline:
+                            raise TimeoutError("Request ran past VLLM_REQUEST_TIMEOUT")
+                finally:
+                    # Closing the connection makes vLLM abort the request
+                    stream.close()
+                result = streamed.result()
+                latency = first_token_latency(streamed, start, continuation)
+            else:
+                completion = client.chat.completions.create(model=model_name, **request)
+                result = completion_result(completion, continuation)
         except Exception as e:
-            print(f"Error during VLLM generation: {e}")
-            return GenerationResult(raw="", token_count=0, error=True)
+            print(f"Error during VLLM generation on {lease.url}: {e}")
+            failure = classify_error(e)
+            result = error_result(failure)
+            if failed is not None:
+                failed.add(lease.url)
+        finally:
+            router.release(
+                lease,
+                cost,
+                failure is not None and failure.endpoint_failed,
+                result.token_count,
+                time.perf_counter() - start,
+                latency,
+                failure is not None and failure.overloaded,
+                prefill_tokens(item.image.size),
+                cancelled,
+            )
 
+        if stop.is_set():
+            return error_result()
         return result
 
-    def process_item(item, max_retries, max_failure_retries=None):
-        result = _generate(item)
-        retries = 0
+    def _timed_generate(*args, **kwargs) -> Tuple[GenerationResult, float]:
+        start = time.perf_counter()
+        result = _generate(*args, **kwargs)
+        return result, time.perf_counter() - start
 
-        while _should_retry(result, retries, max_retries, max_failure_retries):
-            result = _generate(item, temperature=0.3, top_p=0.95)
-            retries += 1
+    def _race(
+        item, image_url, continuation, count, retries, failed
+    ) -> GenerationResult:
+        """Run `count` sampled retries at once and keep the first clean one."""
+        race_won = threading.Event()
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=count) as pool:
+            futures = [
+                pool.submit(
+                    _timed_generate,
+                    item,
+                    image_url,
+                    temperature,
+                    settings.VLLM_SPECULATIVE_TOP_P,
+                    continuation,
+                    seed,
+                    race_won,
+                    failed,
+                )
+                for temperature, seed in speculative_schedule(count, retries)
+            ]
+            winner = None
+            for future in as_completed(futures):
+                if is_clean(future.result()[0]):
+                    winner = futures.index(future)
+                    # Streams still running stop at their next chunk
+                    race_won.set()
+                    break
+        candidates = [future.result() for future in futures]
+        speculation_stats.record(
+            candidates, winner, time.perf_counter() - start, continuation
+        )
+        return candidates[-1 if winner is None else winner][0]
 
+    def _hedged_generate(item, image_url, failed) -> GenerationResult:
+        """First attempt at a page, duplicated on another endpoint where
+        possible if it runs past the hedge delay. The first success wins."""
+        hedge = settings.VLLM_HEDGE and settings.VLLM_STREAM
+        delay = hedge_policy.delay() if hedge else None
+        if delay is None:
+            result, seconds = _timed_generate(item, image_url, failed=failed)
+            if not result.error:
+                hedge_policy.record(seconds)
+            return result
+
+        race_won = threading.Event()
+        sent_to = set()
+        requests = [
+            hedge_pool.submit(
+                _timed_generate,
+                item,
+                image_url,
+                race_won=race_won,
+                failed=failed,
+                sent_to=sent_to,
+            )
+        ]
+        try:
+            result, seconds = requests[0].result(timeout=delay)
+        except FutureTimeoutError:
+            if hedge_policy.try_hedge():
+                requests.append(
+                    hedge_pool.submit(
+                        _timed_generate,
+                        item,
+                        image_url,
+                        race_won=race_won,
+                        failed=failed,
+                        sent_to=sent_to,
+                    )
+                )
+            for future in as_completed(requests):
+                result, seconds = future.result()
+                if not result.error:
+                    # The other request stops at its next chunk
+                    race_won.set()
+                    if future is not requests[0]:
+                        hedge_policy.won()
+                    break
+        if not result.error:
+            hedge_policy.record(seconds)
         return result
 
-    def _should_retry(result, retries, max_retries, max_failure_retries):
-        has_repeat = detect_repeat_token(result.raw) or (
-            len(result.raw) > 50 and detect_repeat_token(result.raw, cut_from_end=50)
-        )
+    def process_item(item, image_url, max_retries, max_failure_retries=None):
+        # Endpoints that failed this page, to retry elsewhere
+        failed = set()
+        result = _hedged_generate(item, image_url, failed)
+        retries = 0
 
-        if retries < max_retries and has_repeat:
-            print(
-                f"Detected repeat token, retrying generation (attempt {retries + 1})..."
+        while (
+            delay := retry_delay(result, retries, max_retries, max_failure_retries)
+        ) is not None:
+            # Failures go straight to another replica when there is one
+            if not (result.error and router.can_reroute(failed)):
+                if stop.wait(delay):
+                    return error_result()
+            # Looping outputs resume from their last good block
+            continuation = get_continuation(result, max_output_tokens)
+            # Losing candidates could only be stopped mid-stream
+            race_size = settings.VLLM_STREAM and speculative_race_size(
+                result, retries, max_retries
+            )
+            if race_size:
+                result = _race(
+                    item, image_url, continuation, race_size, retries, failed
+                )
+                retries += race_size
+                continue
+            result = _generate(
+                item,
+                image_url,
+                temperature=0.3,
+                top_p=0.95,
+                continuation=continuation,
+                failed=failed,
             )
-            return True
+            retries += 1
+
+        return result
 
-        if retries < max_retries and result.error:
-            print(
-                f"Detected vllm error, retrying generation (attempt {retries + 1})..."
+    # Hedged pages run both their requests here. Losing requests may still be
+    # waiting on the server when the batch is done, so the pool isn't joined.
+    hedge_pool = ThreadPoolExecutor(max_workers=2 * max_workers)
+    # Pages are encoded on their own pool, ahead of the request threads, and
+    # reused across retries
+    with (
+        ThreadPoolExecutor(max_workers=settings.VLLM_ENCODE_WORKERS) as encoder,
+        ThreadPoolExecutor(max_workers=max_workers) as executor,
+    ):
+        image_urls = encode_batch_images(batch, encoder, image_codec)
+        try:
+            results = list(
+                executor.map(
+                    process_item,
+                    batch,
+                    image_urls,
+                    repeat(max_retries),
+                    repeat(max_failure_retries),
+                )
             )
-            time.sleep(2 * (retries + 1))  # Sleeping can help under load
-            return True
+        except BaseException:
+            # Interrupted, so abort the requests in flight instead of waiting
+            stop.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+        finally:
+            hedge_pool.shutdown(wait=False)
+
+    return results
+
 
-        if (
-            result.error
-            and max_failure_retries is not None
-            and retries < max_failure_retries
-        ):
-            print(
-                f"Detected vllm error, retrying generation (attempt {retries + 1})..."
+async def get_model_name_async(
+    client: AsyncOpenAI, api_base: str, api_key: str | None = None, headers=None
+) -> str:
+    if api_key is None:
+        api_key = settings.VLLM_API_KEY
+    key = _client_key(api_base, api_key, headers)
+    model_name = _model_names.get(key)
+    if model_name is None:
+        model_name = (await client.models.list()).data[0].id
+        with _clients_lock:
+            _model_names[key] = model_name
+    return model_name
+
+
+async def generate_vllm_async(
+    batch: List[BatchInputItem],
+    max_output_tokens: int = None,
+    max_retries: int = None,
+    max_concurrency: int | None = None,
+    custom_headers: dict | None = None,
+    max_failure_retries: int | None = None,
+    bbox_scale: int = settings.BBOX_SCALE,
+    vllm_api_base: str | Sequence[str] = settings.VLLM_API_BASE,
+    image_codec: str | None = None,
+    semaphore: asyncio.Semaphore | None = None,
+) -> List[GenerationResult]:
+    """Asyncio version of generate_vllm.
+
+    Requests are bounded by `semaphore`, or a new one of `max_concurrency`
+    slots; pass a shared semaphore to bound several concurrent calls together.
+    Within that, the router's adaptive per-endpoint limits apply.
+    Images are encoded in worker threads once a page holds a slot. Cancelling
+    the task closes its requests in flight, streamed or not, which makes vLLM
+    drop them.
+    """
+    if max_retries is None:
+        max_retries = settings.MAX_VLLM_RETRIES
+
+    if max_concurrency is None:
+        max_concurrency = settings.VLLM_ASYNC_CONCURRENCY
+
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+    if max_output_tokens is None:
+        max_output_tokens = settings.MAX_OUTPUT_TOKENS
+
+    router = get_router(vllm_api_base, custom_headers)
+    pool_size = max(settings.VLLM_POOL_SIZE, max_concurrency)
+
+    async def _generate(
+        shard: int,
+        item: BatchInputItem,
+        image_url: str,
+        temperature: float = 0,
+        top_p: float = 0.1,
+        continuation: Continuation | None = None,
+        seed: int | None = None,
+        race_won: threading.Event | None = None,
+        failed: set | None = None,
+        sent_to: set | None = None,
+    ) -> GenerationResult:
+        if race_won is not None and race_won.is_set():
+            return error_result()
+        try:
+            request = build_request(
+                item,
+                image_url,
+                bbox_scale,
+                max_output_tokens,
+                temperature,
+                top_p,
+                continuation,
+                seed,
             )
-            time.sleep(2 * (retries + 1))  # Sleeping can help under load
-            return True
+        except Exception as e:
+            print(f"Error preparing VLLM request: {e}")
+            return error_result(classify_error(e))
+        cost = router.request_cost(
+            item.image.size, remaining_tokens(max_output_tokens, continuation)
+        )
+        try:
+            lease = await router.acquire_async(
+                cost, (failed or set()) | (sent_to or set())
+            )
+        except CircuitOpenError as e:
+            return error_result(
+                RequestError(endpoint_failed=False, retry_after=e.retry_after)
+            )
+        if sent_to is not None:
+            sent_to.add(lease.url)
+        start = time.perf_counter()
+        result = error_result(RequestError())
+        latency, failure, cancelled = None, None, False
+        try:
+            clients = get_async_clients(
+                lease.url,
+                headers=custom_headers,
+                pool_size=pool_size,
+                max_retries=0,
+            )
+            client = clients[shard % len(clients)]
+            model_name = settings.VLLM_MODEL_NAME or await get_model_name_async(
+                client, lease.url, headers=custom_headers
+            )
+            if settings.VLLM_STREAM:
+                deadline = start + settings.VLLM_REQUEST_TIMEOUT
+                stream = await client.chat.completions.create(
+                    model=model_name, **request
+                )
+                streamed = StreamedCompletion(continuation)
+                try:
+                    async for chunk in stream:
+                        if streamed.add(chunk):
+                            break
+                        if race_won is not None and race_won.is_set():
+                            cancelled = True
+                            break
+                        if time.perf_counter() > deadline:
+                            raise TimeoutError("Request ran past VLLM_REQUEST_TIMEOUT")
+                finally:
+                    await stream.close()
+                result = streamed.result()
+                latency = first_token_latency(streamed, start, continuation)
+            else:
+                completion = await client.chat.completions.create(
+                    model=model_name, **request
+                )
+                result = completion_result(completion, continuation)
+        except asyncio.CancelledError:
+            cancelled = True
+            raise
+        except Exception as e:
+            print(f"Error during VLLM generation on {lease.url}: {e}")
+            failure = classify_error(e)
+            result = error_result(failure)
+            if failed is not None:
+                failed.add(lease.url)
+        finally:
+            router.release(
+                lease,
+                cost,
+                failure is not None and failure.endpoint_failed,
+                result.token_count,
+                time.perf_counter() - start,
+                latency,
+                failure is not None and failure.overloaded,
+                prefill_tokens(item.image.size),
+                cancelled,
+            )
+
+        return result
 
-        return False
+    async def _timed_generate(*args, **kwargs) -> Tuple[GenerationResult, float]:
+        start = time.perf_counter()
+        async with semaphore:
+            result = await _generate(*args, **kwargs)
+        return result, time.perf_counter() - start
 
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        results = list(
-            executor.map(
-                process_item, batch, repeat(max_retries), repeat(max_failure_retries)
+    async def _race(
+        shard, item, image_url, continuation, count, retries, failed
+    ) -> GenerationResult:
+        race_won = threading.Event()
+        start = time.perf_counter()
+        tasks = [
+            asyncio.ensure_future(
+                _timed_generate(
+                    shard,
+                    item,
+                    image_url,
+                    temperature,
+                    settings.VLLM_SPECULATIVE_TOP_P,
+                    continuation,
+                    seed,
+                    race_won,
+                    failed,
+                )
+            )
+            for temperature, seed in speculative_schedule(count, retries)
+        ]
+        winner = None
+        pending = set(tasks)
+        while pending and winner is None:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
             )
+            for task in done:
+                if winner is None and is_clean(task.result()[0]):
+                    winner = tasks.index(task)
+                    race_won.set()
+        if not settings.VLLM_STREAM:
+            # Streams stop at their next chunk; a blocking request has to be
+            # cancelled, which closes its connection
+            for task in pending:
+                task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        race_seconds = time.perf_counter() - start
+        candidates = [
+            (error_result(), race_seconds) if task.cancelled() else task.result()
+            for task in tasks
+        ]
+        speculation_stats.record(candidates, winner, race_seconds, continuation)
+        return candidates[-1 if winner is None else winner][0]
+
+    async def _hedged_generate(shard, item, image_url, failed) -> GenerationResult:
+        """Called holding a semaphore slot, which the first request uses; a
+        hedge waits for a slot of its own."""
+        start = time.perf_counter()
+        delay = hedge_policy.delay() if settings.VLLM_HEDGE else None
+        if delay is None:
+            result = await _generate(shard, item, image_url, failed=failed)
+            if not result.error:
+                hedge_policy.record(time.perf_counter() - start)
+            return result
+
+        sent_to = set()
+        primary = asyncio.ensure_future(
+            _generate(shard, item, image_url, failed=failed, sent_to=sent_to)
         )
+        done, _ = await asyncio.wait({primary}, timeout=delay)
+        if done or not hedge_policy.try_hedge():
+            result = await primary
+            seconds = time.perf_counter() - start
+        else:
+            hedge = asyncio.ensure_future(
+                _timed_generate(
+                    shard + 1, item, image_url, failed=failed, sent_to=sent_to
+                )
+            )
+            pending = {primary, hedge}
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                task = done.pop()
+                if task is hedge:
+                    result, seconds = task.result()
+                else:
+                    result, seconds = task.result(), time.perf_counter() - start
+                if not result.error:
+                    if task is hedge:
+                        hedge_policy.won()
+                    break
+            # Cancelling closes the losing request, which aborts it in vLLM
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+        if not result.error:
+            hedge_policy.record(seconds)
+        return result
 
-    return results
+    async def process_item(idx: int, item: BatchInputItem) -> GenerationResult:
+        failed = set()
+        async with semaphore:
+            try:
+                image_url = await asyncio.to_thread(encode_page, item, image_codec)
+            except Exception as e:
+                print(f"Error preparing VLLM request: {e}")
+                return error_result(classify_error(e))
+            result = await _hedged_generate(idx, item, image_url, failed)
+        retries = 0
+
+        while (
+            delay := retry_delay(result, retries, max_retries, max_failure_retries)
+        ) is not None:
+            # Backoff happens outside the semaphore so waiting pages don't
+            # hold a request slot. Failures go straight to another replica.
+            if not (result.error and router.can_reroute(failed)):
+                await asyncio.sleep(delay)
+            continuation = get_continuation(result, max_output_tokens)
+            race_size = speculative_race_size(result, retries, max_retries)
+            if race_size:
+                result = await _race(
+                    idx, item, image_url, continuation, race_size, retries, failed
+                )
+                retries += race_size
+                continue
+            async with semaphore:
+                result = await _generate(
+                    idx,
+                    item,
+                    image_url,
+                    temperature=0.3,
+                    top_p=0.95,
+                    continuation=continuation,
+                    failed=failed,
+                )
+            retries += 1
+
+        return result
+
+    return list(
+        await asyncio.gather(
+            *(process_item(idx, item) for idx, item in enumerate(batch))
+        )
+    )
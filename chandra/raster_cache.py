@@ -0,0 +1,128 @@
+import hashlib
+import os
+import threading
+from functools import lru_cache
+from pathlib import Path
+
+from PIL import Image
+
+from chandra.settings import settings
+
+
+def hash_file(file) -> str:
+    """Content hash of a path or a seekable file-like object."""
+    if isinstance(file, (str, os.PathLike)):
+        stat = os.stat(file)
+        return _hash_path(os.fspath(file), stat.st_size, stat.st_mtime_ns)
+
+    digest = hashlib.blake2b(digest_size=20)
+    position = file.tell()
+    file.seek(0)
+    for chunk in iter(lambda: file.read(1 << 20), b""):
+        digest.update(chunk)
+    file.seek(position)
+    return digest.hexdigest()
+
+
+@lru_cache(maxsize=256)
+def _hash_path(path: str, size: int, mtime_ns: int) -> str:
+    # size and mtime are part of the cache key so edited files are re-hashed
+    digest = hashlib.blake2b(digest_size=20)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class RasterCache:
+    """On-disk cache of rendered pages, evicting least recently used entries.
+
+    Pages are stored as binary PPM, which is uncompressed and decodes with a
+    single memcpy. Recency is tracked through file mtimes, so the cache can be
+    shared between processes.
+    """
+
+    extension = ".ppm"
+
+    def __init__(self, cache_dir: str, max_bytes: int):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._size = None
+
+    @staticmethod
+    def make_key(file_hash: str, page: int, scale: float, flatten: bool) -> str:
+        return f"{file_hash}_{page}_{scale:.6f}_{int(flatten)}"
+
+    def _path(self, key: str) -> Path:
+        return self.cache_dir / key[:2] / f"{key}{self.extension}"
+
+    def _entries(self):
+        return [
+            path
+            for path in self.cache_dir.glob(f"*/*{self.extension}")
+            if path.is_file()
+        ]
+
+    def get(self, key: str) -> Image.Image | None:
+        path = self._path(key)
+        try:
+            image = Image.open(path)
+            image.load()
+            os.utime(path)
+        except (FileNotFoundError, OSError):
+            return None
+        return image
+
+    def put(self, key: str, image: Image.Image):
+        path = self._path(key)
+        path.parent.mkdir(exist_ok=True)
+        tmp_path = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        try:
+            image.save(tmp_path, format="PPM")
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Failed to write raster cache entry {key}: {e}")
+            tmp_path.unlink(missing_ok=True)
+            return
+
+        with self._lock:
+            if self._size is None:
+                self._size = sum(entry.stat().st_size for entry in self._entries())
+            else:
+                self._size += path.stat().st_size
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        entries = []
+        for entry in self._entries():
+            try:
+                entries.append((entry.stat(), entry))
+            except FileNotFoundError:
+                continue
+        entries.sort(key=lambda e: e[0].st_mtime)
+
+        size = sum(stat.st_size for stat, _ in entries)
+        # Evict down to 90% so we don't rescan on every write
+        target = int(self.max_bytes * 0.9)
+        for stat, entry in entries:
+            if size <= target:
+                break
+            entry.unlink(missing_ok=True)
+            size -= stat.st_size
+        self._size = size
+
+    def clear(self):
+        with self._lock:
+            for entry in self._entries():
+                entry.unlink(missing_ok=True)
+            self._size = 0
+
+
+@lru_cache
+def get_raster_cache() -> RasterCache:
+    return RasterCache(
+        settings.RASTER_CACHE_DIR, settings.RASTER_CACHE_MAX_MB * 1024 * 1024
+    )
@@ -5,28 +5,46 @@ Permite procesar imágenes y PDFs mediante endpoints HTTP
 import base64
 import io
 import os
-import tempfile
+import threading
 from http import HTTPStatus
 from pathlib import Path
-from typing import Optional
+from tempfile import SpooledTemporaryFile
+from typing import BinaryIO, Optional
 
-from flask import Flask, request, jsonify
+from flask import Flask, Request, request, jsonify
 from PIL import Image, UnidentifiedImageError
 import filetype
 
 from chandra.model import InferenceManager
+from chandra.model.router import get_router
 from chandra.model.schema import BatchInputItem
-from chandra.input import load_file
+from chandra.input import iter_file_batches
 from chandra.settings import settings
 
 
 # Limitar tamaño máximo de imágenes para prevenir ataques zip bomb
 Image.MAX_IMAGE_PIXELS = settings.MAX_IMAGE_PIXELS
 
+
+class ChandraRequest(Request):
+    """Mantiene en memoria los uploads pequeños; solo los grandes van a disco"""
+
+    def _get_file_stream(
+        self, total_content_length, content_type, filename=None, content_length=None
+    ):
+        # max_size=0 significaría "nunca a disco", así que el mínimo es 1 byte
+        return SpooledTemporaryFile(
+            max_size=max(settings.UPLOAD_MEMORY_MAX_BYTES, 1), mode="rb+"
+        )
+
+
 app = Flask(__name__)
+app.request_class = ChandraRequest
 
 # Variable global para el modelo (se inicializa en el primer uso)
 _model_cache = {}
+# Un solo InferenceManager por método: con hf, todas las peticiones comparten el motor
+_model_lock = threading.Lock()
 
 
 def _normalize_origin(origin: str) -> str:
@@ -83,12 +101,20 @@ def _validate_upload_size(size_in_bytes: Optional[int]) -> bool:
     return size_in_bytes <= settings.MAX_UPLOAD_BYTES
 
 
-def _validate_uploaded_file(path: Path, original_name: str) -> tuple[bool, Optional[str]]:
+def _get_stream_size(stream: BinaryIO) -> int:
+    position = stream.tell()
+    stream.seek(0, os.SEEK_END)
+    size = stream.tell()
+    stream.seek(position)
+    return size
+
+
+def _validate_uploaded_file(stream: BinaryIO, original_name: str) -> tuple[bool, Optional[str]]:
     """Verifica que el archivo subido sea de un tipo permitido"""
     extension = Path(original_name).suffix.lower()
     extension_allowed = extension in settings.ALLOWED_FILE_EXTENSIONS
 
-    guessed = filetype.guess(str(path))
+    guessed = filetype.guess(stream)
     if guessed and guessed.mime not in settings.ALLOWED_FILE_MIME_TYPES:
         return (
             False,
@@ -181,9 +207,10 @@ def handle_preflight():
 
 def get_model(method: str = "vllm") -> InferenceManager:
     """Obtiene o crea el modelo de inferencia (con caché)"""
-    if method not in _model_cache:
-        _model_cache[method] = InferenceManager(method=method)
-    return _model_cache[method]
+    with _model_lock:
+        if method not in _model_cache:
+            _model_cache[method] = InferenceManager(method=method)
+        return _model_cache[method]
 
 
 def image_to_base64(pil_image: Image.Image, format: str = "PNG") -> str:
@@ -208,6 +235,22 @@ def health():
     return jsonify({"status": "ok", "service": "chandra-ocr-api"})
 
 
+@app.route("/api/metrics", methods=["GET"])
+def metrics():
+    """Métricas de los endpoints de vLLM y, si está cargado, del motor hf"""
+    data = {"vllm_endpoints": get_router(settings.VLLM_API_BASE).stats()}
+    engine = _model_cache["hf"].engine if "hf" in _model_cache else None
+    if engine is not None:
+        data["hf_engine"] = {
+            "running": len(engine.running),
+            "queued": engine.queue.qsize(),
+            "steps": engine.steps,
+            "tokens": engine.tokens,
+            "occupancy": engine.occupancy,
+        }
+    return jsonify(data)
+
+
 @app.route("/api/ocr", methods=["POST"])
 def ocr():
     """
@@ -220,6 +263,8 @@ def ocr():
     - include_headers_footers: "true" o "false" (default: "false")
     - max_output_tokens: número entero (opcional)
     - page_range: rango de páginas para PDFs, ej: "1-5,7,9-12" (opcional)
+    - use_text_layer: "true" o "false", usa el texto embebido de PDFs digitales
+      en lugar del modelo cuando es posible (default: TEXT_LAYER_ENABLED)
     
     Retorna JSON con:
     - markdown: texto en formato markdown
@@ -253,6 +298,9 @@ def ocr():
                 return jsonify({"error": "max_output_tokens must be an integer"}), 400
         
         page_range = request.form.get("page_range", None)
+        use_text_layer = request.form.get("use_text_layer")
+        if use_text_layer is not None:
+            use_text_layer = use_text_layer.lower() == "true"
 
         content_length = request.content_length
         if not _validate_upload_size(content_length):
@@ -265,21 +313,12 @@ def ocr():
                 HTTPStatus.REQUEST_ENTITY_TOO_LARGE,
             )
 
-        temp_path: Optional[Path] = None
-
-        # Guardar archivo temporalmente con un nombre seguro
-        suffix = Path(file.filename).suffix if file.filename else ""
-        if not suffix:
-            suffix = ".upload"
-
-        with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp_file:
-            temp_path = Path(tmp_file.name)
-
-        file.save(str(temp_path))
+        # El upload se lee directamente del stream de la petición, que queda en
+        # memoria salvo que supere UPLOAD_MEMORY_MAX_MB
+        stream = file.stream
 
         # Validar tamaño real
-        if not _validate_upload_size(temp_path.stat().st_size):
-            temp_path.unlink(missing_ok=True)
+        if not _validate_upload_size(_get_stream_size(stream)):
             return (
                 jsonify(
                     {
@@ -290,38 +329,49 @@ def ocr():
             )
 
         # Validar tipo de archivo
-        is_valid_file, file_error = _validate_uploaded_file(temp_path, file.filename)
+        is_valid_file, file_error = _validate_uploaded_file(stream, file.filename)
         if not is_valid_file:
-            temp_path.unlink(missing_ok=True)
             return jsonify({"error": file_error}), HTTPStatus.BAD_REQUEST
 
+        page_batches = None
         try:
-            # Cargar imágenes del archivo
+            # Cargar imágenes del archivo de forma perezosa: el render de la
+            # siguiente página se solapa con la inferencia de la actual
             config = {"page_range": page_range} if page_range else {}
-            images = load_file(str(temp_path), config)
-            
-            if not images:
-                return jsonify({"error": "No images could be loaded from file"}), 400
+            if use_text_layer is not None:
+                config["use_text_layer"] = use_text_layer
+            page_batches = iter_file_batches(stream, config, batch_size=1)
 
             # Obtener modelo
             model = get_model(method)
 
+            generate_kwargs = {
+                "include_images": include_images,
+                "include_headers_footers": include_headers_footers,
+            }
+
+            if max_output_tokens:
+                generate_kwargs["max_output_tokens"] = max_output_tokens
+
             # Procesar todas las páginas
             all_results = []
-            for img in images:
-                batch = [BatchInputItem(image=img, prompt_type="ocr_layout")]
-                
-                generate_kwargs = {
-                    "include_images": include_images,
-                    "include_headers_footers": include_headers_footers,
-                }
-                
-                if max_output_tokens:
-                    generate_kwargs["max_output_tokens"] = max_output_tokens
-
-                results = model.generate(batch, **generate_kwargs)
+            batches = (
+                [
+                    BatchInputItem(
+                        image=img,
+                        prompt_type="ocr_layout",
+                        text_layer=img.info.get("text_layer"),
+                    )
+                    for img in images
+                ]
+                for images in page_batches
+            )
+            for results in model.generate_iter(batches, **generate_kwargs):
                 all_results.extend(results)
 
+            if not all_results:
+                return jsonify({"error": "No images could be loaded from file"}), 400
+
             # Combinar resultados de múltiples páginas
             combined_markdown = []
             combined_html = []
@@ -350,6 +400,8 @@ def ocr():
                     "num_chunks": len(result.chunks),
                     "num_images": len(result.images),
                     "page_box": result.page_box,
+                    "from_text_layer": result.from_text_layer,
+                    "skipped": result.skipped,
                 })
 
             # Convertir imágenes a base64 para la respuesta JSON
@@ -366,6 +418,10 @@ def ocr():
                     "total_token_count": total_tokens,
                     "total_chunks": len(all_chunks),
                     "total_images": len(all_extracted_images),
+                    "text_layer_pages": sum(
+                        result.from_text_layer for result in all_results
+                    ),
+                    "skipped_pages": sum(result.skipped for result in all_results),
                     "pages": page_metadata,
                     "method": method,
                     "include_images": include_images,
@@ -376,9 +432,11 @@ def ocr():
             return jsonify(response)
 
         finally:
-            # Limpiar archivo temporal
-            if temp_path and temp_path.exists():
-                temp_path.unlink()
+            # Parar el render en segundo plano antes de cerrar el stream que lee
+            if page_batches is not None:
+                page_batches.close()
+            # Liberar el buffer (o el archivo temporal si se volcó a disco)
+            stream.close()
 
     except Exception as e:
         return jsonify({"error": str(e)}), 500
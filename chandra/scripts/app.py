@@ -18,8 +18,9 @@ def load_model(method: str):
 
 
 @st.cache_data()
-def get_page_image(pdf_file, page_num):
-    return load_pdf_images(pdf_file, [page_num])[0]
+def get_page_image(pdf_file, page_num, use_cache: bool = True):
+    # The raster cache outlives reruns and restarts of the app
+    return load_pdf_images(pdf_file, [page_num], use_cache=use_cache)[0]
 
 
 @st.cache_data()
@@ -88,6 +89,12 @@ if model_mode == "None":
 else:
     model = load_model(model_mode)
 
+use_raster_cache = st.sidebar.checkbox(
+    "Cache rendered pages",
+    value=True,
+    help="Keep rendered PDF pages on disk, so reopening a document skips rendering.",
+)
+
 in_file = st.sidebar.file_uploader(
     "PDF file or image:", type=["pdf", "png", "jpg", "jpeg", "gif", "webp"]
 )
@@ -103,7 +110,7 @@ if "pdf" in filetype:
         f"Page number out of {page_count}:", min_value=0, value=0, max_value=page_count
     )
 
-    pil_image = get_page_image(in_file, page_number)
+    pil_image = get_page_image(in_file, page_number, use_raster_cache)
 else:
     pil_image = Image.open(in_file).convert("RGB")
     page_number = None
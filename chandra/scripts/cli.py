@@ -4,9 +4,14 @@ from typing import List
 
 import click
 
-from chandra.input import load_file
+from chandra.input import iter_file_batches
 from chandra.model import InferenceManager
 from chandra.model.schema import BatchInputItem
+from chandra.model.hedging import hedge_policy
+from chandra.model.hf import batch_limits, padding_stats, pipeline_stats
+from chandra.model.router import get_router
+from chandra.model.vllm import speculation_stats
+from chandra.settings import settings
 
 
 def get_supported_files(input_path: Path) -> List[Path]:
@@ -60,6 +65,9 @@ def save_merged_output(
     total_tokens = 0
     total_chunks = 0
     total_images = 0
+    text_layer_pages = 0
+    skipped_pages = 0
+    deduplicated_pages = 0
 
     # Process each page result
     for page_num, result in enumerate(results):
@@ -75,6 +83,9 @@ def save_merged_output(
         total_tokens += result.token_count
         total_chunks += len(result.chunks)
         total_images += len(result.images)
+        text_layer_pages += result.from_text_layer
+        skipped_pages += result.skipped
+        deduplicated_pages += result.deduplicated
 
         page_metadata = {
             "page_num": page_num,
@@ -82,6 +93,9 @@ def save_merged_output(
             "token_count": result.token_count,
             "num_chunks": len(result.chunks),
             "num_images": len(result.images),
+            "from_text_layer": result.from_text_layer,
+            "skipped": result.skipped,
+            "deduplicated": result.deduplicated,
         }
         all_metadata.append(page_metadata)
 
@@ -112,6 +126,14 @@ def save_merged_output(
         "total_token_count": total_tokens,
         "total_chunks": total_chunks,
         "total_images": total_images,
+        "text_layer_pages": text_layer_pages,
+        "skipped_pages": skipped_pages,
+        "deduplicated_pages": deduplicated_pages,
+        "dedup_hit_rate": deduplicated_pages / len(results) if results else 0.0,
+        "model_pages": len(results)
+        - text_layer_pages
+        - skipped_pages
+        - deduplicated_pages,
         "pages": all_metadata,
     }
     metadata_path = file_output_dir / f"{safe_name}_metadata.json"
@@ -180,6 +202,26 @@ def save_merged_output(
     is_flag=True,
     default=False,
 )
+@click.option(
+    "--text-layer/--no-text-layer",
+    default=None,
+    help="Use the embedded text of born-digital PDF pages instead of the model.",
+)
+@click.option(
+    "--skip-blank/--no-skip-blank",
+    default=None,
+    help="Skip inference for blank or near-blank pages.",
+)
+@click.option(
+    "--dedup/--no-dedup",
+    default=None,
+    help="Run OCR once for pixel-identical pages and reuse the result.",
+)
+@click.option(
+    "--raster-cache/--no-raster-cache",
+    default=None,
+    help="Reuse rendered PDF pages from the on-disk raster cache.",
+)
 def main(
     input_path: Path,
     output_path: Path,
@@ -193,8 +235,19 @@ def main(
     save_html: bool,
     batch_size: int,
     paginate_output: bool,
+    text_layer: bool | None,
+    skip_blank: bool | None,
+    dedup: bool | None,
+    raster_cache: bool | None,
 ):
-    if method == "hf":
+    if method == "hf" and settings.HF_CONTINUOUS_BATCHING:
+        if batch_size is None:
+            batch_size = settings.HF_ENGINE_SLOTS
+    elif method == "hf" and settings.HF_AUTO_BATCH:
+        # Sub-batches shrink to what fits in memory as generation runs out of it
+        if batch_size is None:
+            batch_size = settings.HF_AUTO_BATCH_MAX
+    elif method == "hf":
         click.echo(
             "When using '--method hf', ensure that the batch size is set correctly.  We will default to batch size of 1."
         )
@@ -232,45 +285,59 @@ def main(
         )
 
         try:
-            # Load images from file
+            # Pages are rendered lazily and ahead of inference
             config = {"page_range": page_range} if page_range else {}
-            images = load_file(str(file_path), config)
-            click.echo(f"  Loaded {len(images)} page(s)")
+            if raster_cache is not None:
+                config["use_raster_cache"] = raster_cache
+            if text_layer is not None:
+                config["use_text_layer"] = text_layer
+            page_batches = iter_file_batches(str(file_path), config, batch_size)
+
+            # Build kwargs for generate
+            generate_kwargs = {
+                "include_images": include_images,
+                "include_headers_footers": include_headers_footers,
+            }
+
+            if max_output_tokens is not None:
+                generate_kwargs["max_output_tokens"] = max_output_tokens
+
+            if skip_blank is not None:
+                generate_kwargs["skip_blank"] = skip_blank
+            if dedup is not None:
+                generate_kwargs["dedup"] = dedup
+
+            if method == "vllm":
+                if max_workers is not None:
+                    generate_kwargs["max_workers"] = max_workers
+                if max_retries is not None:
+                    generate_kwargs["max_retries"] = max_retries
 
             # Accumulate all results for this document
             all_results = []
 
-            # Process pages in batches
-            for batch_start in range(0, len(images), batch_size):
-                batch_end = min(batch_start + batch_size, len(images))
-                batch_images = images[batch_start:batch_end]
-
-                # Create batch input items
-                batch = [
-                    BatchInputItem(image=img, prompt_type="ocr_layout")
+            # Create batch input items
+            batches = (
+                [
+                    BatchInputItem(
+                        image=img,
+                        prompt_type="ocr_layout",
+                        text_layer=img.info.get("text_layer"),
+                    )
                     for img in batch_images
                 ]
+                for batch_images in page_batches
+            )
 
-                # Run inference
-                click.echo(f"  Processing pages {batch_start + 1}-{batch_end}...")
-
-                # Build kwargs for generate
-                generate_kwargs = {
-                    "include_images": include_images,
-                    "include_headers_footers": include_headers_footers,
-                }
-
-                if max_output_tokens is not None:
-                    generate_kwargs["max_output_tokens"] = max_output_tokens
-
-                if method == "vllm":
-                    if max_workers is not None:
-                        generate_kwargs["max_workers"] = max_workers
-                    if max_retries is not None:
-                        generate_kwargs["max_retries"] = max_retries
-
-                results = model.generate(batch, **generate_kwargs)
+            # Run inference. generate_iter works ahead of the batch it yields:
+            # the hf pipeline prepares the next batch while this one generates,
+            # and the engine fills slots freed by short pages with the next one
+            for results in model.generate_iter(batches, **generate_kwargs):
+                batch_start = len(all_results)
                 all_results.extend(results)
+                click.echo(f"  Processed pages {batch_start + 1}-{len(all_results)}...")
+
+            click.echo(f"  Processed {len(all_results)} page(s)")
 
             # Save merged output for all pages
             save_merged_output(
@@ -288,6 +355,55 @@ def main(
             click.echo(f"  Error processing {file_path.name}: {e}", err=True)
             continue
 
+    if model.dedup_index.lookups:
+        click.echo(f"Dedup hit rate: {model.dedup_index.hit_rate:.1%}")
+    if speculation_stats.races:
+        click.echo(
+            f"Speculative retries: {speculation_stats.races} races, "
+            f"{speculation_stats.extra_tokens} extra tokens, "
+            f"about {speculation_stats.seconds_saved:.1f}s saved"
+        )
+    if hedge_policy.hedges:
+        click.echo(
+            f"Hedged requests: {hedge_policy.hedges} of {hedge_policy.requests}, "
+            f"{hedge_policy.wins} finished first"
+        )
+    if method == "hf" and pipeline_stats.batches:
+        click.echo(
+            f"HF stages: prepare {pipeline_stats.prepare:.1f}s, "
+            f"generate {pipeline_stats.generate:.1f}s, "
+            f"decode {pipeline_stats.decode:.1f}s, "
+            f"{pipeline_stats.overlap:.1f}s overlapped"
+        )
+    if model.engine is not None and model.engine.steps:
+        click.echo(
+            f"HF engine: {model.engine.tokens} tokens in {model.engine.steps} steps, "
+            f"{model.engine.occupancy:.0%} slot occupancy"
+        )
+    if batch_limits.ooms:
+        limits = ", ".join(
+            f"{2 ** (band - 1)}+ vision tokens: {size}"
+            for (band, _), size in sorted(batch_limits.learned().items())
+        )
+        click.echo(
+            f"HF ran out of memory {batch_limits.ooms} times, batch limits {limits}"
+        )
+    if padding_stats.saved:
+        click.echo(
+            f"Padding: {padding_stats.padding} prompt tokens, "
+            f"{padding_stats.saved} fewer than without bucketing"
+        )
+    if method == "vllm":
+        router = get_router(settings.VLLM_API_BASE)
+        if len(router.endpoints) > 1 or router.adaptive:
+            for endpoint in router.stats():
+                click.echo(
+                    f"{endpoint['url']}: {endpoint['requests']} requests, "
+                    f"{endpoint['errors']} errors, "
+                    f"{endpoint['mean_latency']:.2f}s mean latency, "
+                    f"concurrency limit {endpoint['concurrency_limit']}"
+                    + ("" if endpoint["healthy"] else " (ejected)")
+                )
     click.echo(f"\nProcessing complete. Results saved to: {output_path}")
 
 
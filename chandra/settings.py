@@ -1,28 +1,131 @@
 from dotenv import find_dotenv
-from pydantic import computed_field
+from pydantic import computed_field, field_validator
 from pydantic_settings import BaseSettings
 import torch
 import os
 
 
+CPU_DTYPES = {
+    "bfloat16": torch.bfloat16,
+    "float16": torch.float16,
+    "float32": torch.float32,
+}
+
+
+def _cpu_has_bf16() -> bool:
+    # Private torch helpers, so missing ones count as no support
+    checks = ("_is_amx_tile_supported", "_is_avx512_bf16_supported")
+    return any(getattr(torch.cpu, check, lambda: False)() for check in checks)
+
+
 class Settings(BaseSettings):
     # Paths
     BASE_DIR: str = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
     IMAGE_DPI: int = 192
     MIN_PDF_IMAGE_DIM: int = 1024
     MIN_IMAGE_DIM: int = 1536
+    PDF_PREFETCH_PAGES: int = 8  # Rendered pages allowed to wait for inference
+    PDF_RENDER_WORKERS: int = 1  # Processes used to rasterize PDFs, 1 = serial
+    PDF_RENDER_AT_MODEL_BUDGET: bool = True  # Render no larger than the model sees
+    MODEL_MAX_IMAGE_SIZE: tuple[int, int] = (3072, 2048)
+    IMAGE_DECODE_AT_MODEL_BUDGET: bool = True  # Draft-decode large JPEGs
+    RASTER_CACHE_ENABLED: bool = False
+    RASTER_CACHE_DIR: str = os.path.join(
+        os.path.expanduser("~"), ".cache", "chandra", "rasters"
+    )
+    RASTER_CACHE_MAX_MB: int = 4096
+    # Born-digital pages with a clean text layer can skip the model
+    TEXT_LAYER_ENABLED: bool = False
+    TEXT_LAYER_MIN_CHARS: int = 50
+    TEXT_LAYER_MAX_PATHS: int = 16
+    TEXT_LAYER_MARGIN: float = (
+        0.06  # Short blocks this near the edge are headers/footers
+    )
+    # Blank page detection, see chandra.model.util.is_blank_page
+    SKIP_BLANK_PAGES: bool = False
+    BLANK_PAGE_SAMPLE_DIM: int = 256
+    BLANK_PAGE_INK_DELTA: int = 64  # This far from the paper colour is ink
+    BLANK_PAGE_MAX_INK_RATIO: float = 0.0015
+    BLANK_PAGE_MAX_STD: float = 2.0  # Of the box-filtered page; more is content
+    # Reuse results for pixel-identical pages, within and across batches. Only
+    # exact copies match: re-scans of the same page still go to the model
+    DEDUP_PAGES: bool = False
+    DEDUP_INDEX_SIZE: int = 4096
     MODEL_CHECKPOINT: str = "datalab-to/chandra"
-    TORCH_DEVICE: str | None = None
+    TORCH_DEVICE: str | None = None  # "cpu" runs the hf method without a GPU
+    # CPU mode: bfloat16, float16 or float32, by default bfloat16 where the
+    # CPU has native support (AMX or AVX512-BF16)
+    TORCH_CPU_DTYPE: str | None = None
+    TORCH_CPU_QUANTIZE: bool = False  # Dynamic int8 linear layers, runs in float32
+    TORCH_NUM_THREADS: int | None = None  # Intra-op threads, torch's default if unset
+    TORCH_NUM_INTEROP_THREADS: int | None = None
     MAX_OUTPUT_TOKENS: int = 12384
     TORCH_ATTN: str | None = None
     BBOX_SCALE: int = 1024
+    # Generations are checked for repetition while decoding and stopped early
+    REPEAT_CHECK_CHARS: int = 512  # Streamed vLLM output
+    REPEAT_CHECK_TOKENS: int = 128  # HF generate
+    # HF batches run in sub-batches of pages with similar vision token counts
+    HF_BUCKET_PAGES: bool = True
+    HF_BUCKET_RATIO: float = 1.5  # Largest to smallest page in a sub-batch
+    HF_PIPELINE_DEPTH: int = 3  # Batches in flight across prepare, generate and decode
+    # Sub-batches that run out of memory are halved and retried, and the sizes
+    # that fit are remembered. With auto batching the CLI sends batches of up
+    # to HF_AUTO_BATCH_MAX pages and lets those limits cut them down
+    HF_AUTO_BATCH: bool = False
+    HF_AUTO_BATCH_MAX: int = 64
+    # Continuous batching for the HF backend, see chandra.model.engine. Best
+    # with TORCH_ATTN=flash_attention_2: under sdpa, padded batches lose the
+    # fast grouped-query attention kernel
+    HF_CONTINUOUS_BATCHING: bool = False
+    HF_ENGINE_SLOTS: int = 8  # Pages decoded at once
 
     # vLLM server settings
     VLLM_API_KEY: str = "EMPTY"
-    VLLM_API_BASE: str = "http://localhost:8000/v1"
-    VLLM_MODEL_NAME: str = "chandra"
+    VLLM_API_BASE: str = "http://localhost:8000/v1"  # Comma-separated for replicas
+    VLLM_MODEL_NAME: str | None = "chandra"
     VLLM_GPUS: str = "0"
     MAX_VLLM_RETRIES: int = 6
+    VLLM_STREAM: bool = True  # Stream completions so looping pages are cut off early
+    VLLM_CONTINUE_ON_REPEAT: bool = True  # Retry loops from the last good block
+    # Sampled retries raced at once when a page loops; 0 retries one at a time
+    VLLM_SPECULATIVE_RETRIES: int = 0
+    VLLM_SPECULATIVE_TEMPERATURES: tuple[float, ...] = (0.3, 0.5, 0.7, 0.9)
+    VLLM_SPECULATIVE_TOP_P: float = 0.95
+    # Image transport to the vLLM server: png, webp (lossless) or jpeg
+    VLLM_IMAGE_CODEC: str = "png"
+    VLLM_PNG_COMPRESS_LEVEL: int = 6
+    VLLM_WEBP_METHOD: int = 0
+    VLLM_JPEG_QUALITY: int = 95
+    VLLM_ENCODE_WORKERS: int = 4
+    VLLM_POOL_SIZE: int = 64  # Minimum keep-alive connections per vLLM endpoint
+    VLLM_ASYNC_CONCURRENCY: int = 256  # In-flight requests per generate_vllm_async call
+    VLLM_ASYNC_POOL_SHARD_SIZE: int = 32  # Connections per async client
+    # Routing across several endpoints: least_tokens or least_requests
+    VLLM_ROUTING_POLICY: str = "least_tokens"
+    VLLM_ROUTING_DECODE_ESTIMATE: int = 1024  # Starting guess of completion tokens
+    VLLM_EJECT_AFTER_FAILURES: int = 3
+    VLLM_HEALTH_CHECK_INTERVAL: float = 10.0
+    VLLM_HEALTH_CHECK_TIMEOUT: float = 5.0
+    # Per-endpoint AIMD limit on in-flight requests
+    VLLM_ADAPTIVE_CONCURRENCY: bool = True
+    VLLM_INITIAL_CONCURRENCY: int = 32  # Matches --max-num-seqs in chandra.scripts.vllm
+    VLLM_MAX_CONCURRENCY: int = 128
+    VLLM_CONCURRENCY_BACKOFF: float = 0.75
+    # Time to first token over its baseline that counts as queueing
+    VLLM_CONCURRENCY_LATENCY_TOLERANCE: float = 2.0
+    VLLM_CONNECT_TIMEOUT: float = 5.0
+    VLLM_READ_TIMEOUT: float = 120.0  # Longest wait for the next streamed chunk
+    VLLM_REQUEST_TIMEOUT: float = 900.0  # Whole request, streamed or not
+    VLLM_RETRY_BACKOFF: float = 1.0  # Exponential backoff base, with full jitter
+    VLLM_RETRY_BACKOFF_MAX: float = 30.0
+    VLLM_RETRY_AFTER_MAX: float = 60.0  # Cap on a server's Retry-After
+    VLLM_CIRCUIT_COOLDOWN: float = 30.0
+    # Duplicate requests slower than this percentile of recent latency
+    VLLM_HEDGE: bool = False
+    VLLM_HEDGE_PERCENTILE: float = 95.0
+    VLLM_HEDGE_BUDGET: float = 0.05  # Most hedges, as a share of requests
+    VLLM_HEDGE_MIN_SAMPLES: int = 20
 
     # API authentication settings
     CHANDRA_API_KEY: str | None = None
@@ -31,6 +134,7 @@ class Settings(BaseSettings):
     # API security hardening
     CHANDRA_ALLOWED_ORIGINS: str = "*"
     MAX_UPLOAD_MB: int = 25
+    UPLOAD_MEMORY_MAX_MB: int = 16  # Larger uploads are spooled to disk
     MAX_IMAGE_PIXELS: int = 80_000_000
     ALLOWED_FILE_EXTENSIONS: tuple[str, ...] = (
         ".pdf",
@@ -55,16 +159,37 @@ class Settings(BaseSettings):
         "image/heif",
     )
 
+    @field_validator("TORCH_CPU_DTYPE")
+    @classmethod
+    def check_cpu_dtype(cls, value: str | None) -> str | None:
+        if value and value not in CPU_DTYPES:
+            raise ValueError(
+                f"TORCH_CPU_DTYPE must be one of {', '.join(CPU_DTYPES)}, not {value!r}"
+            )
+        return value or None
+
     @computed_field
     @property
     def TORCH_DTYPE(self) -> torch.dtype:
-        return torch.bfloat16
+        if self.TORCH_DEVICE != "cpu":
+            return torch.bfloat16
+        if self.TORCH_CPU_DTYPE:
+            return CPU_DTYPES[self.TORCH_CPU_DTYPE]
+        # Dynamic quantization only replaces float32 linear layers
+        if not self.TORCH_CPU_QUANTIZE and _cpu_has_bf16():
+            return torch.bfloat16
+        return torch.float32
 
     @computed_field
     @property
     def MAX_UPLOAD_BYTES(self) -> int:
         return self.MAX_UPLOAD_MB * 1024 * 1024
 
+    @computed_field
+    @property
+    def UPLOAD_MEMORY_MAX_BYTES(self) -> int:
+        return self.UPLOAD_MEMORY_MAX_MB * 1024 * 1024
+
     class Config:
         env_file = find_dotenv("local.env")
         extra = "ignore"
@@ -8,3 +8,122 @@ def simple_text_image() -> Image.Image:
     draw = ImageDraw.Draw(image)
     draw.text((50, 50), "Hello, World!", fill="black", font_size=32)
     return image
+
+
+@pytest.fixture(scope="session")
+def blank_pdf(tmp_path_factory):
+    import pypdfium2 as pdfium
+
+    doc = pdfium.PdfDocument.new()
+    for idx in range(5):
+        doc.new_page(612 + idx * 10, 792)
+    path = tmp_path_factory.mktemp("pdf") / "blank.pdf"
+    doc.save(str(path))
+    doc.close()
+    return path
+
+
+def write_text_pdf(path, lines):
+    import ctypes
+
+    import pypdfium2 as pdfium
+    import pypdfium2.raw as pdfium_c
+
+    doc = pdfium.PdfDocument.new()
+    page = doc.new_page(612, 792)
+    for x, y, text in lines:
+        obj = pdfium_c.FPDFPageObj_NewTextObj(doc.raw, b"Helvetica", 12)
+        buffer = ctypes.create_string_buffer((text + "\x00").encode("utf-16-le"))
+        pdfium_c.FPDFText_SetText(obj, ctypes.cast(buffer, pdfium_c.FPDF_WIDESTRING))
+        pdfium_c.FPDFPageObj_Transform(obj, 1, 0, 0, 1, x, y)
+        pdfium_c.FPDFPage_InsertObject(page.raw, obj)
+    pdfium_c.FPDFPage_GenerateContent(page.raw)
+    doc.save(str(path))
+    doc.close()
+    return path
+
+
+TEXT_LINES = [
+    (72, 700, "Chandra converts documents into structured markdown."),
+    (72, 686, "This second line belongs to the same paragraph."),
+    (72, 600, "A separate paragraph further down the page."),
+]
+
+
+@pytest.fixture(scope="session")
+def text_pdf(tmp_path_factory):
+    return write_text_pdf(tmp_path_factory.mktemp("pdf") / "text.pdf", TEXT_LINES)
+
+
+@pytest.fixture(scope="session")
+def header_footer_pdf(tmp_path_factory):
+    lines = [
+        (72, 760, "Annual Report 2024"),
+        *TEXT_LINES,
+        (300, 30, "Page 7"),
+    ]
+    path = tmp_path_factory.mktemp("pdf") / "header_footer.pdf"
+    return write_text_pdf(path, lines)
+
+
+@pytest.fixture(scope="session")
+def annotated_pdf(tmp_path_factory):
+    """A text page with a note annotation, whose text only shows once flattened."""
+    page_text = (
+        b"BT /F1 12 Tf 72 700 Td "
+        b"(Chandra converts documents into structured markdown today.) Tj ET"
+    )
+    note = b"BT /F1 12 Tf 2 6 Td (Reviewed and approved by the records office.) Tj ET"
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        (
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents 4 0 R "
+            b"/Resources << /Font << /F1 5 0 R >> >> /Annots [6 0 R] >>"
+        ),
+        b"<< /Length %d >>\nstream\n%s\nendstream" % (len(page_text), page_text),
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+        (
+            b"<< /Type /Annot /Subtype /FreeText /Rect [72 600 400 620] "
+            b"/DA (/F1 12 Tf) /Contents (note) /AP << /N 7 0 R >> >>"
+        ),
+        b"<< /Type /XObject /Subtype /Form /BBox [0 0 328 20] "
+        b"/Resources << /Font << /F1 5 0 R >> >> /Length %d >>"
+        b"\nstream\n%s\nendstream" % (len(note), note),
+    ]
+    data = bytearray(b"%PDF-1.7\n")
+    offsets = []
+    for idx, body in enumerate(objects, 1):
+        offsets.append(len(data))
+        data += b"%d 0 obj\n%s\nendobj\n" % (idx, body)
+    xref = len(data)
+    data += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    for offset in offsets:
+        data += b"%010d 00000 n \n" % offset
+    data += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (
+        len(objects) + 1,
+        xref,
+    )
+    path = tmp_path_factory.mktemp("pdf") / "annotated.pdf"
+    path.write_bytes(bytes(data))
+    return path
+
+
+@pytest.fixture()
+def vllm_stub():
+    from benchmarks.vllm_stub import StubVLLMServer
+    from chandra.model.router import clear_routers
+    from chandra.model.vllm import clear_clients
+
+    clear_clients()
+    clear_routers()
+    with StubVLLMServer() as server:
+        yield server
+    clear_clients()
+
+
+@pytest.fixture(scope="session")
+def tiny_hf_model():
+    from benchmarks.tiny_qwen import load_tiny_model
+
+    return load_tiny_model()
@@ -0,0 +1,88 @@
+import time
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from chandra.model import InferenceManager
+from chandra.model.schema import BatchInputItem
+from chandra.model.util import is_blank_page
+
+
+def test_blank_and_near_blank_pages():
+    assert is_blank_page(Image.new("RGB", (1632, 2112), "white"))
+    # Grey scanner background with a speck of dust
+    scan = Image.new("RGB", (1632, 2112), (225, 222, 215))
+    ImageDraw.Draw(scan).ellipse((800, 900, 806, 906), fill="black")
+    assert is_blank_page(scan)
+
+
+def test_text_page_is_not_blank(simple_text_image):
+    assert not is_blank_page(simple_text_image)
+
+
+def text_line(fill) -> Image.Image:
+    page = Image.new("RGB", (2550, 3300), "white")
+    ImageDraw.Draw(page).text(
+        (150, 1600), "The quick brown fox jumps over the lazy dog. " * 8, fill=fill
+    )
+    return page
+
+
+def test_single_line_is_not_blank():
+    # Strokes one pixel wide, which a nearest-neighbour sample steps over
+    assert not is_blank_page(text_line("black"))
+
+
+def test_faint_line_is_not_blank():
+    page = Image.new("RGB", (2550, 3300), (240, 238, 230))
+    ImageDraw.Draw(page).line((150, 1600, 2400, 1600), fill=(160, 160, 160))
+    assert not is_blank_page(page)
+
+
+def test_light_text_on_dark_page_is_not_blank():
+    slide = Image.new("RGB", (1632, 2112), (15, 15, 40))
+    draw = ImageDraw.Draw(slide)
+    for line in range(40):
+        draw.text((100, 100 + line * 48), f"Slide text, line {line}", fill="white")
+    assert not is_blank_page(slide)
+
+
+def test_low_contrast_text_is_not_blank():
+    # Pencil grey, closer to the paper than the ink threshold
+    page = Image.new("RGB", (2550, 3300), "white")
+    draw = ImageDraw.Draw(page)
+    for line in range(40):
+        draw.text((150, 200 + line * 70), f"Pencil notes, line {line}", fill=(200,) * 3)
+    assert not is_blank_page(page)
+
+
+def test_noisy_blank_scan_is_blank():
+    rng = np.random.default_rng(0)
+    noise = rng.normal(230, 12, (2112, 1632, 3)).clip(0, 255).astype(np.uint8)
+    assert is_blank_page(Image.fromarray(noise))
+
+
+def mean_seconds(image: Image.Image) -> float:
+    start = time.perf_counter()
+    for _ in range(20):
+        is_blank_page(image)
+    return (time.perf_counter() - start) / 20
+
+
+def test_blank_check_is_fast(simple_text_image):
+    text_page = simple_text_image.resize((3072, 2048))
+    assert mean_seconds(text_page) < 0.005
+    # Pages that look blank take one box-filter pass over every pixel
+    assert mean_seconds(Image.new("RGB", (3072, 2048), "white")) < 0.02
+
+
+def test_generate_skips_blank_pages():
+    manager = InferenceManager(method="vllm")
+    image = Image.new("RGB", (800, 600), "white")
+    output = manager.generate(
+        [BatchInputItem(image=image, prompt_type="ocr_layout")], skip_blank=True
+    )[0]
+    assert output.skipped
+    assert output.markdown == ""
+    assert output.chunks == []
+    assert output.page_box == [0, 0, 800, 600]
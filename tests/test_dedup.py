@@ -0,0 +1,84 @@
+from PIL import Image, ImageDraw
+
+import chandra.model as chandra_model
+from chandra.model import InferenceManager
+from chandra.model.dedup import PageDedupIndex, pixel_hash
+from chandra.model.schema import BatchInputItem, GenerationResult
+
+
+def _page(text: str) -> Image.Image:
+    image = Image.new("RGB", (400, 300), "white")
+    ImageDraw.Draw(image).text((20, 20), text, fill="black", font_size=24)
+    return image
+
+
+def _fake_generate(calls):
+    def _generate(batch, **kwargs):
+        calls.append(len(batch))
+        return [
+            GenerationResult(raw=f"<p>page {len(calls)}-{idx}</p>", token_count=5)
+            for idx in range(len(batch))
+        ]
+
+    return _generate
+
+
+def test_pixel_hash():
+    assert pixel_hash(_page("terms")) == pixel_hash(_page("terms"))
+    assert pixel_hash(_page("terms")) != pixel_hash(_page("terms."))
+    assert pixel_hash(_page("terms")) != pixel_hash(_page("terms").convert("L"))
+
+
+def test_dedup_within_and_across_batches(monkeypatch):
+    calls = []
+    monkeypatch.setattr(chandra_model, "generate_vllm", _fake_generate(calls))
+    manager = InferenceManager(method="vllm")
+
+    batch = [
+        BatchInputItem(image=_page("cover"), prompt_type="ocr_layout"),
+        BatchInputItem(image=_page("body"), prompt_type="ocr_layout"),
+        BatchInputItem(image=_page("cover"), prompt_type="ocr_layout"),
+    ]
+    outputs = manager.generate(batch, dedup=True)
+    assert calls == [2]
+    assert outputs[0].raw == outputs[2].raw != outputs[1].raw
+    assert [output.deduplicated for output in outputs] == [False, False, True]
+
+    outputs = manager.generate(
+        [BatchInputItem(image=_page("cover"), prompt_type="ocr_layout")], dedup=True
+    )
+    assert calls == [2]
+    assert outputs[0].deduplicated
+    assert manager.dedup_index.hit_rate == 0.5
+
+
+def test_prompt_is_part_of_the_key():
+    index = PageDedupIndex(max_entries=4)
+    image = _page("same")
+    layout = index.make_key(BatchInputItem(image=image, prompt_type="ocr_layout"))
+    plain = index.make_key(BatchInputItem(image=image, prompt_type="ocr"))
+    assert layout != plain
+
+
+def test_index_is_bounded():
+    index = PageDedupIndex(max_entries=1)
+    result = GenerationResult(raw="x", token_count=1)
+    index.put(("a",), result)
+    index.put(("b",), result)
+    cached, _, _ = index.plan([(0, ("a",)), (1, ("b",))])
+    assert list(cached) == [1]
+
+
+def test_only_exact_copies_match():
+    index = PageDedupIndex()
+    page = _page("cover")
+    # A re-scan: the same page, one pixel off and a shade darker
+    rescan = Image.new("RGB", page.size, (250, 250, 250))
+    rescan.paste(page.crop((0, 0, page.width - 1, page.height)), (1, 0))
+    index.put(
+        index.make_key(BatchInputItem(image=page, prompt="OCR")),
+        GenerationResult(raw="x", token_count=1),
+    )
+    keys = [(0, index.make_key(BatchInputItem(image=rescan, prompt="OCR")))]
+    cached, _, _ = index.plan(keys)
+    assert not cached
@@ -0,0 +1,100 @@
+import threading
+
+import pytest
+from PIL import Image
+
+from chandra.model import InferenceManager
+from chandra.model.engine import HFEngine
+from chandra.model.hf import generate_hf
+from chandra.model.schema import BatchInputItem
+from chandra.settings import settings
+
+SIZES = [(200, 150), (1000, 1300), (210, 150), (600, 800), (300, 300), (1000, 1300)]
+LENGTHS = [5, 20, 9, 30, 3, 12]
+
+
+@pytest.fixture()
+def engine(tiny_hf_model):
+    engine = HFEngine(tiny_hf_model, max_batch_size=3)
+    yield engine
+    engine.close()
+
+
+def pages():
+    return [
+        BatchInputItem(image=Image.new("RGB", size, "white"), prompt="OCR")
+        for size in SIZES
+    ]
+
+
+def test_engine_matches_generate_hf(tiny_hf_model, engine):
+    batch = pages()
+    expected = [
+        generate_hf([item], tiny_hf_model, max_output_tokens=length)[0]
+        for item, length in zip(batch, LENGTHS)
+    ]
+
+    # More pages than slots, so later pages join as earlier ones finish
+    futures = [engine.submit(item, length) for item, length in zip(batch, LENGTHS)]
+    results = [future.result(timeout=120) for future in futures]
+
+    assert [result.raw for result in results] == [result.raw for result in expected]
+    assert [result.token_count for result in results] == LENGTHS
+    # Steps are bounded by the slots, not by running the batch to its longest page
+    assert engine.steps < sum(LENGTHS)
+    assert engine.occupancy > 0.5
+
+
+def test_engine_concurrent_callers(engine):
+    batch = pages()
+    results = {}
+
+    def run(idx):
+        results[idx] = engine.generate(batch[idx : idx + 2], max_output_tokens=4)
+
+    threads = [threading.Thread(target=run, args=(idx,)) for idx in (0, 2, 4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(120)
+
+    assert sorted(results) == [0, 2, 4]
+    assert all(result.token_count == 4 for rs in results.values() for result in rs)
+    assert not engine.running
+
+
+def test_closed_engine_rejects_pages(engine):
+    item = pages()[0]
+    engine.close()
+    with pytest.raises(RuntimeError):
+        engine.submit(item)
+
+
+def test_bad_page_fails_alone(engine):
+    good = pages()[:4]
+    bad = BatchInputItem(image=Image.new("RGB", SIZES[0], "white"), prompt_type="?")
+    running = engine.submit(good[0], 20)
+
+    futures = [engine.submit(item, 4) for item in (good[1], bad, good[2], good[3])]
+
+    with pytest.raises(KeyError):
+        futures[1].result(timeout=120)
+    for future in [running] + futures[:1] + futures[2:]:
+        assert not future.result(timeout=120).error
+
+
+def test_failed_page_does_not_sink_its_batch(tiny_hf_model, monkeypatch):
+    monkeypatch.setattr("chandra.model.load_model", lambda: tiny_hf_model)
+    monkeypatch.setattr(settings, "HF_CONTINUOUS_BATCHING", True)
+    manager = InferenceManager(method="hf")
+    try:
+        batch = pages()[:3]
+        batch[1] = BatchInputItem(image=batch[1].image, prompt_type="?")
+        outputs = manager.generate(batch, max_output_tokens=4)
+        batches = list(manager.generate_iter([batch, pages()[3:]], max_output_tokens=4))
+    finally:
+        manager.engine.close()
+
+    assert [output.error for output in outputs] == [False, True, False]
+    assert [output.error for output in batches[0]] == [False, True, False]
+    assert not any(output.error for output in batches[1])
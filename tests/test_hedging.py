@@ -0,0 +1,74 @@
+import asyncio
+import itertools
+import threading
+import time
+
+import pytest
+
+from chandra.model import vllm
+from chandra.model.hedging import HedgePolicy
+from chandra.model.schema import BatchInputItem
+from chandra.model.vllm import generate_vllm, generate_vllm_async
+from chandra.settings import settings
+
+
+def test_no_hedging_until_warmed_up():
+    policy = HedgePolicy(percentile=90, min_samples=5)
+    for seconds in (0.1, 0.2, 0.3, 0.4):
+        policy.record(seconds)
+    assert policy.delay() is None
+    policy.record(2.0)
+    assert policy.delay() == 2.0
+    for seconds in [0.1] * 15:
+        policy.record(seconds)
+    assert policy.delay() == pytest.approx(0.3)
+
+
+def test_hedge_budget():
+    policy = HedgePolicy(budget=0.1, min_samples=0)
+    granted = 0
+    for _ in range(100):
+        policy.delay()
+        granted += policy.try_hedge()
+    assert granted == 10
+    assert policy.hedges == 10
+
+
+@pytest.mark.parametrize("use_async", [False, True])
+def test_straggler_is_hedged(vllm_stub, simple_text_image, monkeypatch, use_async):
+    policy = HedgePolicy(percentile=90, budget=0.5, min_samples=5)
+    for _ in range(5):
+        policy.record(0.5)
+    monkeypatch.setattr(vllm, "hedge_policy", policy)
+    monkeypatch.setattr(settings, "VLLM_HEDGE", True)
+    # Only the very first request is slow, and its response says so
+    calls = itertools.count()
+    request = threading.local()
+
+    def latency():
+        request.slow = next(calls) == 0
+        return 1.5 if request.slow else 0.05
+
+    vllm_stub.latency = latency
+    vllm_stub.response = lambda body: "<p>slow</p>" if request.slow else "<p>fast</p>"
+    batch = [BatchInputItem(image=simple_text_image, prompt="OCR")] * 4
+
+    if use_async:
+        results = asyncio.run(
+            generate_vllm_async(batch, max_retries=0, vllm_api_base=vllm_stub.url)
+        )
+    else:
+        results = generate_vllm(batch, max_retries=0, vllm_api_base=vllm_stub.url)
+
+    # The hedge of the slow request won
+    assert [result.raw for result in results] == ["<p>fast</p>"] * 4
+    # Cold starts can push a normal page past the delay too
+    assert 1 <= policy.hedges <= 2
+    assert policy.wins >= 1
+    assert vllm_stub.requests == 4 + policy.hedges
+
+    # Let the losing request finish on the server before it shuts down
+    deadline = time.monotonic() + 5
+    while vllm_stub.running and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert not vllm_stub.running
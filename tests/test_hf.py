@@ -0,0 +1,179 @@
+import warnings
+
+import pytest
+import torch
+from PIL import Image
+from pydantic import ValidationError
+from qwen_vl_utils import process_vision_info
+
+from benchmarks.tiny_qwen import load_tiny_model
+from chandra.model import hf
+from chandra.model.hf import (
+    BatchLimits,
+    PaddingStats,
+    PipelineStats,
+    RepeatStoppingCriteria,
+    bucket_batch,
+    generate_hf,
+    generate_hf_pipelined,
+    process_batch_element,
+    quantize_for_cpu,
+    vision_token_count,
+)
+from chandra.model.schema import BatchInputItem
+from chandra.settings import Settings, settings
+
+
+class CharTokenizer:
+    def batch_decode(self, ids, skip_special_tokens=True):
+        return ["".join(chr(i) for i in row.tolist() if i) for row in ids]
+
+
+def test_repeat_stopping_criteria():
+    prompt = [ord(c) for c in "prompt"]
+    looping = [ord(c) for c in "<div><p>" + "ab" * 60]
+    varied = [ord(c) for c in "<div><p>" + "The quick brown fox jumps. " * 5]
+    length = min(len(looping), len(varied))
+    input_ids = torch.tensor([prompt + looping[:length], prompt + varied[:length]])
+
+    criteria = RepeatStoppingCriteria(CharTokenizer(), len(prompt), check_every=8)
+    for _ in range(7):
+        assert not criteria(input_ids, None).any()
+    assert criteria(input_ids, None).tolist() == [True, False]
+
+
+def page(width: int, height: int) -> BatchInputItem:
+    return BatchInputItem(
+        image=Image.new("RGB", (width, height), "white"), prompt="OCR"
+    )
+
+
+def test_vision_token_count_matches_processor(tiny_hf_model):
+    processor = tiny_hf_model.processor
+    for size in [(200, 150), (640, 900), (3000, 4000), (30, 2000)]:
+        item = page(*size)
+        messages = [[process_batch_element(item, processor, 1024)]]
+        images, _ = process_vision_info(messages)
+        inputs = processor(text=["<|image_pad|>"], images=images, return_tensors="pt")
+        expected = (inputs.input_ids == processor.image_token_id).sum().item()
+        assert vision_token_count(item, processor) == expected
+
+
+def test_bucket_batch():
+    assert bucket_batch([100, 1000, 120, 900, 160], ratio=1.5) == [[0, 2], [4], [3, 1]]
+    assert bucket_batch([50] * 3, ratio=1.5) == [[0, 1, 2]]
+    assert bucket_batch([], ratio=1.5) == []
+
+
+def test_bucketed_generation(tiny_hf_model, monkeypatch):
+    stats = PaddingStats()
+    monkeypatch.setattr(hf, "padding_stats", stats)
+    batch = [page(200, 150), page(1000, 1300), page(210, 150), page(1000, 1300)]
+
+    results = generate_hf(batch, tiny_hf_model, max_output_tokens=6)
+
+    # Same output, in the same order, as generating each page on its own
+    singles = [
+        generate_hf([item], tiny_hf_model, max_output_tokens=6)[0] for item in batch
+    ]
+    assert [result.raw for result in results] == [result.raw for result in singles]
+    assert stats.unbucketed_padding > 10 * max(stats.padding, 1)
+    assert stats.saved == stats.unbucketed_padding - stats.padding
+
+
+@pytest.mark.parametrize("depth", [1, 3])
+def test_pipelined_generation(tiny_hf_model, monkeypatch, depth):
+    batches = [
+        [page(200, 150), page(600, 800)],
+        [],
+        [page(300, 300)],
+        [page(1000, 1300), page(210, 150)],
+    ]
+    expected = [
+        generate_hf(batch, tiny_hf_model, max_output_tokens=4) for batch in batches
+    ]
+    stats = PipelineStats()
+    monkeypatch.setattr(hf, "pipeline_stats", stats)
+
+    results = list(
+        generate_hf_pipelined(
+            iter(batches), tiny_hf_model, max_output_tokens=4, depth=depth
+        )
+    )
+
+    assert [[r.raw for r in rs] for rs in results] == [
+        [r.raw for r in rs] for rs in expected
+    ]
+    assert stats.batches == len(batches)
+    assert min(stats.prepare, stats.generate, stats.decode) > 0
+    assert stats.wall > 0
+
+
+def simulate_oom(model, monkeypatch, capacity: int):
+    """Makes generate run out of memory on batches over `capacity` pages."""
+    generate = model.generate
+    sizes = []
+
+    def oom_generate(**kwargs):
+        size = kwargs["input_ids"].shape[0]
+        sizes.append(size)
+        if size > capacity:
+            raise torch.OutOfMemoryError("simulated")
+        return generate(**kwargs)
+
+    monkeypatch.setattr(model, "generate", oom_generate)
+    return sizes
+
+
+def test_oom_backoff(tiny_hf_model, monkeypatch):
+    batch = [page(600 + 10 * idx, 800) for idx in range(8)]
+    expected = generate_hf(batch, tiny_hf_model, max_output_tokens=4)
+    limits = BatchLimits(max_size=64)
+    monkeypatch.setattr(hf, "batch_limits", limits)
+    sizes = simulate_oom(tiny_hf_model, monkeypatch, capacity=3)
+
+    results = generate_hf(batch, tiny_hf_model, max_output_tokens=4)
+
+    assert [r.raw for r in results] == [r.raw for r in expected]
+    assert sizes == [8, 4, 2, 2, 3, 1]
+    (key,) = limits.learned()
+    assert limits.learned() == {key: 3} and limits.limit(key) == 3
+
+    # Later batches start from the learned limit
+    sizes.clear()
+    generate_hf(batch, tiny_hf_model, max_output_tokens=4)
+    assert sizes == [3, 3, 2]
+
+
+def test_oom_single_page(tiny_hf_model, monkeypatch):
+    monkeypatch.setattr(hf, "batch_limits", BatchLimits(max_size=64))
+    simulate_oom(tiny_hf_model, monkeypatch, capacity=0)
+
+    results = generate_hf([page(200, 150), page(210, 150)], tiny_hf_model)
+
+    assert [(r.raw, r.error) for r in results] == [("", True), ("", True)]
+
+
+def test_cpu_dtype(monkeypatch):
+    assert settings.TORCH_DTYPE == torch.bfloat16
+    monkeypatch.setattr(settings, "TORCH_DEVICE", "cpu")
+    monkeypatch.setattr(settings, "TORCH_CPU_DTYPE", "float32")
+    assert settings.TORCH_DTYPE == torch.float32
+    monkeypatch.setattr(settings, "TORCH_CPU_DTYPE", None)
+    monkeypatch.setattr(settings, "TORCH_CPU_QUANTIZE", True)
+    assert settings.TORCH_DTYPE == torch.float32
+
+    with pytest.raises(ValidationError, match="TORCH_CPU_DTYPE must be one of"):
+        Settings(TORCH_CPU_DTYPE="int8")
+
+
+def test_quantized_cpu_generation():
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always")
+        model = quantize_for_cpu(load_tiny_model())
+    # Only torch's own deprecation notices are silenced
+    assert not [w for w in caught if "quantiz" in str(w.message)]
+
+    assert isinstance(model.lm_head, torch.ao.nn.quantized.dynamic.Linear)
+    results = generate_hf([page(200, 150)], model, max_output_tokens=4)
+    assert results[0].token_count == 4 and not results[0].error
@@ -0,0 +1,111 @@
+import io
+import math
+import threading
+
+import pytest
+from PIL import Image
+
+from chandra.input import (
+    get_render_scale,
+    iter_file,
+    iter_file_batches,
+    iter_pdf_images,
+    load_file,
+    load_image,
+    load_pdf_images,
+    prefetch,
+)
+
+
+def test_iter_pdf_images_page_range(blank_pdf):
+    images = list(iter_pdf_images(str(blank_pdf), [3, 1, 99]))
+    assert len(images) == 2
+    # Pages come back in document order regardless of range order
+    assert images[0].width < images[1].width
+
+
+def test_load_pdf_images_all_pages(blank_pdf):
+    assert len(load_pdf_images(str(blank_pdf), [])) == 5
+
+
+def test_iter_file_batches(blank_pdf):
+    batches = list(iter_file_batches(str(blank_pdf), {}, batch_size=2, max_pending=1))
+    assert [len(batch) for batch in batches] == [2, 2, 1]
+
+
+def test_closing_batches_joins_the_renderer(blank_pdf):
+    threads = threading.active_count()
+    stream = io.BytesIO(blank_pdf.read_bytes())
+    batches = iter_file_batches(stream, {}, batch_size=1, max_pending=1)
+    next(batches)
+    batches.close()
+    # The stream can be closed now without the renderer still reading it
+    assert threading.active_count() == threads
+    stream.close()
+
+
+def test_prefetch_propagates_errors():
+    def _items():
+        yield 1
+        raise ValueError("boom")
+
+    out = []
+    with pytest.raises(ValueError):
+        for item in prefetch(_items(), max_pending=2):
+            out.append(item)
+    assert out == [1]
+
+
+def test_parallel_render_matches_serial(blank_pdf):
+    serial = load_pdf_images(str(blank_pdf), [0, 2, 4], workers=1)
+    parallel = load_pdf_images(str(blank_pdf), [0, 2, 4], workers=2)
+    assert [img.size for img in parallel] == [img.size for img in serial]
+    assert all(a.tobytes() == b.tobytes() for a, b in zip(serial, parallel))
+
+
+def test_render_scale_respects_model_budget():
+    # 34x22in drawing sheet, far above the model budget at 192 DPI
+    width, height = 2448, 1584
+    max_size = (3072, 2048)
+    scale = get_render_scale(width, height, 192, 1024, max_size)
+    rendered = math.ceil(width * scale) * math.ceil(height * scale)
+    assert rendered <= max_size[0] * max_size[1]
+    assert rendered > 0.99 * max_size[0] * max_size[1]
+
+    # Small pages keep the DPI-derived scale
+    assert get_render_scale(612, 792, 192, 1024, max_size) == 192 / 72
+
+
+def test_load_image_drafts_large_jpeg(tmp_path):
+    path = tmp_path / "photo.jpg"
+    Image.new("RGB", (8000, 5000), "white").save(path, quality=80)
+    image = load_image(str(path), fit_to_model=True)
+    # Decoded at 1/2 scale: still above the model budget, far below full size
+    assert image.size == (4000, 2500)
+    assert load_image(str(path), fit_to_model=False).size == (8000, 5000)
+
+
+def test_iter_image_frames_multipage_tiff(tmp_path):
+    path = tmp_path / "fax.tiff"
+    frames = [Image.new("L", (1728, 2200), shade) for shade in (0, 128, 255)]
+    frames[0].save(path, save_all=True, append_images=frames[1:])
+
+    pages = list(iter_file(str(path), {}))
+    assert len(pages) == 3
+    assert [page.getpixel((0, 0))[0] for page in pages] == [0, 128, 255]
+
+    pages = list(iter_file(str(path), {"page_range": "1-2"}))
+    assert [page.getpixel((0, 0))[0] for page in pages] == [128, 255]
+
+
+def test_load_file_buffer_sources(blank_pdf, simple_text_image):
+    data = blank_pdf.read_bytes()
+    config = {"page_range": "1-2"}
+    assert len(load_file(data, config)) == 2
+    assert len(load_file(memoryview(data), config)) == 2
+    assert len(load_file(io.BytesIO(data), config)) == 2
+
+    buffer = io.BytesIO()
+    simple_text_image.save(buffer, format="PNG")
+    images = load_file(buffer.getvalue(), {})
+    assert len(images) == 1
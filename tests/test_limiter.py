@@ -0,0 +1,106 @@
+import asyncio
+import random
+
+import pytest
+
+from PIL import Image
+
+from benchmarks.vllm_stub import StubVLLMServer
+
+from chandra.model.limiter import AIMDLimit
+from chandra.model.router import EndpointRouter, clear_routers, get_router
+from chandra.model.schema import BatchInputItem
+from chandra.model.vllm import clear_clients, generate_vllm
+
+
+def test_slow_start_then_additive_increase():
+    limit = AIMDLimit(initial=4, max_limit=100)
+    for _ in range(4):
+        limit.on_result(inflight=4, overloaded=False, latency=0.1)
+    assert int(limit) == 8
+
+    limit.on_result(inflight=8, overloaded=True, latency=None)
+    assert int(limit) == 6
+    assert not limit.slow_start
+
+    # After a cut the limit grows by about one per limit's worth of successes
+    for _ in range(12):
+        limit.on_result(inflight=6, overloaded=False, latency=0.1)
+    assert 7 < limit.limit < 8.5
+
+
+def test_one_cut_per_congestion_window():
+    limit = AIMDLimit(initial=32, backoff=0.5)
+    for _ in range(10):
+        limit.on_result(inflight=32, overloaded=True, latency=None)
+    assert int(limit) == 16
+    assert limit.decreases == 1
+
+
+def test_queueing_latency_cuts_limit():
+    limit = AIMDLimit(initial=16, tolerance=2.0)
+    limit.on_result(inflight=16, overloaded=False, latency=0.1)
+    limit.on_result(inflight=16, overloaded=False, latency=0.15)
+    assert limit.decreases == 0
+    limit.on_result(inflight=16, overloaded=False, latency=0.5)
+    assert limit.decreases == 1
+
+
+@pytest.mark.parametrize("large_share", [0.1, 0.5])
+def test_mixed_page_sizes_are_not_queueing(large_share):
+    # Large pages prefill six times longer, with no queueing on the server
+    rng = random.Random(0)
+    limit = AIMDLimit(initial=32, tolerance=2.0)
+    for _ in range(500):
+        large = rng.random() < large_share
+        latency = (0.6 if large else 0.1) * rng.uniform(1.0, 1.3)
+        limit.on_result(32, False, latency, prefill_tokens=4000 if large else 300)
+    assert limit.decreases == 0
+    assert int(limit) >= 32
+
+    # Queueing still shows within a band
+    limit.on_result(32, False, 1.5, prefill_tokens=4000)
+    assert limit.decreases == 1
+
+
+def test_limit_idle_endpoint_does_not_grow():
+    limit = AIMDLimit(initial=16)
+    for _ in range(50):
+        limit.on_result(inflight=1, overloaded=False, latency=0.1)
+    assert int(limit) == 16
+
+
+def test_router_waits_for_a_slot():
+    router = EndpointRouter(["a"], adaptive=True)
+    router.endpoints[0].limit = AIMDLimit(initial=1)
+
+    async def run():
+        first = await router.acquire_async()
+        second = asyncio.ensure_future(router.acquire_async())
+        await asyncio.sleep(0.05)
+        assert not second.done()
+        router.release(first, 0, error=False)
+        return await asyncio.wait_for(second, 1)
+
+    assert asyncio.run(run()).url == "a"
+
+
+def test_limit_settles_near_server_capacity():
+    clear_clients()
+    clear_routers()
+    batch = [BatchInputItem(image=Image.new("RGB", (64, 64)), prompt="OCR")] * 150
+    with StubVLLMServer(latency=0.05, token_latency=0.002, max_num_seqs=4) as server:
+        router = get_router(server.url)
+        router.endpoints[0].limit = AIMDLimit(initial=8)
+        results = generate_vllm(
+            batch, max_retries=0, max_workers=32, vllm_api_base=server.url
+        )
+    clear_routers()
+
+    assert not any(result.error for result in results)
+    stats = router.stats()[0]
+    assert stats["outstanding"] == 0
+    assert stats["throughput"] > 0
+    # Slow start overshot the 4 slots on the server, and queueing cut it back
+    assert router.endpoints[0].limit.decreases >= 1
+    assert stats["concurrency_limit"] < 16
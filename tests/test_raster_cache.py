@@ -0,0 +1,90 @@
+import io
+import os
+import time
+from functools import partial
+
+import pypdfium2 as pdfium
+from PIL import Image
+
+from chandra import input as chandra_input
+from chandra.raster_cache import RasterCache, get_raster_cache, hash_file
+
+
+def test_hash_file_path_and_buffer(blank_pdf):
+    data = blank_pdf.read_bytes()
+    assert hash_file(blank_pdf) == hash_file(io.BytesIO(data))
+
+
+def test_get_put_roundtrip(tmp_path):
+    cache = RasterCache(str(tmp_path), max_bytes=10 * 1024 * 1024)
+    image = Image.new("RGB", (32, 16), "red")
+    key = cache.make_key("abc", 0, 2.0, flatten=True)
+    assert cache.get(key) is None
+    cache.put(key, image)
+    cached = cache.get(key)
+    assert cached.size == (32, 16)
+    assert cached.tobytes() == image.tobytes()
+
+
+def test_lru_eviction(tmp_path):
+    image = Image.new("RGB", (64, 64), "white")
+    entry_size = 64 * 64 * 3 + 15  # PPM header
+    cache = RasterCache(str(tmp_path), max_bytes=int(entry_size * 2.5))
+
+    keys = [cache.make_key("abc", page, 1.0, flatten=True) for page in range(3)]
+    cache.put(keys[0], image)
+    cache.put(keys[1], image)
+    # Touch the first entry so the second one is least recently used
+    past = time.time() - 10
+    os.utime(cache._path(keys[1]), (past, past))
+    cache.get(keys[0])
+    cache.put(keys[2], image)
+
+    assert cache.get(keys[1]) is None
+    assert cache.get(keys[0]) is not None
+    assert cache.get(keys[2]) is not None
+
+
+def test_warm_render_skips_pdfium(blank_pdf, tmp_path, monkeypatch):
+    monkeypatch.setattr(chandra_input.settings, "RASTER_CACHE_DIR", str(tmp_path))
+    get_raster_cache.cache_clear()
+    try:
+        cold = chandra_input.load_pdf_images(str(blank_pdf), [], use_cache=True)
+
+        def _fail(*args, **kwargs):
+            raise AssertionError("page was re-rendered")
+
+        monkeypatch.setattr(chandra_input, "flatten", _fail)
+        warm = chandra_input.load_pdf_images(str(blank_pdf), [], use_cache=True)
+    finally:
+        get_raster_cache.cache_clear()
+
+    assert [img.tobytes() for img in cold] == [img.tobytes() for img in warm]
+
+
+def test_warm_render_keeps_text_layer(annotated_pdf, tmp_path, monkeypatch):
+    monkeypatch.setattr(chandra_input.settings, "RASTER_CACHE_DIR", str(tmp_path))
+    get_raster_cache.cache_clear()
+    load = partial(
+        chandra_input.load_pdf_images,
+        str(annotated_pdf),
+        [],
+        use_cache=True,
+        text_layer=True,
+    )
+    try:
+        cold = load()
+
+        def _fail(*args, **kwargs):
+            raise AssertionError("page was re-rendered")
+
+        monkeypatch.setattr(pdfium.PdfPage, "render", _fail)
+        warm = load()
+    finally:
+        get_raster_cache.cache_clear()
+
+    # The note is only part of the text layer once the page is flattened
+    assert "records office" in cold[0].info["text_layer"][-1]["text"]
+    assert [img.info["text_layer"] for img in warm] == [
+        img.info["text_layer"] for img in cold
+    ]
@@ -0,0 +1,123 @@
+import random
+
+import pytest
+
+from chandra.model.util import (
+    RepeatMonitor,
+    detect_repeat_raw,
+    detect_repeat_token,
+    has_repeat,
+    repeat_free_prefix,
+)
+
+WORDS = (
+    "the of and to in a is that for it as was with be by on not he this are "
+    "or his from at which but have an they you were her she there been one all"
+).split()
+
+
+def sentence(rng: random.Random, n: int) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(n)).capitalize() + "."
+
+
+def div(label: str, inner: str, bbox: str = "10 10 500 60") -> str:
+    return f'<div data-bbox="{bbox}" data-label="{label}">{inner}</div>'
+
+
+def page(rng: random.Random, n: int) -> str:
+    return "".join(
+        div("Text", f"<p>{sentence(rng, rng.randint(8, 30))}</p>") for _ in range(n)
+    )
+
+
+def build_corpus():
+    rng = random.Random(0)
+    corpus = {f"page_{i}": page(rng, rng.randint(1, 12)) for i in range(10)}
+    corpus["long_page"] = page(rng, 60)
+    corpus["numbers"] = div("Text", "<p>" + " ".join(map(str, range(400))) + "</p>")
+    corpus["distinct_rows"] = div(
+        "Table",
+        "<table>"
+        + "".join(f"<tr><td>{i}</td><td>{i * 7}</td></tr>" for i in range(40))
+        + "</table>",
+    )
+    corpus["looping_rows"] = div("Table", "<table>" + "<tr><td>1</td></tr>" * 60)
+    corpus["looping_list"] = div("List-Group", "<ul>" + "<li>Item</li>" * 50)
+    corpus["looping_math"] = div("Text", "<p><math>x_1</math>" + " + x_2" * 80)
+    corpus["entities"] = div("Text", "<p>" + "&amp; " * 40 + "</p>")
+    corpus["cut_mid_tag"] = page(rng, 2) + div("Text", "<p>" + "loop " * 100 + "</di")
+    corpus["long_period"] = page(rng, 2) + div(
+        "Text", "<p>" + (sentence(rng, 30) + " ") * 8 + "</p>"
+    )
+    # Both sides of the repeat threshold, for paragraphs and whole blocks
+    for count in range(1, 10):
+        corpus[f"phrase_x{count}"] = page(rng, 2) + div(
+            "Text", "<p>" + "results are shown " * count + "</p>"
+        )
+        corpus[f"blocks_x{count}"] = page(rng, 2) + "".join(
+            div("Text", "<p>Same para.</p>", f"10 {20 + i * 30} 500 {40 + i * 30}")
+            for i in range(count)
+        )
+        # Inline markup, which markdown renders as markers
+        corpus[f"bold_x{count}"] = page(rng, 2) + div(
+            "Text", "<p>" + "<b>results</b> are shown " * count + "</p>"
+        )
+        corpus[f"emphasis_x{count}"] = page(rng, 2) + div(
+            "Text", "<p>" + "<em>note</em>: see <i>a_b</i> " * count + "</p>"
+        )
+        corpus[f"link_x{count}"] = page(rng, 2) + div(
+            "Text", "<p>" + "<i>item</i> <a href='u'>note</a> " * count + "</p>"
+        )
+        for tag in ("ul", "ol"):
+            corpus[f"{tag}_x{count}"] = page(rng, 2) + div(
+                "List-Group", f"<{tag}>" + "<li>Same item</li>" * count + f"</{tag}>"
+            )
+    return corpus
+
+
+CORPUS = build_corpus()
+
+
+def markdown_has_repeat(text: str) -> bool:
+    return detect_repeat_token(text) or (
+        len(text) > 50 and detect_repeat_token(text, cut_from_end=50)
+    )
+
+
+@pytest.mark.parametrize("name", CORPUS)
+def test_agrees_with_markdown_detector(name):
+    assert has_repeat(CORPUS[name]) == markdown_has_repeat(CORPUS[name])
+
+
+def test_corpus_has_both_outcomes():
+    outcomes = [markdown_has_repeat(text) for text in CORPUS.values()]
+    assert 10 <= sum(outcomes) <= len(outcomes) - 10
+
+
+def test_short_and_empty():
+    assert not detect_repeat_raw("")
+    assert not detect_repeat_raw("<div><p></p></div>")
+    assert detect_repeat_raw("a" * 17)
+    assert not detect_repeat_raw("a" * 16)
+
+
+def test_monitor_flags_loop_in_stream():
+    monitor = RepeatMonitor(check_every=64)
+    text = page(random.Random(1), 20) + div("Text", "<p>" + "again " * 5000)
+    pieces = [text[i : i + 4] for i in range(0, len(text), 4)]
+    stopped_at = next(
+        (i for i, piece in enumerate(pieces) if monitor.feed(piece)), None
+    )
+    assert stopped_at is not None
+    assert stopped_at < len(pieces) // 10
+
+
+def test_repeat_free_prefix():
+    block = div("Text", "<p>Same para.</p>")
+    good = page(random.Random(2), 3)
+    prefix = repeat_free_prefix(good + block * 30 + '<div data-label="Text"><p>x')
+    assert prefix.startswith(good)
+    assert not has_repeat(prefix)
+    assert prefix.count(block) >= 1
+
+    assert repeat_free_prefix("<div><p>" + "loop " * 100) == ""
@@ -0,0 +1,188 @@
+import asyncio
+import email.utils
+import threading
+import time
+
+import pytest
+
+from benchmarks.vllm_stub import StubVLLMServer
+
+from chandra.model.router import get_router
+from chandra.model.schema import BatchInputItem
+from chandra.model.vllm import (
+    backoff_delay,
+    generate_vllm,
+    generate_vllm_async,
+    parse_retry_after,
+)
+from chandra.settings import settings
+
+
+def wait_for(condition, timeout: float = 5.0):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.02)
+
+
+def failing_first(count: int, status: int):
+    calls = iter(range(1_000_000))
+    return lambda: status if next(calls) < count else 200
+
+
+def test_parse_retry_after():
+    assert parse_retry_after("3") == 3.0
+    assert parse_retry_after("bogus") is None
+    assert parse_retry_after(None) is None
+    later = email.utils.formatdate(time.time() + 30, usegmt=True)
+    assert 25 < parse_retry_after(later) <= 30
+    assert parse_retry_after("100000") == settings.VLLM_RETRY_AFTER_MAX
+
+
+def test_backoff_is_jittered_and_capped():
+    delays = [backoff_delay(3) for _ in range(200)]
+    assert all(0 <= delay <= 8 * settings.VLLM_RETRY_BACKOFF for delay in delays)
+    assert len(set(delays)) > 100
+    assert backoff_delay(50) <= settings.VLLM_RETRY_BACKOFF_MAX
+    assert backoff_delay(0, retry_after=2.0) >= 2.0
+
+
+def test_bad_request_is_not_retried(vllm_stub, simple_text_image):
+    vllm_stub.status = 400
+    batch = [BatchInputItem(image=simple_text_image, prompt="OCR")]
+    results = generate_vllm(
+        batch, max_retries=3, max_failure_retries=3, vllm_api_base=vllm_stub.url
+    )
+
+    assert results[0].error and not results[0].retryable
+    assert vllm_stub.requests == 1
+    # A request the server rightly rejected says nothing about its health
+    assert get_router(vllm_stub.url).stats()[0]["errors"] == 0
+
+
+def test_retry_after_is_honoured(vllm_stub, simple_text_image, monkeypatch):
+    monkeypatch.setattr(settings, "VLLM_RETRY_BACKOFF", 0.01)
+    vllm_stub.status = failing_first(1, 429)
+    vllm_stub.retry_after = "0.5"
+    batch = [BatchInputItem(image=simple_text_image, prompt="OCR")]
+
+    start = time.perf_counter()
+    results = generate_vllm(batch, max_retries=3, vllm_api_base=vllm_stub.url)
+
+    assert not results[0].error
+    assert vllm_stub.requests == 2
+    assert time.perf_counter() - start >= 0.5
+    assert get_router(vllm_stub.url).endpoints[0].limit.decreases == 1
+
+
+def test_read_timeout(vllm_stub, simple_text_image, monkeypatch):
+    monkeypatch.setattr(settings, "VLLM_READ_TIMEOUT", 0.2)
+    vllm_stub.latency = 1.0
+    batch = [BatchInputItem(image=simple_text_image, prompt="OCR")]
+
+    start = time.perf_counter()
+    results = generate_vllm(batch, max_retries=0, vllm_api_base=vllm_stub.url)
+
+    assert results[0].error and results[0].retryable
+    assert time.perf_counter() - start < 0.9
+
+
+def test_circuit_breaker_fails_fast(simple_text_image, monkeypatch):
+    monkeypatch.setattr(settings, "VLLM_RETRY_BACKOFF", 0.2)
+    monkeypatch.setattr(settings, "VLLM_CIRCUIT_COOLDOWN", 0.3)
+    server = StubVLLMServer().start()
+    server.stop()  # Nothing listens on its port now
+    batch = [BatchInputItem(image=simple_text_image, prompt="OCR")] * 20
+
+    results = generate_vllm(
+        batch, max_retries=1, max_workers=4, vllm_api_base=server.url
+    )
+
+    assert all(result.error for result in results)
+    router = get_router(server.url)
+    assert router.circuit_open_until is not None
+    # Pages wait out the open circuit instead of each trying the dead server
+    assert router.stats()[0]["requests"] < len(batch)
+
+
+def test_circuit_recovers_after_a_blip(vllm_stub, simple_text_image, monkeypatch):
+    monkeypatch.setattr(settings, "VLLM_RETRY_BACKOFF", 0.01)
+    monkeypatch.setattr(settings, "VLLM_CIRCUIT_COOLDOWN", 0.3)
+    vllm_stub.status = failing_first(settings.VLLM_EJECT_AFTER_FAILURES, 500)
+    batch = [BatchInputItem(image=simple_text_image, prompt="OCR")] * 6
+
+    results = generate_vllm(
+        batch, max_retries=6, max_workers=6, vllm_api_base=vllm_stub.url
+    )
+
+    assert not any(result.error for result in results)
+    assert get_router(vllm_stub.url).circuit_open_until is None
+
+
+def test_bad_page_leaves_endpoint_healthy(vllm_stub, simple_text_image):
+    bad = [BatchInputItem(image=simple_text_image, prompt_type="bogus")] * 5
+    results = generate_vllm(bad, max_retries=3, vllm_api_base=vllm_stub.url)
+
+    assert all(result.error and not result.retryable for result in results)
+    assert vllm_stub.requests == 0
+    router = get_router(vllm_stub.url)
+    assert router.circuit_open_until is None
+    assert router.stats()[0]["requests"] == 0
+    assert router.stats()[0]["errors"] == 0
+
+    good = [BatchInputItem(image=simple_text_image, prompt="OCR")]
+    assert not generate_vllm(good, vllm_api_base=vllm_stub.url)[0].error
+
+    results = asyncio.run(
+        generate_vllm_async(bad, max_retries=3, vllm_api_base=vllm_stub.url)
+    )
+    assert all(result.error for result in results)
+    assert router.stats()[0]["errors"] == 0
+
+
+def test_cancel_aborts_streams(vllm_stub, simple_text_image):
+    vllm_stub.response = "<div><p>" + "slow text " * 500 + "</p></div>"
+    vllm_stub.token_latency = 0.01
+    batch = [BatchInputItem(image=simple_text_image, prompt="OCR")] * 4
+    cancel = threading.Event()
+    results = []
+
+    thread = threading.Thread(
+        target=lambda: results.extend(
+            generate_vllm(
+                batch, max_retries=0, vllm_api_base=vllm_stub.url, cancel=cancel
+            )
+        )
+    )
+    thread.start()
+    wait_for(lambda: vllm_stub.streamed_chunks >= 4)
+    start = time.perf_counter()
+    cancel.set()
+    thread.join(5)
+
+    assert time.perf_counter() - start < 1
+    assert len(results) == 4 and all(result.error for result in results)
+    wait_for(lambda: vllm_stub.aborted_streams == 4)
+    assert vllm_stub.aborted_streams == 4
+    assert vllm_stub.completed_streams == 0
+
+
+def test_cancel_async_task(vllm_stub, simple_text_image):
+    vllm_stub.response = "<div><p>" + "slow text " * 500 + "</p></div>"
+    vllm_stub.token_latency = 0.01
+    batch = [BatchInputItem(image=simple_text_image, prompt="OCR")] * 4
+
+    async def run():
+        task = asyncio.ensure_future(
+            generate_vllm_async(batch, max_retries=0, vllm_api_base=vllm_stub.url)
+        )
+        await asyncio.to_thread(wait_for, lambda: vllm_stub.streamed_chunks >= 4)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(run())
+    wait_for(lambda: vllm_stub.aborted_streams == 4)
+    assert vllm_stub.aborted_streams == 4
+    stats = get_router(vllm_stub.url).stats()[0]
+    assert stats["outstanding"] == 0
+    assert stats["errors"] == 0
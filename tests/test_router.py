@@ -0,0 +1,147 @@
+import asyncio
+
+import pytest
+
+from benchmarks.vllm_stub import StubVLLMServer
+
+from chandra.model.router import (
+    CircuitOpenError,
+    EndpointRouter,
+    clear_routers,
+    get_router,
+    parse_endpoints,
+)
+from chandra.model.schema import BatchInputItem
+from chandra.model.vllm import clear_clients, generate_vllm, generate_vllm_async
+from chandra.settings import settings
+
+
+@pytest.fixture()
+def replicas():
+    clear_clients()
+    clear_routers()
+    servers = [StubVLLMServer().start() for _ in range(3)]
+    yield servers
+    for server in servers:
+        server.stop()
+    clear_routers()
+
+
+def test_parse_endpoints():
+    assert parse_endpoints("http://a/v1/, http://b/v1") == (
+        "http://a/v1",
+        "http://b/v1",
+    )
+    assert parse_endpoints(["http://a/v1"]) == ("http://a/v1",)
+    with pytest.raises(ValueError):
+        parse_endpoints(" , ")
+
+
+@pytest.mark.parametrize("policy", ["least_tokens", "least_requests"])
+def test_acquire_prefers_least_loaded(policy):
+    router = EndpointRouter(["a", "b"], policy=policy)
+    big = router.acquire(cost=5000)
+    smalls = [router.acquire(cost=10) for _ in range(2)]
+
+    # Token routing keeps small requests off the replica busy with a big one
+    if policy == "least_tokens":
+        assert all(lease.endpoint is not big.endpoint for lease in smalls)
+    else:
+        assert smalls[1].endpoint is big.endpoint
+
+
+def test_slow_replica_gets_less_work(replicas, simple_text_image):
+    replicas[0].latency = 0.2
+    batch = [BatchInputItem(image=simple_text_image, prompt="OCR")] * 30
+    results = generate_vllm(
+        batch,
+        max_retries=0,
+        max_workers=6,
+        vllm_api_base=",".join(server.url for server in replicas),
+    )
+
+    assert not any(result.error for result in results)
+    assert replicas[0].requests < min(replicas[1].requests, replicas[2].requests)
+
+
+@pytest.mark.parametrize("use_async", [False, True])
+def test_failing_replica_is_ejected(
+    replicas, simple_text_image, use_async, monkeypatch
+):
+    monkeypatch.setattr(settings, "VLLM_EJECT_AFTER_FAILURES", 2)
+    replicas[0].status = 500
+    api_base = ",".join(server.url for server in replicas)
+    batch = [BatchInputItem(image=simple_text_image, prompt="OCR")] * 12
+    kwargs = dict(max_retries=0, max_failure_retries=2, vllm_api_base=api_base)
+
+    def run():
+        if use_async:
+            return asyncio.run(generate_vllm_async(batch, max_concurrency=4, **kwargs))
+        return generate_vllm(batch, max_workers=4, **kwargs)
+
+    # Failed requests were retried on the healthy replicas
+    assert not any(result.error for result in run())
+    router = get_router(api_base)
+    stats = {endpoint["url"]: endpoint for endpoint in router.stats()}
+    assert not stats[replicas[0].url]["healthy"]
+    assert stats[replicas[0].url]["ejections"] == 1
+
+    # Requests already on their way may land after the ejection, but no new
+    # ones are sent to it
+    ejected_requests = replicas[0].requests
+    assert not any(result.error for result in run())
+    assert replicas[0].requests == ejected_requests
+
+    replicas[0].status = 200
+    router.probe()
+    assert all(endpoint["healthy"] for endpoint in router.stats())
+
+
+def test_probe_ejects_unreachable_replica(replicas):
+    router = EndpointRouter([server.url for server in replicas])
+    replicas[1].stop()
+    router.probe()
+    healthy = [endpoint["healthy"] for endpoint in router.stats()]
+    assert healthy == [True, False, True]
+
+
+def test_last_replica_opens_circuit():
+    router = EndpointRouter(["a"])
+    for _ in range(settings.VLLM_EJECT_AFTER_FAILURES):
+        router.release(router.acquire(), 0, error=True)
+    assert router.endpoints[0].healthy
+    with pytest.raises(CircuitOpenError):
+        router.acquire()
+
+    # After the cooldown a single trial goes through and closes the circuit
+    router.circuit_open_until = 0
+    trial = router.acquire()
+    with pytest.raises(CircuitOpenError):
+        router.acquire()
+    router.release(trial, 0, error=False)
+    assert router.circuit_open_until is None
+    router.release(router.acquire(), 0, error=False)
+
+
+def test_only_the_trial_closes_the_circuit():
+    router = EndpointRouter(["a"])
+    stale = router.acquire()
+    for _ in range(settings.VLLM_EJECT_AFTER_FAILURES):
+        router.release(router.acquire(), 0, error=True)
+    with pytest.raises(CircuitOpenError) as error:
+        router.acquire()
+    assert 0 < error.value.retry_after <= settings.VLLM_CIRCUIT_COOLDOWN
+
+    # A request sent before the circuit opened doesn't close it
+    router.release(stale, 0, error=False)
+    assert router.circuit_open_until is not None
+
+    # Nor does a cancelled trial, which lets the next request try instead
+    router.circuit_open_until = 0
+    router.release(router.acquire(), 0, error=False, cancelled=True)
+    assert router.circuit_open_until == 0
+    assert router.endpoints[0].errors == settings.VLLM_EJECT_AFTER_FAILURES
+
+    # A failed trial opens it again
+    router.release(router.acquire(), 0, error=True)
+    assert router.circuit_open_until > 0
@@ -0,0 +1,58 @@
+from chandra.input import load_pdf_images
+from chandra.model import InferenceManager
+from chandra.model.schema import BatchInputItem
+
+
+def test_text_layer_blocks(text_pdf):
+    image = load_pdf_images(str(text_pdf), [], text_layer=True)[0]
+    blocks = image.info["text_layer"]
+    assert len(blocks) == 2
+    assert blocks[0]["text"].startswith("Chandra converts")
+    assert blocks[0]["text"].endswith("same paragraph.")
+    assert all(0 <= coord <= 1 for block in blocks for coord in block["bbox"])
+    assert blocks[0]["bbox"][1] < blocks[1]["bbox"][1]
+
+
+def test_blank_page_has_no_text_layer(blank_pdf):
+    image = load_pdf_images(str(blank_pdf), [0], text_layer=True)[0]
+    assert image.info["text_layer"] is None
+
+
+def test_text_layer_skips_model(text_pdf):
+    image = load_pdf_images(str(text_pdf), [], text_layer=True)[0]
+    manager = InferenceManager(method="vllm")
+    batch = [
+        BatchInputItem(
+            image=image,
+            prompt_type="ocr_layout",
+            text_layer=image.info["text_layer"],
+        )
+    ]
+    output = manager.generate(batch, bbox_scale=1000)[0]
+    assert output.from_text_layer
+    assert output.token_count == 0
+    assert "separate paragraph" in output.markdown
+    assert len(output.chunks) == 2
+    assert output.chunks[0]["label"] == "Text"
+    # Chunk bboxes are in image pixels, like parse_chunks output for the model
+    x0, y0, x1, y1 = output.chunks[0]["bbox"]
+    assert 0 <= x0 < x1 <= image.width and 0 <= y0 < y1 <= image.height
+
+
+def test_text_layer_labels_headers_and_footers(header_footer_pdf):
+    image = load_pdf_images(str(header_footer_pdf), [], text_layer=True)[0]
+    labels = [block["label"] for block in image.info["text_layer"]]
+    assert labels == ["Page-Header", "Text", "Text", "Page-Footer"]
+
+    manager = InferenceManager(method="vllm")
+    batch = [
+        BatchInputItem(
+            image=image,
+            prompt_type="ocr_layout",
+            text_layer=image.info["text_layer"],
+        )
+    ]
+    output = manager.generate(batch)[0]
+    assert "Chandra converts" in output.markdown
+    assert "Annual Report" not in output.markdown
+    assert "Page 7" not in output.markdown
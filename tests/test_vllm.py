@@ -0,0 +1,252 @@
+import asyncio
+import base64
+import gc
+import io
+import threading
+import time
+
+import pytest
+from PIL import Image
+
+from benchmarks.vllm_stub import DEFAULT_RESPONSE
+
+from chandra.model import InferenceManager
+from chandra.model.schema import BatchInputItem
+from chandra.model.vllm import (
+    SpeculationStats,
+    IMAGE_CODECS,
+    generate_vllm,
+    clear_clients,
+    generate_vllm_async,
+    get_async_clients,
+    get_client,
+    image_to_data_url,
+)
+from chandra.settings import settings
+
+
+@pytest.mark.parametrize("codec", IMAGE_CODECS)
+def test_image_to_data_url(codec, simple_text_image):
+    data_url = image_to_data_url(simple_text_image, codec)
+    header, payload = data_url.split(",", 1)
+    assert header == f"data:image/{codec};base64"
+
+    decoded = Image.open(io.BytesIO(base64.b64decode(payload))).convert("RGB")
+    assert decoded.size == simple_text_image.size
+    if codec != "jpeg":
+        assert decoded.tobytes() == simple_text_image.tobytes()
+
+
+def test_unknown_codec(simple_text_image):
+    with pytest.raises(ValueError):
+        image_to_data_url(simple_text_image, "gif")
+
+
+def test_client_is_shared(vllm_stub, simple_text_image, monkeypatch):
+    monkeypatch.setattr(settings, "VLLM_MODEL_NAME", None)
+    batch = [BatchInputItem(image=simple_text_image, prompt="OCR")]
+    for _ in range(3):
+        results = generate_vllm(batch, max_retries=0, vllm_api_base=vllm_stub.url)
+        assert not results[0].error
+
+    assert get_client(vllm_stub.url) is get_client(vllm_stub.url)
+    assert vllm_stub.requests == 3
+    assert vllm_stub.model_list_calls == 1
+    assert vllm_stub.connections == 1
+
+
+def test_client_pool_grows(vllm_stub):
+    small = get_client(vllm_stub.url, pool_size=4)
+    assert get_client(vllm_stub.url, pool_size=2) is small
+    assert get_client(vllm_stub.url, pool_size=8) is not small
+
+
+def test_replaced_clients_close_their_pool(vllm_stub):
+    small = get_client(vllm_stub.url, pool_size=4)
+    pool = small._client
+    get_client(vllm_stub.url, pool_size=8)
+    # Closed once the requests using the old client let go of it
+    assert not pool.is_closed
+    del small
+    gc.collect()
+    assert pool.is_closed
+
+    async def run():
+        small = get_async_clients(vllm_stub.url, pool_size=4)[0]
+        pool = small._client
+        get_async_clients(vllm_stub.url, pool_size=1000)
+        del small
+        gc.collect()
+        await asyncio.sleep(0.05)
+        assert pool.is_closed
+
+        pool = get_async_clients(vllm_stub.url)[0]._client
+        clear_clients()
+        await asyncio.sleep(0.05)
+        assert pool.is_closed
+
+    asyncio.run(run())
+
+
+def test_agenerate_matches_generate(vllm_stub, simple_text_image):
+    manager = InferenceManager(method="vllm")
+    batch = [BatchInputItem(image=simple_text_image, prompt="OCR")] * 3
+    kwargs = dict(max_retries=0, vllm_api_base=vllm_stub.url)
+
+    expected = manager.generate(batch, **kwargs)
+    actual = asyncio.run(manager.agenerate(batch, **kwargs))
+    assert actual == expected
+    assert actual[0].markdown.strip() == "Stub page"
+
+
+def test_generate_vllm_async_concurrency(vllm_stub, simple_text_image):
+    vllm_stub.latency = 0.2
+    batch = [BatchInputItem(image=simple_text_image, prompt="OCR")] * 20
+
+    async def run():
+        semaphore = asyncio.Semaphore(10)
+        start = time.perf_counter()
+        results = await generate_vllm_async(
+            batch, max_retries=0, semaphore=semaphore, vllm_api_base=vllm_stub.url
+        )
+        return results, time.perf_counter() - start
+
+    results, elapsed = asyncio.run(run())
+    assert not any(result.error for result in results)
+    assert vllm_stub.requests == 20
+    # Two waves of ten concurrent requests
+    assert 0.4 <= elapsed < 2.0
+
+
+@pytest.mark.parametrize("stream", [True, False])
+def test_streamed_output_matches(vllm_stub, simple_text_image, monkeypatch, stream):
+    monkeypatch.setattr(settings, "VLLM_STREAM", stream)
+    batch = [BatchInputItem(image=simple_text_image, prompt="OCR")]
+    result = generate_vllm(batch, max_retries=0, vllm_api_base=vllm_stub.url)[0]
+    assert result.raw == DEFAULT_RESPONSE
+    assert vllm_stub.completed_streams == int(stream)
+
+
+def test_stream_aborts_on_repeat(vllm_stub, simple_text_image):
+    looping = '<div data-label="Text"><p>' + "the same line " * 2000
+    vllm_stub.response = looping
+    vllm_stub.token_latency = 0.0005
+    batch = [BatchInputItem(image=simple_text_image, prompt="OCR")]
+
+    result = generate_vllm(batch, max_retries=1, vllm_api_base=vllm_stub.url)[0]
+    assert vllm_stub.requests == 2
+    assert len(result.raw) < len(looping) // 4
+
+    # The server sees the client hang up
+    deadline = time.time() + 5
+    while vllm_stub.aborted_streams < 2 and time.time() < deadline:
+        time.sleep(0.05)
+    assert vllm_stub.aborted_streams == 2
+    assert vllm_stub.completed_streams == 0
+
+
+@pytest.mark.parametrize("stream", [True, False])
+def test_repeat_retry_continues_from_prefix(
+    vllm_stub, simple_text_image, monkeypatch, stream
+):
+    monkeypatch.setattr(settings, "VLLM_STREAM", stream)
+    good = (
+        '<div data-label="Text"><p>First block.</p></div>'
+        '<div data-label="Text"><p>Second block.</p></div>'
+    )
+    ending = '<div data-label="Text"><p>Last block.</p></div>'
+
+    def respond(body):
+        if body["messages"][-1]["role"] == "assistant":
+            return ending
+        return good + '<div data-label="Text"><p>' + "the same line " * 300
+
+    vllm_stub.response = respond
+    batch = [BatchInputItem(image=simple_text_image, prompt="OCR")]
+    result = generate_vllm(
+        batch, max_output_tokens=2000, max_retries=2, vllm_api_base=vllm_stub.url
+    )[0]
+
+    assert result.raw == good + ending
+    assert vllm_stub.requests == 2
+    retry = vllm_stub.bodies[1]
+    assert retry["messages"][-1] == {"role": "assistant", "content": good}
+    assert retry["continue_final_message"] and not retry["add_generation_prompt"]
+    assert retry["temperature"] == 0.3
+    assert retry["max_tokens"] < 2000
+
+
+@pytest.mark.parametrize("use_async", [False, True])
+def test_speculative_retries_race(vllm_stub, simple_text_image, monkeypatch, use_async):
+    monkeypatch.setattr(settings, "VLLM_SPECULATIVE_RETRIES", 3)
+    monkeypatch.setattr(settings, "VLLM_CONTINUE_ON_REPEAT", False)
+    looping = '<div data-label="Text"><p>' + "the same line " * 300
+    clean = '<div data-label="Text"><p>Clean page.</p></div>'
+    slow = '<div data-label="Text"><p>' + " ".join(map(str, range(3000))) + "</p></div>"
+    outputs = {None: looping, 0: looping, 1: clean, 2: slow}
+    vllm_stub.response = lambda body: outputs[body.get("seed")]
+    vllm_stub.token_latency = 0.001
+    stats = SpeculationStats()
+    monkeypatch.setattr("chandra.model.vllm.speculation_stats", stats)
+
+    batch = [BatchInputItem(image=simple_text_image, prompt="OCR")]
+    start = time.perf_counter()
+    kwargs = dict(max_retries=6, vllm_api_base=vllm_stub.url)
+    if use_async:
+        result = asyncio.run(generate_vllm_async(batch, **kwargs))[0]
+    else:
+        result = generate_vllm(batch, **kwargs)[0]
+    elapsed = time.perf_counter() - start
+
+    assert result.raw == clean
+    assert vllm_stub.requests == 4
+    seeds = sorted(body["seed"] for body in vllm_stub.bodies[1:])
+    assert seeds == [0, 1, 2]
+    assert {body["temperature"] for body in vllm_stub.bodies[1:]} == {0.3, 0.5, 0.7}
+    # The slow candidate is dropped instead of running for ~4s
+    assert elapsed < 3
+    assert stats.races == 1 and stats.candidates == 3
+    assert stats.extra_tokens > 0
+
+
+def test_non_streamed_race_cancels_losers(vllm_stub, simple_text_image, monkeypatch):
+    monkeypatch.setattr(settings, "VLLM_STREAM", False)
+    monkeypatch.setattr(settings, "VLLM_SPECULATIVE_RETRIES", 3)
+    monkeypatch.setattr(settings, "VLLM_CONTINUE_ON_REPEAT", False)
+    looping = '<div data-label="Text"><p>' + "the same line " * 300
+    clean = '<div data-label="Text"><p>Clean page.</p></div>'
+    slow = '<div data-label="Text"><p>' + " ".join(map(str, range(3000))) + "</p></div>"
+    outputs = {None: looping, 0: looping, 1: clean, 2: slow}
+    vllm_stub.response = lambda body: outputs[body.get("seed")]
+    # Non-streamed replies take this per chunk, so the slow candidate takes ~7s
+    vllm_stub.token_latency = 0.002
+    stats = SpeculationStats()
+    monkeypatch.setattr("chandra.model.vllm.speculation_stats", stats)
+
+    batch = [BatchInputItem(image=simple_text_image, prompt="OCR")]
+    start = time.perf_counter()
+    result = asyncio.run(
+        generate_vllm_async(batch, max_retries=6, vllm_api_base=vllm_stub.url)
+    )[0]
+
+    assert result.raw == clean
+    assert time.perf_counter() - start < 5
+    assert stats.races == 1 and stats.candidates == 3
+
+
+def test_non_streamed_sync_needs_stream_to_cancel(
+    vllm_stub, simple_text_image, monkeypatch
+):
+    monkeypatch.setattr(settings, "VLLM_STREAM", False)
+    monkeypatch.setattr(settings, "VLLM_SPECULATIVE_RETRIES", 3)
+    batch = [BatchInputItem(image=simple_text_image, prompt="OCR")]
+    with pytest.raises(ValueError, match="VLLM_STREAM"):
+        generate_vllm(batch, vllm_api_base=vllm_stub.url, cancel=threading.Event())
+
+    # Sampled retries go one at a time, since losers couldn't be stopped
+    vllm_stub.response = '<div data-label="Text"><p>' + "the same line " * 300
+    stats = SpeculationStats()
+    monkeypatch.setattr("chandra.model.vllm.speculation_stats", stats)
+    generate_vllm(batch, max_retries=2, vllm_api_base=vllm_stub.url)
+    assert vllm_stub.requests == 3
+    assert stats.races == 0